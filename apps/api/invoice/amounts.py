@@ -0,0 +1,131 @@
+# invoice/amounts.py
+
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import lru_cache
+from typing import Iterable, List, Optional
+
+from invoice.ban import NO_BAN
+
+# 課稅別: 1 應稅, 2 零稅率, 3 免稅, 4 特種稅率, 9 混合應稅與免稅或零稅率
+TAXABLE = "1"
+ZERO_RATED = "2"
+TAX_FREE = "3"
+SPECIAL_RATE = "4"
+MIXED = "9"
+ITEM_TAX_TYPES = (TAXABLE, ZERO_RATED, TAX_FREE)
+
+ONE = Decimal(1)
+ZERO = Decimal(0)
+AMOUNT_FIELDS = ("SalesAmount", "FreeTaxSalesAmount", "ZeroTaxSalesAmount", "TaxAmount", "TotalAmount")
+
+# Tills send the same few strings ("1", "100", "0.05") over and over; parse each once
+@lru_cache(maxsize=4096)
+def _decimal(value: str) -> Decimal:
+    number = Decimal(value)
+    if not number.is_finite():
+        raise InvalidOperation(value)
+    return number
+
+@lru_cache(maxsize=64)
+def _divisor(rate: str) -> Decimal:
+    return ONE + _decimal(rate)
+
+def to_decimal(value) -> Optional[Decimal]:
+    try:
+        return _decimal(str(value).strip())
+    except (InvalidOperation, ValueError):
+        return None
+
+def round_amount(value: Decimal) -> Decimal:
+    """Invoice totals are whole NT$, rounded half up (四捨五入)."""
+    return value.quantize(ONE, rounding=ROUND_HALF_UP)
+
+def split_tax(total: Decimal, rate: str) -> tuple:
+    """
+    (sales, tax) of a tax-inclusive total for a B2B invoice: sales is the total divided by
+    (1 + rate) rounded half up, tax is the rest, so sales + tax always equals the total.
+    170 at 0.05 -> (162, 8).
+    """
+    sales = round_amount(total / _divisor(rate))
+    return sales, total - sales
+
+def compute_amounts(order: dict) -> dict:
+    """The invoice-level amounts implied by ProductItem, as the strings f0401 expects."""
+    errors, amounts = _check(order)
+    if amounts is None:
+        raise ValueError("；".join(errors))
+    return {field: str(value) for field, value in amounts.items()}
+
+def check_amounts(order: dict) -> List[str]:
+    """Problems with the order's money fields, empty when SalesAmount/TaxAmount/TotalAmount are consistent."""
+    return _check(order)[0]
+
+def check_amounts_batch(orders: Iterable[dict]) -> List[List[str]]:
+    """check_amounts for a whole batch in one pass; the parse caches are shared across orders."""
+    check = _check
+    return [check(order)[0] for order in orders]
+
+def _check(order: dict) -> tuple:
+    """(errors, derived amounts or None when the items themselves are unusable)."""
+    errors = []
+    tax_type = str(order.get("TaxType", ""))
+    rate = str(order.get("TaxRate", "")).strip()
+    sums = {TAXABLE: ZERO, ZERO_RATED: ZERO, TAX_FREE: ZERO}
+    for index, item in enumerate(order.get("ProductItem") or []):
+        quantity = to_decimal(item.get("Quantity"))
+        unit_price = to_decimal(item.get("UnitPrice"))
+        amount = to_decimal(item.get("Amount"))
+        if quantity is None or unit_price is None or amount is None:
+            errors.append(f"ProductItem[{index}] 的 Quantity/UnitPrice/Amount 必須是數字")
+            continue
+        # Amount may carry decimals; it has to equal Quantity x UnitPrice at its own precision
+        expected = quantity * unit_price
+        expected = expected.quantize(amount, rounding=ROUND_HALF_UP) if amount.as_tuple().exponent < 0 else round_amount(expected)
+        if expected != amount:
+            errors.append(f"ProductItem[{index}] 的 Amount 應為 {expected}（Quantity {quantity} x UnitPrice {unit_price}），目前為 {amount}")
+        item_type = str(item.get("TaxType", ""))
+        if item_type not in sums:
+            errors.append(f"ProductItem[{index}] 的 TaxType 必須是 1、2 或 3")
+            continue
+        if tax_type in ITEM_TAX_TYPES and item_type != tax_type:
+            errors.append(f"ProductItem[{index}] 的 TaxType {item_type} 與發票課稅別 {tax_type} 不符")
+        sums[item_type] += amount
+    if not order.get("ProductItem"):
+        errors.append("ProductItem 至少需要一筆")
+    if errors:
+        return errors, None
+    if tax_type == MIXED and sum(1 for value in sums.values() if value) < 2:
+        errors.append("課稅別 9（混合）需要至少兩種不同課稅別的商品")
+    if tax_type not in (TAXABLE, ZERO_RATED, TAX_FREE, SPECIAL_RATE, MIXED):
+        return [f"TaxType 必須是 1、2、3、4 或 9，目前為 {tax_type}"], None
+    if sums[TAXABLE] and to_decimal(rate) is None:
+        return [f"TaxRate 必須是數字，目前為 {rate}"], None
+
+    taxable = round_amount(sums[TAXABLE])
+    if order.get("BuyerIdentifier", NO_BAN) in (NO_BAN, "", None):
+        # B2C: amounts stay tax-inclusive and no tax is shown
+        sales, tax = taxable, ZERO
+    else:
+        sales, tax = split_tax(taxable, rate) if taxable else (ZERO, ZERO)
+    amounts = {
+        "SalesAmount": sales,
+        "FreeTaxSalesAmount": round_amount(sums[TAX_FREE]),
+        "ZeroTaxSalesAmount": round_amount(sums[ZERO_RATED]),
+        "TaxAmount": tax,
+    }
+    amounts["TotalAmount"] = sales + tax + amounts["FreeTaxSalesAmount"] + amounts["ZeroTaxSalesAmount"]
+
+    given = {field: to_decimal(order.get(field)) for field in AMOUNT_FIELDS}
+    if tax_type == SPECIAL_RATE:
+        # 特種稅率 (e.g. 25% for nightclubs) has its own tax base; only check that the totals add up
+        if None in given.values():
+            errors.append("金額欄位必須是數字")
+        elif given["TotalAmount"] != given["SalesAmount"] + given["TaxAmount"] + given["FreeTaxSalesAmount"] + given["ZeroTaxSalesAmount"]:
+            errors.append("TotalAmount 應等於 SalesAmount + TaxAmount + FreeTaxSalesAmount + ZeroTaxSalesAmount")
+        return errors, amounts
+    for field in AMOUNT_FIELDS:
+        if given[field] is None:
+            errors.append(f"{field} 必須是數字，應為 {amounts[field]}")
+        elif given[field] != amounts[field]:
+            errors.append(f"{field} 應為 {amounts[field]}，目前為 {order.get(field)}")
+    return errors, amounts
@@ -1,5 +1,5 @@
 # invoice/api_requests.py
-from pydantic import BaseModel, condecimal, Field
+from pydantic import BaseModel, condecimal, Field, field_validator
 from typing import Optional, List, Annotated, Literal
 
 
@@ -9,6 +9,8 @@ from invoice.utils import (
     TheProductItem,
     InvoiceNumberByPeriod,
 )
+from invoice.ban import is_valid_ban, is_valid_buyer_identifier
+from invoice.constants import CREATE_BATCH_MAX_SIZE, CANCEL_BULK_MAX_SIZE
 
 # SearchTypeGeneral_DataType = Annotated[Literal["true", "false"]]
 
@@ -46,7 +48,18 @@ class CancelInvoiceRequest(BaseModel):
 class CancelMultipleInvoicesRequest(BaseModel):
     cancel_invoice_numbers: List[str] = Field(..., min_items=1, description="要作廢的發票號碼列表")
 
-class CreateInvoiceRequest(BaseModel):
+BUYER_IDENTIFIER_ERROR = "統一編號格式或檢查碼錯誤（無統編請填 0000000000）"
+
+def buyer_identifier_error(value: Optional[str]) -> Optional[str]:
+    # BuyerIdentifier must pass the BAN check digit (invoice/ban.py), except NO_BAN:
+    # "0000000000" (the default) is how B2C invoices without a buyer BAN are sent, and it
+    # is accepted as is even though it is ten digits rather than eight
+    if value is not None and not is_valid_buyer_identifier(value):
+        return BUYER_IDENTIFIER_ERROR
+    return None
+
+class CreateInvoiceBatchItem(BaseModel):
+    """One order of /create/invoices; its BuyerIdentifier is checked per order by the route."""
     OrderId: Optional[str] = Field(default=None, description="訂單編號")
     BuyerIdentifier: Optional[str] = Field(default="0000000000", description="買方統一編號")
     BuyerName: Optional[str] = Field(default="客人", description="買方名稱")
@@ -71,6 +84,15 @@ class CreateInvoiceRequest(BaseModel):
         validate_by_name = True
         arbitrary_types_allowed = True
 
+class CreateInvoiceRequest(CreateInvoiceBatchItem):
+    @field_validator("BuyerIdentifier")
+    @classmethod
+    def check_buyer_identifier(cls, v):
+        error = buyer_identifier_error(v)
+        if error:
+            raise ValueError(error)
+        return v
+
 class InvoiceByPeriodRequest(BaseModel):
     date_select: int = Field(default=1, description="日期條件 1:發票日期 2:建立日期")
     date_start: int = Field(default=20250726, description="開始日期，格式：YYYYMMDD，例如：20240901")
@@ -78,6 +100,11 @@ class InvoiceByPeriodRequest(BaseModel):
     limit: int = Field(default=20, ge=1, le=500, description="每頁顯示資料筆數 20~500，預設 20 筆")
     page: int = Field(default=1, ge=1, description="目前頁數，預設第1頁")
 
+class ReconcileRequest(BaseModel):
+    date_start: int = Field(..., description="開始發票日期，格式：YYYYMMDD")
+    date_end: int = Field(..., description="結束發票日期，格式：YYYYMMDD")
+    full: bool = Field(default=False, description="忽略上次的水位與頁雜湊，重新抓取整段發票列表")
+
 class InvoicePrintDetailsRequest(BaseModel):
     type: Annotated[str, Literal["order", "invoice"]] = Field(..., description="查詢類型 order：訂單編號 invoice：發票號碼，擇一查詢")
     printer_type: int = Field(default=2, description="列印格式 1：發票正本 2：發票補印 3：單印明細(僅限制Xprinter 芯燁通用以後的機型B2C發票可使用)")
@@ -88,7 +115,17 @@ class InvoicePrintDetailsRequest(BaseModel):
 class CompanyBANNumber(BaseModel):
     ban: str = Field(..., description="統一編號，數字8碼 統編基本檢查邏輯請參考 營利事業統一編號檢查碼邏輯修正說明: https://www.fia.gov.tw/singlehtml/3?cntId=c4d9cff38c8642ef8872774ee9987283")
 
+    @field_validator("ban")
+    @classmethod
+    def check_ban(cls, v):
+        if not is_valid_ban(v):
+            raise ValueError("統一編號格式或檢查碼錯誤")
+        return v
+
 QueryInvoicesRequest = List[InvoiceNumberItem]
 CancelInvoicesRequest = List[CancelInvoiceNumber]
+BulkCancelInvoicesRequest = Annotated[List[CancelInvoiceNumber], Field(min_length=1, max_length=CANCEL_BULK_MAX_SIZE)]
 CompanyVATInfoRequest = List[CompanyBANNumber]
+# A bad BAN fails only its own order (see create_invoices_request), not the whole batch
+CreateInvoicesRequest = Annotated[List[CreateInvoiceBatchItem], Field(min_length=1, max_length=CREATE_BATCH_MAX_SIZE)]
 # InvoiceByPeriodRequest = InvoiceNumberByPeriod
\ No newline at end of file
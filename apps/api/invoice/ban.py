@@ -0,0 +1,39 @@
+# invoice/ban.py
+
+from typing import Iterable, List
+
+# 營利事業統一編號檢查碼邏輯: https://www.fia.gov.tw/singlehtml/3?cntId=c4d9cff38c8642ef8872774ee9987283
+# Each digit is multiplied by its weight and the digits of the product are summed.
+# Since 2023 the total only has to be divisible by 5 (previously 10); when the
+# 7th digit is 7 its product (28 -> 10) may be counted as 1 or 0.
+BAN_WEIGHTS = (1, 2, 1, 2, 1, 2, 4, 1)
+BAN_DIVISOR = 5
+BAN_LEGACY_DIVISOR = 10
+NO_BAN = "0000000000"
+
+# Per-position lookup of the digit-sum contribution, indexed by the digit character
+_CONTRIBUTIONS = tuple(
+    {str(d): (d * w) // 10 + (d * w) % 10 for d in range(10)}
+    for w in BAN_WEIGHTS
+)
+
+def is_valid_ban(ban: str, legacy: bool = False) -> bool:
+    """Check an 8-digit 統一編號 against the Ministry of Finance check-digit rule."""
+    if len(ban) != 8 or not ban.isascii() or not ban.isdigit():
+        return False
+    divisor = BAN_LEGACY_DIVISOR if legacy else BAN_DIVISOR
+    c = _CONTRIBUTIONS
+    total = (
+        c[0][ban[0]] + c[1][ban[1]] + c[2][ban[2]] + c[3][ban[3]]
+        + c[4][ban[4]] + c[5][ban[5]] + c[6][ban[6]] + c[7][ban[7]]
+    )
+    if total % divisor == 0:
+        return True
+    return ban[6] == "7" and (total + 1) % divisor == 0
+
+def validate_bans(bans: Iterable[str], legacy: bool = False) -> List[bool]:
+    return [is_valid_ban(ban, legacy) for ban in bans]
+
+def is_valid_buyer_identifier(identifier: str) -> bool:
+    # B2C invoices use ten zeros in place of a BAN
+    return identifier == NO_BAN or is_valid_ban(identifier)
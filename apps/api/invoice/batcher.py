@@ -0,0 +1,98 @@
+# invoice/batcher.py
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, List
+
+class _Batch:
+    def __init__(self):
+        self.numbers = {}   # invoice number -> None, keeps first-seen order without duplicates
+        self.waiters = []   # (invoice numbers, future)
+        self.timer = None
+
+class StatusBatcher:
+    """
+    Micro-batches /json/invoice_status lookups. Numbers asked for within `window` seconds
+    (or until `max_items` distinct numbers) under the same credentials go upstream as
+    one list, and each caller gets back only the rows for its own numbers. When the provider
+    refuses the merged list (one caller's malformed number fails it whole), every caller's
+    numbers are sent again on their own, so the error only reaches the caller that caused it.
+    """
+
+    def __init__(self, send: Callable[[List[dict], str, str], Awaitable[dict]], window: float, max_items: int):
+        self.send = send
+        self.window = window
+        self.max_items = max_items
+        self.requests = 0
+        self.batches = 0
+        self.split_batches = 0
+        self._pending = {}
+        # The event loop only keeps weak references to tasks
+        self._tasks = set()
+
+    async def lookup(self, invoice_numbers: List[str], api_key: str = None, vatid: str = None) -> dict:
+        key = (api_key, vatid)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = _Batch()
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, key, batch)
+        future = asyncio.get_running_loop().create_future()
+        batch.waiters.append((invoice_numbers, future))
+        for number in invoice_numbers:
+            batch.numbers[number] = None
+        self.requests += 1
+        if len(batch.numbers) >= self.max_items:
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key: tuple, batch: _Batch):
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        batch.timer.cancel()
+        self.batches += 1
+        task = asyncio.ensure_future(self._send(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _call(self, numbers, api_key: str = None, vatid: str = None) -> dict:
+        try:
+            return await self.send([{"InvoiceNumber": number} for number in numbers], api_key, vatid)
+        except Exception as e:
+            logging.error(f"Status batch failed: {e}")
+            return {"error": "Request failed", "details": str(e), "status_code": 500}
+
+    async def _send(self, key: tuple, batch: _Batch):
+        api_key, vatid = key
+        response = await self._call(batch.numbers, api_key, vatid)
+        if len(batch.waiters) > 1 and "error" not in response and response.get("code", 0) != 0:
+            # An application error may be about one caller's numbers; transport errors are everyone's
+            self.split_batches += 1
+            waiters = [(numbers, future) for numbers, future in batch.waiters if not future.done()]
+            responses = await asyncio.gather(*(self._call(numbers, api_key, vatid) for numbers, _ in waiters))
+            for (_, future), own in zip(waiters, responses):
+                if not future.done():
+                    future.set_result(own)
+            return
+        for numbers, future in batch.waiters:
+            if not future.done():
+                future.set_result(_scatter(response, numbers, len(batch.waiters)))
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "upstream_calls": self.batches,
+            "split_batches": self.split_batches,
+            "avg_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0,
+            "pending_batches": len(self._pending),
+        }
+
+def _scatter(response: dict, numbers: List[str], waiters: int) -> dict:
+    if waiters == 1 or "error" in response or not isinstance(response.get("data"), list):
+        return response
+    wanted = set(numbers)
+    rows = [
+        row for row in response["data"]
+        if isinstance(row, dict) and (row.get("invoice_number") or row.get("InvoiceNumber")) in wanted
+    ]
+    return {**response, "data": rows}
@@ -0,0 +1,146 @@
+# invoice/breaker.py
+
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+from invoice.constants import (
+    BREAKER_FAILURE_THRESHOLD,
+    BREAKER_RESET_TIMEOUT,
+    BREAKER_LATENCY_WINDOW,
+    BREAKER_TIMEOUT_PERCENTILE,
+    BREAKER_TIMEOUT_MULTIPLIER,
+    BREAKER_TIMEOUT_MIN,
+)
+from invoice.metrics import Counter, Gauge
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Below this many samples the configured timeout is used as is
+MIN_LATENCY_SAMPLES = 20
+
+BREAKER_STATE = Gauge("invoice_upstream_circuit_state", "Circuit breaker state by URI (0 closed, 1 half-open, 2 open).", ("uri",))
+BREAKER_REJECTED = Counter("invoice_upstream_circuit_rejected_total", "Calls failed fast because the circuit was open, by URI.", ("uri",))
+
+class CircuitBreaker:
+    """
+    Breaker for one upstream endpoint. After `failure_threshold` consecutive failures
+    (transport errors, timeouts, 5xx) it opens and calls fail immediately. Once
+    `reset_timeout` has passed a single probe is let through (half-open): success
+    closes the circuit, failure opens it for another `reset_timeout`.
+
+    It also keeps a window of successful call latencies so the read timeout can follow
+    the endpoint's real behaviour instead of a fixed worst case.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = None,
+        reset_timeout: float = None,
+        latency_window: int = None,
+    ):
+        self.name = name
+        self.failure_threshold = BREAKER_FAILURE_THRESHOLD if failure_threshold is None else failure_threshold
+        self.reset_timeout = BREAKER_RESET_TIMEOUT if reset_timeout is None else reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+        self.rejected = 0
+        self.trips = 0
+        self._latencies = deque(maxlen=latency_window or BREAKER_LATENCY_WINDOW)
+        self._since_percentile = 0
+        self._percentile = None
+        self._lock = threading.Lock()
+        self._state_gauge = BREAKER_STATE.labels(name)
+        self._rejected_counter = BREAKER_REJECTED.labels(name)
+
+    def allow(self) -> bool:
+        """Whether a call may go out now; in half-open only the probe gets a True."""
+        if self.state == CLOSED or self.failure_threshold <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+                self.probe_started = now
+                return True
+            # A probe that never reported back (cancelled caller) must not wedge the breaker
+            if self.state == HALF_OPEN and now - self.probe_started >= self.reset_timeout:
+                self.probe_started = now
+                return True
+            self.rejected += 1
+            self._rejected_counter.value += 1
+            return False
+
+    def record_success(self, latency: float):
+        self._latencies.append(latency)
+        self._since_percentile += 1
+        if self.state != CLOSED or self.failures:
+            with self._lock:
+                self.failures = 0
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and 0 < self.failure_threshold <= self.failures):
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                self._set_state(OPEN)
+
+    def _set_state(self, state: str):
+        self.state = state
+        self._state_gauge.value = _STATE_CODES[state]
+
+    def latency_percentile(self) -> Optional[float]:
+        # Sorting the window is cheap but not free; refresh once a tenth of it is new
+        if len(self._latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        if self._percentile is None or self._since_percentile >= max(1, self._latencies.maxlen // 10):
+            ordered = sorted(self._latencies)
+            index = min(len(ordered) - 1, int(len(ordered) * BREAKER_TIMEOUT_PERCENTILE / 100))
+            self._percentile = ordered[index]
+            self._since_percentile = 0
+        return self._percentile
+
+    def read_timeout(self, configured: float) -> float:
+        """Adaptive read timeout, never above the configured one."""
+        percentile = self.latency_percentile()
+        if percentile is None:
+            return configured
+        return min(configured, max(BREAKER_TIMEOUT_MIN, percentile * BREAKER_TIMEOUT_MULTIPLIER))
+
+    def retry_after(self) -> float:
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def status(self) -> dict:
+        percentile = self.latency_percentile()
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "retry_after_seconds": round(self.retry_after(), 3),
+            "latency_samples": len(self._latencies),
+            f"latency_p{BREAKER_TIMEOUT_PERCENTILE:g}_seconds": None if percentile is None else round(percentile, 4),
+        }
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_breaker(uri: str) -> CircuitBreaker:
+    breaker = _breakers.get(uri)
+    if breaker is None:
+        breaker = _breakers.setdefault(uri, CircuitBreaker(uri))
+    return breaker
+
+def breaker_status() -> dict:
+    return {uri: breaker.status() for uri, breaker in _breakers.items()}
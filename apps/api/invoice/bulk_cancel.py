@@ -0,0 +1,329 @@
+# invoice/bulk_cancel.py
+
+import asyncio
+import hmac
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from invoice.cancel import cancel_invoices
+from invoice.search import send_invoice_status
+from invoice.ledger import CANCELLED_INVOICE_TYPE
+from invoice.constants import CANCEL_CHUNK_SIZE, CANCEL_BATCH_CONCURRENCY, CANCEL_SPLIT_CODES
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cancel_jobs (
+    job_id TEXT PRIMARY KEY,
+    vatid TEXT,
+    api_key TEXT,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cancel_items (
+    job_id TEXT NOT NULL,
+    invoice_number TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    error TEXT,
+    status_code INTEGER,
+    PRIMARY KEY (job_id, invoice_number)
+) WITHOUT ROWID;
+"""
+
+# Job states
+RUNNING = "running"
+FINISHED = "finished"
+
+# Invoice states
+PENDING = "pending"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+class CancelJobStore:
+    """
+    Checkpoints of bulk cancellations. Every number of a job is written before the first
+    f0501 call and each finished chunk is recorded in one transaction, so after a crash
+    only the numbers that were not confirmed are sent again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+
+    def create(self, job_id: str, invoice_numbers: List[str], api_key: str = None, vatid: str = None):
+        """Register a job; submitting an existing job again adds any new numbers and reopens it."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                """
+                INSERT INTO cancel_jobs (job_id, vatid, api_key, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (job_id) DO UPDATE SET status = excluded.status, updated_at = excluded.updated_at
+                """,
+                (job_id, vatid, api_key, RUNNING, now, now),
+            )
+            offset = self._conn.execute("SELECT COUNT(*) FROM cancel_items WHERE job_id = ?", (job_id,)).fetchone()[0]
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO cancel_items (job_id, invoice_number, position) VALUES (?, ?, ?)",
+                [(job_id, number, offset + index) for index, number in enumerate(invoice_numbers)],
+            )
+            self._conn.execute("COMMIT")
+
+    def job(self, job_id: str) -> Optional[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute("SELECT * FROM cancel_jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+    def outstanding(self, job_id: str) -> List[str]:
+        """Numbers of the job not yet confirmed as cancelled, failures included: a resume retries them."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT invoice_number FROM cancel_items WHERE job_id = ? AND status != ? ORDER BY position",
+                (job_id, CANCELLED),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def record(self, job_id: str, outcomes: Dict[str, dict]):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "UPDATE cancel_items SET status = ?, error = ?, status_code = ? WHERE job_id = ? AND invoice_number = ?",
+                [
+                    (outcome["status"], outcome.get("error"), outcome.get("status_code"), job_id, number)
+                    for number, outcome in outcomes.items()
+                ],
+            )
+            self._conn.execute("UPDATE cancel_jobs SET updated_at = ? WHERE job_id = ?", (time.time(), job_id))
+            self._conn.execute("COMMIT")
+
+    def finish(self, job_id: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE cancel_jobs SET status = ?, updated_at = ? WHERE job_id = ?", (FINISHED, time.time(), job_id)
+            )
+
+    def results(self, job_id: str) -> Dict[str, dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT invoice_number, status, error, status_code FROM cancel_items WHERE job_id = ? ORDER BY position",
+                (job_id,),
+            ).fetchall()
+        return {row["invoice_number"]: _outcome(row["status"], row["error"], row["status_code"]) for row in rows}
+
+    def running_jobs(self, older_than: float = 0) -> List[sqlite3.Row]:
+        """Unfinished jobs whose last checkpoint is at least older_than seconds old."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT * FROM cancel_jobs WHERE status = ? AND updated_at <= ?", (RUNNING, time.time() - older_than)
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def _outcome(status: str, error: str = None, status_code: int = None) -> dict:
+    if status == FAILED:
+        return {"status": status, "error": error, "status_code": status_code}
+    return {"status": status}
+
+def new_job_id() -> str:
+    return f"CANCEL{int(time.time())}{uuid.uuid4().hex[:8]}"
+
+def summarize(job_id: str, results: Dict[str, dict], status: str = FINISHED) -> dict:
+    counts = {PENDING: 0, CANCELLED: 0, FAILED: 0}
+    for outcome in results.values():
+        counts[outcome["status"]] += 1
+    return {
+        "job_id": job_id,
+        "status": status,
+        "total": len(results),
+        "cancelled": counts[CANCELLED],
+        "failed": counts[FAILED],
+        "pending": counts[PENDING],
+        "results": results,
+    }
+
+async def _send_chunk(invoice_numbers: List[str], api_key: str = None, vatid: str = None) -> dict:
+    try:
+        return await cancel_invoices([{"CancelInvoiceNumber": number} for number in invoice_numbers], api_key, vatid)
+    except Exception as e:
+        logging.error(f"Cancel chunk failed: {e}")
+        return {"error": "Cancel failed", "details": str(e), "status_code": 500}
+
+def _failed_all(invoice_numbers: List[str], response: dict) -> Dict[str, dict]:
+    outcome = _outcome(
+        FAILED,
+        str(response.get("error") or response.get("msg") or "Cancel failed"),
+        response.get("status_code") or response.get("code"),
+    )
+    return {number: dict(outcome) for number in invoice_numbers}
+
+async def _cancel_chunk(invoice_numbers: List[str], api_key: str = None, vatid: str = None, response: dict = None) -> Dict[str, dict]:
+    if response is None:
+        response = await _send_chunk(invoice_numbers, api_key, vatid)
+    if "error" not in response and response.get("code", 0) == 0:
+        return {number: _outcome(CANCELLED) for number in invoice_numbers}
+    if "error" in response or len(invoice_numbers) == 1:
+        # Transport errors say nothing about single numbers, so the whole chunk is left for a retry
+        return _failed_all(invoice_numbers, response)
+    # f0501 rejects the whole package for one bad number; halve it until the culprits are isolated.
+    # The halves go one after the other so a chunk never holds more than its one slot.
+    middle = len(invoice_numbers) // 2
+    first, second = invoice_numbers[:middle], invoice_numbers[middle:]
+    first_response = await _send_chunk(first, api_key, vatid)
+    second_response = await _send_chunk(second, api_key, vatid)
+    code = response.get("code")
+    if code not in CANCEL_SPLIT_CODES and all(
+        "error" not in half and half.get("code", 0) == code for half in (first_response, second_response)
+    ):
+        # Both halves refused like the whole: a bad key, clock skew or quota, not a number, and halving
+        # further would only repeat it. The numbers stay failed and a resume of the job retries them.
+        return _failed_all(invoice_numbers, response)
+    outcomes = await _cancel_chunk(first, api_key, vatid, first_response)
+    outcomes.update(await _cancel_chunk(second, api_key, vatid, second_response))
+    return outcomes
+
+async def _already_cancelled(invoice_numbers: List[str], api_key: str = None, vatid: str = None, chunk_size: int = None) -> List[str]:
+    """Numbers the provider reports as voided, e.g. by a chunk that was in flight when the process died."""
+    found = []
+    chunk_size = chunk_size or CANCEL_CHUNK_SIZE
+    for start in range(0, len(invoice_numbers), chunk_size):
+        chunk = invoice_numbers[start:start + chunk_size]
+        response = await send_invoice_status([{"InvoiceNumber": number} for number in chunk], api_key, vatid)
+        if "error" in response or response.get("code", 0) != 0:
+            continue
+        found.extend(
+            row["invoice_number"] for row in response.get("data") or []
+            if row.get("invoice_type") == CANCELLED_INVOICE_TYPE
+        )
+    return found
+
+async def bulk_cancel(
+    invoice_numbers: List[str],
+    api_key: str = None,
+    vatid: str = None,
+    job_id: str = None,
+    chunk_size: int = None,
+    concurrency: int = None,
+) -> dict:
+    """
+    Void many invoices in provider-sized chunks with bounded parallelism (the tenant's rate
+    budget still applies to every call) and return a per-invoice outcome map. With a job
+    store, a job_id that was seen before resumes where its checkpoint left off.
+    """
+    job_id = job_id or new_job_id()
+    chunk_size = chunk_size or CANCEL_CHUNK_SIZE
+    store = get_cancel_store()
+    invoice_numbers = list(dict.fromkeys(invoice_numbers))
+    if store is not None:
+        await asyncio.to_thread(store.create, job_id, invoice_numbers, api_key, vatid)
+        todo = await asyncio.to_thread(store.outstanding, job_id)
+    else:
+        todo = invoice_numbers
+    results = {number: _outcome(PENDING) for number in todo}
+    semaphore = asyncio.Semaphore(concurrency or CANCEL_BATCH_CONCURRENCY)
+
+    async def run_chunk(chunk: List[str]):
+        async with semaphore:
+            outcomes = await _cancel_chunk(chunk, api_key, vatid)
+        if store is not None:
+            await asyncio.to_thread(store.record, job_id, outcomes)
+        results.update(outcomes)
+
+    await asyncio.gather(*(run_chunk(todo[i:i + chunk_size]) for i in range(0, len(todo), chunk_size)))
+
+    # A refused or timed-out number may be voided after all: by an earlier run, or by a call whose answer was lost
+    failed = [number for number, outcome in results.items() if outcome["status"] == FAILED]
+    if failed:
+        voided = await _already_cancelled(failed, api_key, vatid, chunk_size)
+        outcomes = {number: _outcome(CANCELLED) for number in voided}
+        if store is not None and outcomes:
+            await asyncio.to_thread(store.record, job_id, outcomes)
+        results.update(outcomes)
+
+    if store is not None:
+        await asyncio.to_thread(store.finish, job_id)
+        results = await asyncio.to_thread(store.results, job_id)
+    return summarize(job_id, results)
+
+class CancelJobConflict(Exception):
+    """A job_id that is still running, or that another caller started."""
+
+_store = None
+_running: Dict[str, asyncio.Task] = {}
+
+def init_cancel_store(path: str) -> Optional[CancelJobStore]:
+    global _store
+    if not path:
+        return None
+    _store = CancelJobStore(path)
+    return _store
+
+def get_cancel_store() -> Optional[CancelJobStore]:
+    return _store
+
+def _owns(job: sqlite3.Row, api_key: str = None, vatid: str = None) -> bool:
+    return job["vatid"] == vatid and hmac.compare_digest((job["api_key"] or "").encode(), (api_key or "").encode())
+
+def check_job(job_id: str, api_key: str = None, vatid: str = None):
+    """Raise CancelJobConflict unless job_id is new, or a stopped job of the same VATID and key."""
+    if job_id in _running:
+        raise CancelJobConflict(f"Cancel job {job_id} is still running")
+    if _store is None:
+        return
+    job = _store.job(job_id)
+    if job is not None and not _owns(job, api_key, vatid):
+        raise CancelJobConflict(f"Cancel job {job_id} belongs to another caller")
+
+def start_bulk_cancel(invoice_numbers: List[str], api_key: str = None, vatid: str = None, job_id: str = None) -> asyncio.Task:
+    """Run a job in the background; raises CancelJobConflict if the job is already running."""
+    job_id = job_id or new_job_id()
+    if job_id in _running:
+        # Its outstanding numbers were read at start, so new ones would be silently dropped
+        raise CancelJobConflict(f"Cancel job {job_id} is still running")
+    task = asyncio.create_task(bulk_cancel(invoice_numbers, api_key, vatid, job_id))
+    _running[job_id] = task
+    task.add_done_callback(lambda _: _running.pop(job_id, None))
+    return task
+
+async def resume_bulk_cancels(older_than: float = 0) -> int:
+    """
+    Restart the jobs a previous process left running. With several workers sharing the
+    store, only jobs without a checkpoint for older_than seconds are taken over.
+    """
+    if _store is None:
+        return 0
+    jobs = [job for job in await asyncio.to_thread(_store.running_jobs, older_than) if job["job_id"] not in _running]
+    for job in jobs:
+        logging.info(f"Resuming bulk cancel {job['job_id']}")
+        start_bulk_cancel([], job["api_key"], job["vatid"], job["job_id"])
+    return len(jobs)
+
+def job_status(job_id: str, api_key: str = None, vatid: str = None) -> Optional[dict]:
+    """The job's progress, or None when it does not exist or was started with another VATID or key."""
+    if _store is None:
+        return None
+    job = _store.job(job_id)
+    if job is None or not _owns(job, api_key, vatid):
+        return None
+    status = RUNNING if job_id in _running else job["status"]
+    return summarize(job_id, _store.results(job_id), status)
+
+async def close_cancel_store():
+    global _store
+    tasks = list(_running.values())
+    for task in tasks:
+        task.cancel()
+    # Jobs stay "running" in the store and are resumed on the next start
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if _store is not None:
+        _store.close()
+        _store = None
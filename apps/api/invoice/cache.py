@@ -0,0 +1,140 @@
+# invoice/cache.py
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+class TTLCache:
+    """
+    Size-bounded LRU cache whose entries expire after a TTL (seconds). After share() the
+    entries live in a SharedState instead, so every worker process sees the same ones;
+    keys and values must then be JSON-serializable.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.shared = None
+        self.namespace = None
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def share(self, state, namespace: str):
+        """Keep entries in `state` under `namespace`; what this process held so far moves there."""
+        with self._lock:
+            entries, self._data = list(self._data.items()), OrderedDict()
+            self.shared, self.namespace = state, namespace
+        for key, (expires_at, value) in entries:
+            state.set(namespace, key, value, expires_at)
+
+    def get(self, key, default=MISSING):
+        if self.shared is not None:
+            value = self.shared.get(self.namespace, key)
+            if value is MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            # Wall clock so expiry survives a dump/load across restarts
+            if expires_at < time.time():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        if self.shared is not None:
+            self.shared.set(self.namespace, key, value, expires_at, self.maxsize)
+            return
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        if self.shared is not None:
+            self.shared.delete(self.namespace, key)
+            return
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        if self.shared is not None:
+            self.shared.clear(self.namespace)
+            return
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        if self.shared is not None:
+            return self.shared.size(self.namespace)
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def load(self, path: str) -> int:
+        """Load unexpired entries from a JSON file written by dump(); returns the count."""
+        if not path or not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Cache load failed ({path}): {e}")
+            return 0
+        now = time.time()
+        if self.shared is not None:
+            entries = [(key, expires_at, value) for key, expires_at, value in entries if expires_at > now]
+            for key, expires_at, value in entries:
+                self.shared.set(self.namespace, key, value, expires_at, self.maxsize)
+            return len(entries)
+        with self._lock:
+            for key, expires_at, value in entries:
+                if expires_at > now:
+                    self._data[key] = (expires_at, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return len(self._data)
+
+    def dump(self, path: str):
+        if not path:
+            return
+        now = time.time()
+        if self.shared is not None:
+            entries = [list(entry) for entry in self.shared.items(self.namespace)]
+        else:
+            with self._lock:
+                entries = [[key, expires_at, value] for key, (expires_at, value) in self._data.items() if expires_at > now]
+        # Per process, since every worker dumps the shared entries on its way out
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.error(f"Cache dump failed ({path}): {e}")
@@ -1,13 +1,16 @@
 # invoice/search.py
 
+import asyncio
 import time
 from typing import List
 from urllib.parse import urljoin
-from invoice.utils import create_package, send_request
+from invoice.utils import create_package, send_request_async
 from invoice.utils import InvoiceNumberItem
 from invoice.constants import INVOICE_API_BASE_URL, CANCEL_INVOICE_URI
+from invoice.ledger import get_ledger
+from invoice.search import forget_invoice_status
 
-def cancel_invoices(
+async def cancel_invoices(
     invoice_numbers: List[InvoiceNumberItem] = [],
     api_key: str = None,
     vatid: str = None
@@ -21,4 +24,10 @@ def cancel_invoices(
     url = urljoin(INVOICE_API_BASE_URL, CANCEL_INVOICE_URI)
     package = create_package(timestamp, invoice_numbers, api_key, vatid)
 
-    return send_request(url, package)
+    response = await send_request_async(url, package, vatid)
+    # Even a failed call may have voided some of them
+    forget_invoice_status([item["CancelInvoiceNumber"] for item in invoice_numbers], api_key, vatid)
+    ledger = get_ledger()
+    if ledger is not None and "error" not in response and response.get("code", 0) == 0:
+        await asyncio.to_thread(ledger.record_cancelled, vatid, [item["CancelInvoiceNumber"] for item in invoice_numbers])
+    return response
@@ -0,0 +1,188 @@
+# invoice/client.py
+
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from invoice.constants import (
+    INVOICE_API_POOL_SIZE,
+    INVOICE_API_MAX_CONCURRENCY,
+    INVOICE_API_CONNECT_TIMEOUT,
+    INVOICE_API_READ_TIMEOUT,
+    INVOICE_API_READ_TIMEOUTS,
+    BREAKER_FIXED_TIMEOUT_URIS,
+)
+
+DEFAULT_HEADERS = {
+    "Content-Type": "application/x-www-form-urlencoded",
+    "User-Agent": "invoice-app/1.0",
+    "Connection": "keep-alive",
+}
+
+class FairSemaphore:
+    """
+    Bounds in-flight upstream calls like a semaphore, but when callers have to wait the
+    free slots are handed out round-robin between tenants (one waiter per tenant per turn)
+    instead of first-come-first-served, and a tenant never holds more than its own limit.
+    A store sending hundreds of calls therefore cannot push a quiet store to the back.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_use = 0
+        self._held = {}
+        self._limits = {}
+        self._waiters = OrderedDict()   # tenant -> deque of futures, in round-robin order
+
+    def _can_take(self, tenant) -> bool:
+        limit = self._limits.get(tenant) or self.capacity
+        return self.in_use < self.capacity and self._held.get(tenant, 0) < limit
+
+    def _grant(self, tenant):
+        self.in_use += 1
+        self._held[tenant] = self._held.get(tenant, 0) + 1
+
+    async def acquire(self, tenant=None, limit: int = 0):
+        self._limits[tenant] = limit
+        if tenant not in self._waiters and self._can_take(tenant):
+            self._grant(tenant)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(tenant, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted and cancelled in the same tick: hand the slot on
+                self.release(tenant)
+            raise
+
+    def release(self, tenant=None):
+        self.in_use -= 1
+        held = self._held[tenant] - 1
+        if held:
+            self._held[tenant] = held
+        else:
+            del self._held[tenant]
+        self._wake()
+
+    def _wake(self):
+        while self.in_use < self.capacity and self._waiters:
+            for tenant in self._waiters:
+                if self._can_take(tenant):
+                    break
+            else:
+                return  # everyone waiting is at their own limit
+            queue = self._waiters.pop(tenant)
+            future = queue.popleft()
+            if queue:
+                self._waiters[tenant] = queue   # back of the round
+            if future.done():
+                continue  # cancelled while waiting
+            self._grant(tenant)
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, tenant=None, limit: int = 0):
+        await self.acquire(tenant, limit)
+        try:
+            yield
+        finally:
+            self.release(tenant)
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "in_use": self.in_use,
+            "waiting": sum(len(queue) for queue in self._waiters.values()),
+        }
+
+    def tenant_stats(self, tenant) -> dict:
+        queue = self._waiters.get(tenant)
+        return {"in_flight": self._held.get(tenant, 0), "queued": len(queue) if queue else 0}
+
+_session = None
+_async_client = None
+_semaphore = None
+
+def init_session(pool_size: int = None) -> requests.Session:
+    """Create the shared keep-alive session used for every upstream call."""
+    global _session
+    pool_size = pool_size or INVOICE_API_POOL_SIZE
+
+    session = requests.Session()
+    session.headers.update(DEFAULT_HEADERS)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.verify = False
+
+    if _session is not None:
+        _session.close()
+    _session = session
+    return session
+
+def get_session() -> requests.Session:
+    # Lazily created so scripts that import invoice.* without FastAPI still work
+    if _session is None:
+        return init_session()
+    return _session
+
+def close_session():
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
+
+def init_async_client(pool_size: int = None, max_concurrency: int = None) -> httpx.AsyncClient:
+    """Create the shared async client and the fair semaphore that bounds in-flight upstream calls."""
+    global _async_client, _semaphore
+    pool_size = pool_size or INVOICE_API_POOL_SIZE
+    max_concurrency = max_concurrency or INVOICE_API_MAX_CONCURRENCY
+
+    _async_client = httpx.AsyncClient(
+        headers=DEFAULT_HEADERS,
+        limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=pool_size),
+        timeout=httpx.Timeout(INVOICE_API_READ_TIMEOUT, connect=INVOICE_API_CONNECT_TIMEOUT),
+        verify=False,
+    )
+    _semaphore = FairSemaphore(max_concurrency)
+    return _async_client
+
+def get_async_client() -> httpx.AsyncClient:
+    if _async_client is None:
+        return init_async_client()
+    return _async_client
+
+def get_semaphore() -> FairSemaphore:
+    if _semaphore is None:
+        init_async_client()
+    return _semaphore
+
+async def close_async_client():
+    global _async_client, _semaphore
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+        _semaphore = None
+
+def get_timeout(url: str, breaker=None) -> tuple:
+    """
+    (connect, read) timeout for the endpoint that url points at, tightened by its breaker's latency
+    history unless the endpoint is in BREAKER_FIXED_TIMEOUT_URIS.
+    """
+    read_timeout = INVOICE_API_READ_TIMEOUT
+    for uri, timeout in INVOICE_API_READ_TIMEOUTS.items():
+        if url.endswith(uri):
+            read_timeout = timeout
+            break
+    if breaker is not None and not url.endswith(BREAKER_FIXED_TIMEOUT_URIS):
+        read_timeout = breaker.read_timeout(read_timeout)
+    return (INVOICE_API_CONNECT_TIMEOUT, read_timeout)
+
+def get_async_timeout(url: str, breaker=None) -> httpx.Timeout:
+    connect, read = get_timeout(url, breaker)
+    return httpx.Timeout(read, connect=connect)
@@ -1,10 +1,11 @@
 # invoice/constants.py
 
 import os
+import tempfile
 
 # Define constants
 INVOICE_WEBSITE_BASE_URL = "https://invoice.amego.tw"
-INVOICE_API_BASE_URL = "https://invoice-api.amego.tw"
+INVOICE_API_BASE_URL = os.getenv("INVOICE_API_BASE_URL", "https://invoice-api.amego.tw")
 INVOICE_API_TEST_ACCOUNT = "test@amego.tw"
 INVOICE_API_TEST_PASSWD = "12345678"
 INVOICE_API_TEST_TAX_ID = "12345678"
@@ -28,6 +29,145 @@ INVOICE_API_TAX_ID = os.getenv("INVOICE_API_TAX_ID", INVOICE_API_TEST_TAX_ID)
 INVOICE_API_COMPANY_NAME = os.getenv("INVOICE_API_COMPANY_NAME", INVOICE_API_TEST_COMPANY_NAME)
 INVOICE_API_KEY = os.getenv("INVOICE_API_KEY", INVOICE_API_TEST_KEY)
 
+# Upstream HTTP client (seconds for timeouts)
+INVOICE_API_POOL_SIZE = int(os.getenv("INVOICE_API_POOL_SIZE", "20"))
+INVOICE_API_MAX_CONCURRENCY = int(os.getenv("INVOICE_API_MAX_CONCURRENCY", "100"))
+INVOICE_API_CONNECT_TIMEOUT = float(os.getenv("INVOICE_API_CONNECT_TIMEOUT", "3"))
+INVOICE_API_READ_TIMEOUT = float(os.getenv("INVOICE_API_READ_TIMEOUT", "10"))
+INVOICE_API_READ_TIMEOUTS = {
+    CREATE_INVOICE_URI: float(os.getenv("INVOICE_API_CREATE_TIMEOUT", "15")),
+    CANCEL_INVOICE_URI: float(os.getenv("INVOICE_API_CANCEL_TIMEOUT", "15")),
+    STATUS_INVOICE_URI: float(os.getenv("INVOICE_API_STATUS_TIMEOUT", "5")),
+    SEARCH_INVOICE_LIST_URI: float(os.getenv("INVOICE_API_LIST_TIMEOUT", "20")),
+    GET_INVOICE_PRINT_URI: float(os.getenv("INVOICE_API_PRINT_TIMEOUT", "5")),
+    GET_COMPANY_VAT_INFO_URI: float(os.getenv("INVOICE_API_BAN_TIMEOUT", "5")),
+}
+
+# Per-endpoint circuit breaker; a failure threshold of 0 disables it
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("BREAKER_RESET_TIMEOUT", "30"))
+# Adaptive read timeout: multiplier x the observed latency percentile, between the minimum
+# and the configured per-endpoint timeout above
+BREAKER_LATENCY_WINDOW = int(os.getenv("BREAKER_LATENCY_WINDOW", "200"))
+BREAKER_TIMEOUT_PERCENTILE = float(os.getenv("BREAKER_TIMEOUT_PERCENTILE", "99"))
+BREAKER_TIMEOUT_MULTIPLIER = float(os.getenv("BREAKER_TIMEOUT_MULTIPLIER", "3"))
+BREAKER_TIMEOUT_MIN = float(os.getenv("BREAKER_TIMEOUT_MIN", "1"))
+# Calls that are not safe to repeat keep the configured timeout: cutting a create or cancel the
+# provider still completes makes the till retry, and without an Idempotency-Key that issues it twice
+BREAKER_FIXED_TIMEOUT_URIS = (CREATE_INVOICE_URI, CANCEL_INVOICE_URI)
+# Queue creations in the outbox instead of failing them while /json/f0401 is open. Opt-in: the
+# caller then gets a 202 with the OrderId (see queued_response), which older tills do not understand
+BREAKER_ENQUEUE_CREATE = os.getenv("BREAKER_ENQUEUE_CREATE", "false").lower() == "true"
+
+# Tenants (one per store VATID): a JSON file and/or TENANTS="vatid:key,vatid:key".
+# Rates are upstream calls per second per VATID (0 = unlimited); concurrency is the tenant's
+# share of INVOICE_API_MAX_CONCURRENCY (0 = no cap beyond fair queuing)
+TENANTS_FILE = os.getenv("TENANTS_FILE", "")
+TENANTS = os.getenv("TENANTS", "")
+TENANT_DEFAULT_RATE = float(os.getenv("TENANT_DEFAULT_RATE", "0"))
+TENANT_DEFAULT_BURST = float(os.getenv("TENANT_DEFAULT_BURST", "0"))
+TENANT_DEFAULT_CONCURRENCY = int(os.getenv("TENANT_DEFAULT_CONCURRENCY", "0"))
+TENANT_RATE_MAX_WAIT = float(os.getenv("TENANT_RATE_MAX_WAIT", "5"))
+# Open mode (no tenants configured): budgets kept for at most this many VATIDs, least recently used dropped
+TENANT_UNREGISTERED_MAX = int(os.getenv("TENANT_UNREGISTERED_MAX", "1000"))
+
+# create_package uses its own indent=0 encoder; set to false to fall back to json.dumps
+PACKAGE_FAST_JSON = os.getenv("PACKAGE_FAST_JSON", "true").lower() == "true"
+
+# Micro-batching of /json/invoice_status lookups; a window of 0 sends each lookup on its own
+STATUS_BATCH_WINDOW = float(os.getenv("STATUS_BATCH_WINDOW", "0"))
+STATUS_BATCH_MAX = int(os.getenv("STATUS_BATCH_MAX", "100"))
+# Per-invoice status rows are cached for STATUS_CACHE_TTL seconds (0 = off); our own cancels drop them
+STATUS_CACHE_SIZE = int(os.getenv("STATUS_CACHE_SIZE", "10000"))
+STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_TTL", "0"))
+
+# Batch invoice creation
+CREATE_BATCH_CONCURRENCY = int(os.getenv("CREATE_BATCH_CONCURRENCY", "10"))
+CREATE_BATCH_MAX_SIZE = int(os.getenv("CREATE_BATCH_MAX_SIZE", "1000"))
+
+# Check SalesAmount/TaxAmount/TotalAmount against ProductItem before calling f0401 (invoice/amounts.py):
+# "off", "log" (log the problems and send the order anyway) or "reject" (answer 422 without calling f0401).
+# Off by default: the provider's own rounding rules are authoritative, so try "log" before rejecting
+INVOICE_AMOUNT_CHECK = os.getenv("INVOICE_AMOUNT_CHECK", "off").lower()
+# true/false from before there was a log mode
+INVOICE_AMOUNT_CHECK = {"true": "reject", "false": "off"}.get(INVOICE_AMOUNT_CHECK, INVOICE_AMOUNT_CHECK)
+
+# Idempotent create: an Idempotency-Key header is remembered for IDEMPOTENCY_KEY_TTL seconds. Identical
+# bodies without a key are folded together within IDEMPOTENCY_BODY_WINDOW seconds; that is off by default
+# because two customers buying the same thing at one till send identical bodies too.
+# An empty IDEMPOTENCY_DB keeps the index in memory only
+IDEMPOTENCY_DB = os.getenv("IDEMPOTENCY_DB", "invoice_idempotency.db")
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+IDEMPOTENCY_KEY_TTL = float(os.getenv("IDEMPOTENCY_KEY_TTL", str(24 * 3600)))
+IDEMPOTENCY_BODY_WINDOW = float(os.getenv("IDEMPOTENCY_BODY_WINDOW", "0"))
+
+# Bulk cancellation: f0501 packages of CANCEL_CHUNK_SIZE numbers, CANCEL_BATCH_CONCURRENCY in flight.
+# Progress is checkpointed to CANCEL_JOBS_DB (SQLite); an empty CANCEL_JOBS_DB disables resuming
+CANCEL_CHUNK_SIZE = int(os.getenv("CANCEL_CHUNK_SIZE", "100"))
+CANCEL_BATCH_CONCURRENCY = int(os.getenv("CANCEL_BATCH_CONCURRENCY", "4"))
+CANCEL_BULK_MAX_SIZE = int(os.getenv("CANCEL_BULK_MAX_SIZE", "20000"))
+# f0501 error codes that name a bad invoice number: a refused chunk is always halved until the culprits are
+# isolated. With any other code, a chunk whose two halves are refused the same way is failed as a whole
+CANCEL_SPLIT_CODES = {int(code) for code in os.getenv("CANCEL_SPLIT_CODES", "").split(",") if code.strip()}
+CANCEL_JOBS_DB = os.getenv("CANCEL_JOBS_DB", "invoice_cancel_jobs.db")
+
+# Period export walks /json/invoice_list with the largest page the provider allows
+PERIOD_EXPORT_PAGE_SIZE = int(os.getenv("PERIOD_EXPORT_PAGE_SIZE", "500"))
+
+# Local invoice ledger (SQLite); an empty LEDGER_DB disables it
+LEDGER_DB = os.getenv("LEDGER_DB", "invoice_ledger.db")
+# local-first listings are answered from the ledger only for dates a ledger sync has fully listed
+LEDGER_LOCAL_FIRST = os.getenv("LEDGER_LOCAL_FIRST", "false").lower()
+LEDGER_SYNC_INTERVAL = float(os.getenv("LEDGER_SYNC_INTERVAL", "0"))
+LEDGER_SYNC_DAYS = int(os.getenv("LEDGER_SYNC_DAYS", "1"))
+
+# Durable create queue (SQLite); an empty OUTBOX_DB disables it
+OUTBOX_DB = os.getenv("OUTBOX_DB", "invoice_outbox.db")
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "2"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "300"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_ENQUEUE = os.getenv("OUTBOX_ENQUEUE", "false").lower()
+# Queue a creation that failed upstream instead of answering "1"; the caller gets a 202 (see queued_response)
+OUTBOX_FALLBACK = os.getenv("OUTBOX_FALLBACK", "false").lower() == "true"
+
+# Incremental reconciliation of issued orders against /json/invoice_list (SQLite); an empty RECONCILE_DB disables it.
+# The page size is part of the stored watermarks: changing it makes the next run a full one
+RECONCILE_DB = os.getenv("RECONCILE_DB", "invoice_reconcile.db")
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "500"))
+RECONCILE_MAX_DAYS = int(os.getenv("RECONCILE_MAX_DAYS", "31"))
+
+# /json/invoice_print response cache and post-create prefetch
+PRINT_CACHE_SIZE = int(os.getenv("PRINT_CACHE_SIZE", "2000"))
+PRINT_CACHE_TTL = float(os.getenv("PRINT_CACHE_TTL", str(24 * 3600)))
+PRINT_PREFETCH = os.getenv("PRINT_PREFETCH", "false").lower() == "true"
+PRINT_PREFETCH_PRINTER_TYPE = int(os.getenv("PRINT_PREFETCH_PRINTER_TYPE", "2"))
+PRINT_PREFETCH_INVOICE_TYPE = int(os.getenv("PRINT_PREFETCH_INVOICE_TYPE", "1"))
+# Render ESC/POS locally from the ledger instead of calling /json/invoice_print.
+# Experimental and off by default: the side-by-side QR codes need ESC/POS page mode,
+# which not every printer clone implements; check a test print before enabling it
+LOCAL_PRINT_RENDER = os.getenv("LOCAL_PRINT_RENDER", "false").lower() == "true"
+
+# BAN (統一編號) company-name cache, TTLs in seconds
+BAN_CACHE_SIZE = int(os.getenv("BAN_CACHE_SIZE", "10000"))
+BAN_CACHE_TTL = float(os.getenv("BAN_CACHE_TTL", str(7 * 24 * 3600)))
+BAN_CACHE_NEGATIVE_TTL = float(os.getenv("BAN_CACHE_NEGATIVE_TTL", "3600"))
+BAN_CACHE_FILE = os.getenv("BAN_CACHE_FILE", "")
+
+# Multi-worker mode (WEB_CONCURRENCY=N uvicorn main:app): the caches and tenant rate budgets live in
+# SHARED_STATE_DB, a SQLite file every worker on the host opens (tmpfs by default), and one worker at
+# a time runs the background jobs. Set it explicitly when passing --workers; empty = per-process state.
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+SHARED_STATE_DB = os.getenv(
+    "SHARED_STATE_DB",
+    os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "invoice_shared.db") if WEB_CONCURRENCY > 1 else "",
+)
+# How long a request waits for another worker's lock on SHARED_STATE_DB before going without it
+SHARED_STATE_BUSY_TIMEOUT = float(os.getenv("SHARED_STATE_BUSY_TIMEOUT", "0.05"))
+# Outbox jobs and bulk cancels another worker claimed are taken over after this long without progress
+WORKER_STALE_AFTER = float(os.getenv("WORKER_STALE_AFTER", "120"))
+
 # Define __all__ for module exports
 __all__ = [
     "INVOICE_API_BASE_URL",
@@ -42,6 +182,73 @@ __all__ = [
     "INVOICE_API_PASSWD",
     "INVOICE_API_TAX_ID",
     "INVOICE_API_COMPANY_NAME",
+    "INVOICE_API_POOL_SIZE",
+    "INVOICE_API_MAX_CONCURRENCY",
+    "INVOICE_API_CONNECT_TIMEOUT",
+    "INVOICE_API_READ_TIMEOUT",
+    "INVOICE_API_READ_TIMEOUTS",
+    "BREAKER_FAILURE_THRESHOLD",
+    "BREAKER_RESET_TIMEOUT",
+    "BREAKER_LATENCY_WINDOW",
+    "BREAKER_TIMEOUT_PERCENTILE",
+    "BREAKER_TIMEOUT_MULTIPLIER",
+    "BREAKER_TIMEOUT_MIN",
+    "BREAKER_FIXED_TIMEOUT_URIS",
+    "BREAKER_ENQUEUE_CREATE",
+    "TENANTS_FILE",
+    "TENANTS",
+    "TENANT_DEFAULT_RATE",
+    "TENANT_DEFAULT_BURST",
+    "TENANT_DEFAULT_CONCURRENCY",
+    "TENANT_UNREGISTERED_MAX",
+    "TENANT_RATE_MAX_WAIT",
+    "PACKAGE_FAST_JSON",
+    "STATUS_BATCH_WINDOW",
+    "STATUS_BATCH_MAX",
+    "STATUS_CACHE_SIZE",
+    "STATUS_CACHE_TTL",
+    "CREATE_BATCH_CONCURRENCY",
+    "CREATE_BATCH_MAX_SIZE",
+    "INVOICE_AMOUNT_CHECK",
+    "IDEMPOTENCY_DB",
+    "IDEMPOTENCY_CACHE_SIZE",
+    "IDEMPOTENCY_KEY_TTL",
+    "IDEMPOTENCY_BODY_WINDOW",
+    "CANCEL_CHUNK_SIZE",
+    "CANCEL_BATCH_CONCURRENCY",
+    "CANCEL_BULK_MAX_SIZE",
+    "CANCEL_SPLIT_CODES",
+    "CANCEL_JOBS_DB",
+    "PERIOD_EXPORT_PAGE_SIZE",
+    "LEDGER_DB",
+    "LEDGER_LOCAL_FIRST",
+    "LEDGER_SYNC_INTERVAL",
+    "LEDGER_SYNC_DAYS",
+    "OUTBOX_DB",
+    "OUTBOX_WORKERS",
+    "OUTBOX_MAX_ATTEMPTS",
+    "OUTBOX_BACKOFF_BASE",
+    "OUTBOX_BACKOFF_MAX",
+    "OUTBOX_POLL_INTERVAL",
+    "OUTBOX_ENQUEUE",
+    "OUTBOX_FALLBACK",
+    "RECONCILE_DB",
+    "RECONCILE_PAGE_SIZE",
+    "RECONCILE_MAX_DAYS",
+    "PRINT_CACHE_SIZE",
+    "PRINT_CACHE_TTL",
+    "PRINT_PREFETCH",
+    "PRINT_PREFETCH_PRINTER_TYPE",
+    "PRINT_PREFETCH_INVOICE_TYPE",
+    "LOCAL_PRINT_RENDER",
+    "BAN_CACHE_SIZE",
+    "BAN_CACHE_TTL",
+    "BAN_CACHE_NEGATIVE_TTL",
+    "BAN_CACHE_FILE",
+    "WEB_CONCURRENCY",
+    "SHARED_STATE_DB",
+    "SHARED_STATE_BUSY_TIMEOUT",
+    "WORKER_STALE_AFTER",
 ]
 
 # Conditionally add test constants to __all__ if DEBUG is True
@@ -1,14 +1,51 @@
 # invoice/create.py
 
+import asyncio
 import time
 import uuid
+from typing import List, Optional
 
-from invoice.utils import create_package, send_request
-from invoice.constants import INVOICE_API_BASE_URL, CREATE_INVOICE_URI
+from invoice.utils import create_package, send_request, send_request_async
+from invoice.constants import INVOICE_API_BASE_URL, CREATE_INVOICE_URI, CREATE_BATCH_CONCURRENCY
+from invoice.constants import PRINT_PREFETCH, PRINT_PREFETCH_PRINTER_TYPE, PRINT_PREFETCH_INVOICE_TYPE
+from invoice.ledger import get_ledger
+from invoice.search import get_print_invoice, query_invoice_by_order
 from urllib.parse import urljoin
 
+# Strong references so prefetch tasks are not garbage collected mid-flight
+_prefetch_tasks = set()
+
+def prefetch_print_data(invoice_number: str, api_key: str = None, vatid: str = None):
+    """Warm the print cache in the background so the first /print/invoice is served locally."""
+    data = {
+        "type": "invoice",
+        "printer_type": PRINT_PREFETCH_PRINTER_TYPE,
+        "print_invoice_type": PRINT_PREFETCH_INVOICE_TYPE,
+        "order_id": None,
+        "invoice_number": invoice_number,
+    }
+    task = asyncio.ensure_future(get_print_invoice(data, api_key, vatid))
+    _prefetch_tasks.add(task)
+    task.add_done_callback(_prefetch_tasks.discard)
+
+def new_order_id(timestamp: int = None) -> str:
+    return f"ORDER{timestamp or int(time.time())}{uuid.uuid4().hex[:4]}"
+
+async def find_issued_invoice(order_id: str, api_key: str = None, vatid: str = None) -> Optional[str]:
+    """Invoice number already issued for an OrderId, for retries of a call whose outcome is unknown."""
+    ledger = get_ledger()
+    if ledger is not None:
+        row = await asyncio.to_thread(ledger.find_by_order_id, vatid, order_id)
+        if row is not None:
+            return row["invoice_number"]
+    response = await query_invoice_by_order(order_id, api_key, vatid)
+    data = response.get("data") if "error" not in response and response.get("code", 0) == 0 else None
+    if isinstance(data, dict) and data.get("invoice_number"):
+        return data["invoice_number"]
+    return None
+
 # https://www.einvoice.nat.gov.tw/static/ptl/ein_upload/attachments/1693297176294_0.pdf
-def create_full_invoice(data: dict, api_key: str = None, vatid: str = None):
+async def create_full_invoice(data: dict, api_key: str = None, vatid: str = None, order_id: str = None):
     if api_key is None or vatid is None:
         msg = {
             "error": "缺少必要的標頭：請在請求標頭中包含 'Authorization' 和 'VATID'。",
@@ -17,14 +54,38 @@ def create_full_invoice(data: dict, api_key: str = None, vatid: str = None):
         print(msg)
         # return msg
     timestamp = int(time.time())
-    order_id = f"ORDER{timestamp}{uuid.uuid4().hex[:4]}"
-    # Overwrite the order id in the data
-    data['OrderId'] = order_id
-    
+    # Overwrite the order id in the data; retries pass the original one so the provider sees the same order
+    data['OrderId'] = order_id or new_order_id(timestamp)
+
     url = urljoin(INVOICE_API_BASE_URL, CREATE_INVOICE_URI)
     package = create_package(timestamp, data, api_key, vatid)
 
-    return send_request(url, package)
+    response = await send_request_async(url, package, vatid)
+    if "invoice_number" in response and "error" not in response:
+        ledger = get_ledger()
+        if ledger is not None:
+            await asyncio.to_thread(ledger.record_created, vatid, data, response)
+        if PRINT_PREFETCH:
+            prefetch_print_data(response["invoice_number"], api_key, vatid)
+    return response
+
+async def create_invoices(
+    orders: List[dict],
+    api_key: str = None,
+    vatid: str = None,
+    concurrency: int = None,
+) -> List[dict]:
+    """Create many invoices with bounded parallelism; responses keep the input order."""
+    semaphore = asyncio.Semaphore(concurrency or CREATE_BATCH_CONCURRENCY)
+
+    async def create_one(data: dict):
+        async with semaphore:
+            try:
+                return await create_full_invoice(data, api_key, vatid)
+            except Exception as e:
+                return {"error": "Create failed", "details": str(e), "status_code": 500}
+
+    return await asyncio.gather(*(create_one(data) for data in orders))
 
 def create_invoice_online(
     price,
@@ -0,0 +1,179 @@
+# invoice/escpos.py
+
+import base64
+from datetime import datetime
+from typing import List, Optional
+
+# ESC/POS commands (Xprinter / Epson compatible)
+ESC = b"\x1b"
+GS = b"\x1d"
+INIT = ESC + b"@"
+ALIGN_LEFT = ESC + b"a\x00"
+ALIGN_CENTER = ESC + b"a\x01"
+BOLD_ON = ESC + b"E\x01"
+BOLD_OFF = ESC + b"E\x00"
+SIZE_NORMAL = GS + b"!\x00"
+SIZE_DOUBLE = GS + b"!\x11"
+SIZE_TALL = GS + b"!\x01"
+CUT = GS + b"V\x42\x00"
+LF = b"\n"
+PAGE_MODE = ESC + b"L"
+PAGE_PRINT = b"\x0c"  # FF: print the page and return to standard mode
+
+# Receipt printers in Taiwan take Big5 (cp950) for Chinese text
+TEXT_ENCODING = "cp950"
+LINE_WIDTH = 32  # 58mm paper, in single-width characters
+PAPER_DOTS = 384  # printable width of 58mm paper at 203 dpi
+QR_AREA_HEIGHT = 180  # dots; a version 8 symbol at module size 3 is 147 dots tall
+
+PRINTER_TYPE_ORIGINAL = 1
+PRINTER_TYPE_REPRINT = 2
+PRINTER_TYPE_DETAILS = 3
+
+NO_BAN = "0000000000"
+
+def text(value: str) -> bytes:
+    return value.encode(TEXT_ENCODING, errors="replace")
+
+def line(value: str = "") -> bytes:
+    return text(value) + LF
+
+def display_width(value: str) -> int:
+    # Big5 characters take two columns, ASCII one
+    return len(value.encode(TEXT_ENCODING, errors="replace"))
+
+def two_columns(left: str, right: str, width: int = LINE_WIDTH) -> bytes:
+    gap = max(1, width - display_width(left) - display_width(right))
+    return line(left + " " * gap + right)
+
+def code39(data: str, height: int = 64) -> bytes:
+    """1D barcode, CODE39 (GS k m=69 n d1...dn)."""
+    payload = data.encode("ascii")
+    return (
+        GS + b"h" + bytes([height])   # bar height in dots
+        + GS + b"w\x01"               # narrowest module width, fits 19 chars on 58mm
+        + GS + b"H\x00"               # no human readable text
+        + GS + b"k\x45" + bytes([len(payload)]) + payload
+    )
+
+def qr_code(data: str, module_size: int = 3) -> bytes:
+    """QR code through the GS ( k function 165/167/169/180/181 sequence."""
+    payload = data.encode("utf-8")
+    store_len = len(payload) + 3
+    return (
+        GS + b"(k\x04\x001A2\x00"                            # model 2
+        + GS + b"(k\x03\x001C" + bytes([module_size])         # module size
+        + GS + b"(k\x03\x001E0"                              # error correction L, as the spec requires
+        + GS + b"(k" + bytes([store_len % 256, store_len // 256]) + b"1P0" + payload
+        + GS + b"(k\x03\x001Q0"                              # print
+    )
+
+def print_area(x: int, y: int, width: int, height: int) -> bytes:
+    """ESC W: the page-mode area following data is laid out in, in dots."""
+    return ESC + b"W" + b"".join(value.to_bytes(2, "little") for value in (x, y, width, height))
+
+def qr_codes_side_by_side(left: str, right: str, module_size: int = 3, height: int = QR_AREA_HEIGHT) -> bytes:
+    """
+    The 證明聯's two QR codes next to each other. In standard mode every symbol starts on a
+    new line, so they are laid out on one page: each half of the paper is its own print
+    area, and a symbol is placed with its bottom on the area's baseline.
+    """
+    half = PAPER_DOTS // 2
+    parts = [PAGE_MODE]
+    for x, data in ((0, left), (half, right)):
+        parts += [
+            print_area(x, 0, half, height),
+            ESC + b"$" + (8).to_bytes(2, "little"),            # a little margin from the area's edge
+            GS + b"$" + (height - 1).to_bytes(2, "little"),    # baseline at the bottom of the area
+            qr_code(data, module_size),
+        ]
+    parts.append(PAGE_PRINT)
+    return b"".join(parts)
+
+def invoice_period(issued: datetime) -> str:
+    """e.g. 114年07-08月; invoices are filed in two-month periods starting on odd months."""
+    start = issued.month if issued.month % 2 else issued.month - 1
+    return f"{issued.year - 1911}年{start:02d}-{start + 1:02d}月"
+
+def invoice_barcode(issued: datetime, invoice_number: str, random_number: str) -> str:
+    # 期別(民國年3碼 + 期末月2碼) + 發票字軌號碼10碼 + 隨機碼4碼
+    end_month = issued.month if issued.month % 2 == 0 else issued.month + 1
+    return f"{issued.year - 1911:03d}{end_month:02d}{invoice_number}{random_number}"
+
+def render_details(order: dict) -> List[bytes]:
+    parts = [ALIGN_LEFT, SIZE_NORMAL, line("-" * LINE_WIDTH)]
+    for item in order.get("ProductItem", []):
+        parts.append(line(item["Description"]))
+        parts.append(two_columns(f"  {item['Quantity']} x {item['UnitPrice']}", str(item["Amount"])))
+    parts.append(line("-" * LINE_WIDTH))
+    buyer = order.get("BuyerIdentifier") or NO_BAN
+    if buyer != NO_BAN:
+        parts.append(two_columns("銷售額", str(order.get("SalesAmount", ""))))
+        parts.append(two_columns("稅額", str(order.get("TaxAmount", ""))))
+    parts.append(two_columns("總計", str(order.get("TotalAmount", ""))))
+    if order.get("MainRemark"):
+        parts.append(line(order["MainRemark"]))
+    return parts
+
+def render_invoice(
+    order: dict,
+    issue: dict,
+    seller_name: str,
+    seller_ban: str,
+    printer_type: int = PRINTER_TYPE_REPRINT,
+    print_invoice_type: int = 1,
+) -> Optional[bytes]:
+    """
+    Render an invoice print-out from the f0401 request body (`order`) and its response (`issue`).
+    Experimental (LOCAL_PRINT_RENDER, off by default): tests/test_escpos.py only compares it with
+    snapshots of its own output, not with the provider's print-out, and page mode, which the QR
+    codes need, varies between printer clones.
+    Returns None when the response lacks what the 證明聯 needs (random number and both QR
+    payloads, whose encrypted part only the provider can produce); callers then fall back
+    to /json/invoice_print.
+    """
+    invoice_number = issue.get("invoice_number")
+    buyer = order.get("BuyerIdentifier") or NO_BAN
+    issued = datetime.fromtimestamp(issue["invoice_time"]) if isinstance(issue.get("invoice_time"), int) else None
+    if not invoice_number or issued is None:
+        return None
+
+    # B2B invoices always carry details; print_invoice_type only toggles them for B2C
+    with_details = buyer != NO_BAN or print_invoice_type == 1
+    parts = [INIT]
+
+    if printer_type == PRINTER_TYPE_DETAILS:
+        parts += [ALIGN_CENTER, SIZE_TALL, line("交易明細"), SIZE_NORMAL, line(f"發票號碼 {invoice_number[:2]}-{invoice_number[2:]}")]
+        parts += render_details(order)
+        parts += [LF, LF, CUT]
+        return b"".join(parts)
+
+    random_number = issue.get("random_number")
+    qrcode_left = issue.get("qrcode_left")
+    qrcode_right = issue.get("qrcode_right")
+    if not random_number or not qrcode_left or not qrcode_right:
+        return None
+
+    title = "電子發票證明聯" + ("補印" if printer_type == PRINTER_TYPE_REPRINT else "")
+    parts += [
+        ALIGN_CENTER,
+        SIZE_TALL, BOLD_ON, line(seller_name), BOLD_OFF,
+        SIZE_DOUBLE, line(title),
+        line(invoice_period(issued)),
+        line(f"{invoice_number[:2]}-{invoice_number[2:]}"),
+        SIZE_NORMAL, ALIGN_LEFT,
+        two_columns(issued.strftime("%Y-%m-%d %H:%M:%S"), "格式 25" if buyer != NO_BAN else ""),
+        two_columns(f"隨機碼 {random_number}", f"總計 {order.get('TotalAmount', '')}"),
+        two_columns(f"賣方 {seller_ban}", f"買方 {buyer}" if buyer != NO_BAN else ""),
+        ALIGN_CENTER,
+        code39(issue.get("barcode") or invoice_barcode(issued, invoice_number, random_number)), LF,
+        qr_codes_side_by_side(qrcode_left, qrcode_right), ALIGN_LEFT,
+    ]
+    if with_details:
+        parts += render_details(order)
+    parts += [LF, LF, CUT]
+    return b"".join(parts)
+
+def render_invoice_base64(*args, **kwargs) -> Optional[str]:
+    raw = render_invoice(*args, **kwargs)
+    return base64.b64encode(raw).decode("ascii") if raw is not None else None
@@ -0,0 +1,224 @@
+# invoice/idempotency.py
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from invoice.cache import TTLCache, MISSING
+from invoice.create import create_full_invoice, find_issued_invoice, new_order_id
+from invoice.singleflight import SingleFlight
+from invoice.constants import (
+    INVOICE_API_TAX_ID,
+    IDEMPOTENCY_CACHE_SIZE,
+    IDEMPOTENCY_KEY_TTL,
+    IDEMPOTENCY_BODY_WINDOW,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency (
+    key TEXT PRIMARY KEY,
+    order_id TEXT NOT NULL,
+    fingerprint TEXT,
+    response TEXT,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency (expires_at);
+"""
+
+# Expired rows are deleted every this many reservations
+PURGE_EVERY = 1000
+
+class IdempotencyConflict(Exception):
+    """An Idempotency-Key that was first used for a different request body."""
+
+def request_fingerprint(data: dict) -> str:
+    # Canonical form: the validated model fills defaults, sort_keys removes field order
+    body = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+def idempotency_key(data: dict, vatid: str = None, client_key: str = None) -> tuple:
+    """(key, ttl) for a create request, or (None, 0) when it is not deduplicated."""
+    vatid = vatid or INVOICE_API_TAX_ID
+    if client_key:
+        return f"{vatid}:key:{client_key}", IDEMPOTENCY_KEY_TTL
+    if IDEMPOTENCY_BODY_WINDOW > 0:
+        return f"{vatid}:body:{request_fingerprint(data)}", IDEMPOTENCY_BODY_WINDOW
+    return None, 0
+
+def _check_fingerprint(entry: dict, fingerprint: Optional[str]):
+    # Rows written before fingerprints were stored have none and are not checked
+    if fingerprint and entry.get("fingerprint") and entry["fingerprint"] != fingerprint:
+        raise IdempotencyConflict("Idempotency-Key was already used with a different request body")
+
+class IdempotencyIndex:
+    """
+    Key -> {"order_id", "fingerprint", "response"} for recent create requests, in a bounded LRU
+    in front of SQLite. The OrderId is fixed when a key is first seen, so a retry after a failed
+    or interrupted attempt reuses it and the provider can never issue the order twice. The
+    fingerprint is the hash of the first request's body; a key reused with another body raises
+    IdempotencyConflict instead of replaying an invoice issued for something else.
+    """
+
+    def __init__(self, path: str = None, maxsize: int = None):
+        self.path = path
+        self.memory = TTLCache(maxsize or IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_KEY_TTL)
+        self.flight = SingleFlight("idempotent_create")
+        self.replayed = 0
+        self.recovered = 0
+        self._writes = 0
+        self._conn = None
+        self._lock = threading.Lock()
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            with self._lock:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.executescript(SCHEMA)
+                # Files created before fingerprints were stored
+                columns = {row[1] for row in self._conn.execute("PRAGMA table_info(idempotency)")}
+                if "fingerprint" not in columns:
+                    self._conn.execute("ALTER TABLE idempotency ADD COLUMN fingerprint TEXT")
+            self.purge()
+
+    def lookup(self, key: str) -> Optional[dict]:
+        entry = self.memory.get(key)
+        if entry is not MISSING:
+            return entry
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT order_id, fingerprint, response, expires_at FROM idempotency WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            ).fetchone()
+        if row is None:
+            return None
+        entry = {
+            "order_id": row["order_id"],
+            "fingerprint": row["fingerprint"],
+            "response": json.loads(row["response"]) if row["response"] else None,
+        }
+        self.memory.set(key, entry, row["expires_at"] - time.time())
+        return entry
+
+    def reserve(self, key: str, ttl: float, fingerprint: str = None) -> tuple:
+        """
+        (entry, created): the key's entry, created with a fresh OrderId on first sight and
+        written to disk before any upstream call is made for it.
+        """
+        entry = self.lookup(key)
+        if entry is not None:
+            _check_fingerprint(entry, fingerprint)
+            return entry, False
+        entry = {"order_id": new_order_id(), "fingerprint": fingerprint, "response": None}
+        now = time.time()
+        if self._conn is not None:
+            with self._lock:
+                # Only an expired row is replaced: another worker process may have reserved the key just now
+                inserted = self._conn.execute(
+                    """
+                    INSERT INTO idempotency (key, order_id, fingerprint, response, created_at, expires_at) VALUES (?, ?, ?, NULL, ?, ?)
+                    ON CONFLICT (key) DO UPDATE SET order_id = excluded.order_id, fingerprint = excluded.fingerprint,
+                        response = NULL, created_at = excluded.created_at, expires_at = excluded.expires_at
+                    WHERE idempotency.expires_at <= excluded.created_at
+                    """,
+                    (key, entry["order_id"], fingerprint, now, now + ttl),
+                ).rowcount
+            if not inserted:
+                self.memory.delete(key)
+                existing = self.lookup(key)
+                if existing is not None:
+                    _check_fingerprint(existing, fingerprint)
+                    return existing, False
+            self._writes += 1
+            if self._writes % PURGE_EVERY == 0:
+                self.purge()
+        self.memory.set(key, entry, ttl)
+        return entry, True
+
+    def complete(self, key: str, entry: dict, response: dict, ttl: float):
+        entry = {"order_id": entry["order_id"], "fingerprint": entry.get("fingerprint"), "response": response}
+        if self._conn is not None:
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE idempotency SET response = ? WHERE key = ?",
+                    (json.dumps(response, ensure_ascii=False, default=str), key),
+                )
+        self.memory.set(key, entry, ttl)
+
+    def purge(self) -> int:
+        if self._conn is None:
+            return 0
+        with self._lock:
+            return self._conn.execute("DELETE FROM idempotency WHERE expires_at <= ?", (time.time(),)).rowcount
+
+    def stats(self) -> dict:
+        return {
+            "replayed": self.replayed,
+            "recovered": self.recovered,
+            "memory": self.memory.stats(),
+            "inflight": self.flight.stats(),
+        }
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+            self._conn = None
+
+    def replay(self, entry: dict) -> dict:
+        """The stored answer of a key that was already answered."""
+        self.replayed += 1
+        return dict(entry["response"], idempotent_replay=True)
+
+    async def create(self, key: str, ttl: float, data: dict, api_key: str = None, vatid: str = None) -> dict:
+        """
+        create_full_invoice at most once per key; duplicates arriving meanwhile wait for the first.
+        Raises IdempotencyConflict when the key was first used with a different body.
+        """
+        fingerprint = request_fingerprint(data)
+        entry = await asyncio.to_thread(self.lookup, key)
+        if entry is not None:
+            _check_fingerprint(entry, fingerprint)
+            if entry["response"] is not None:
+                return self.replay(entry)
+        # The flight is keyed by key and body, so a conflicting request never gets the first one's answer
+        return await self.flight.do((key, fingerprint), lambda: self._create(key, ttl, data, fingerprint, api_key, vatid))
+
+    async def _create(self, key: str, ttl: float, data: dict, fingerprint: str, api_key: str = None, vatid: str = None) -> dict:
+        entry, created = await asyncio.to_thread(self.reserve, key, ttl, fingerprint)
+        if entry["response"] is not None:
+            return self.replay(entry)
+        if not created:
+            # An earlier attempt failed or was cut off (a crash, a timeout); it may have been issued anyway
+            invoice_number = await find_issued_invoice(entry["order_id"], api_key, vatid)
+            if invoice_number:
+                self.recovered += 1
+                response = {"invoice_number": invoice_number}
+                await asyncio.to_thread(self.complete, key, entry, response, ttl)
+                return dict(response, idempotent_replay=True)
+        response = await create_full_invoice(data, api_key, vatid, order_id=entry["order_id"])
+        if "invoice_number" in response and "error" not in response:
+            await asyncio.to_thread(self.complete, key, entry, response, ttl)
+        return response
+
+_index = None
+
+def init_idempotency(path: str = None) -> IdempotencyIndex:
+    global _index
+    _index = IdempotencyIndex(path or None)
+    return _index
+
+def get_idempotency() -> Optional[IdempotencyIndex]:
+    return _index
+
+def close_idempotency():
+    global _index
+    if _index is not None:
+        _index.close()
+        _index = None
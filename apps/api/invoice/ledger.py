@@ -0,0 +1,305 @@
+# invoice/ledger.py
+
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+
+from invoice.constants import INVOICE_API_TAX_ID
+
+# Columns mirror the /json/invoice_list rows so local answers look like upstream ones
+LIST_COLUMNS = (
+    "invoice_number",
+    "invoice_date",
+    "invoice_time",
+    "buyer_identifier",
+    "total_amount",
+    "invoice_type",
+    "invoice_status",
+    "carrier_id1",
+    "order_id",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    vatid TEXT NOT NULL,
+    invoice_number TEXT NOT NULL,
+    order_id TEXT,
+    invoice_date INTEGER,
+    invoice_time TEXT,
+    create_date INTEGER,
+    buyer_identifier TEXT,
+    total_amount TEXT,
+    invoice_type TEXT,
+    invoice_status TEXT,
+    carrier_id1 TEXT,
+    cancelled INTEGER NOT NULL DEFAULT 0,
+    source TEXT NOT NULL,
+    raw TEXT,
+    issue_request TEXT,
+    issue_response TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (vatid, invoice_number)
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_order ON invoices (vatid, order_id);
+CREATE INDEX IF NOT EXISTS idx_invoices_date ON invoices (vatid, invoice_date);
+CREATE INDEX IF NOT EXISTS idx_invoices_create_date ON invoices (vatid, create_date);
+CREATE INDEX IF NOT EXISTS idx_invoices_buyer ON invoices (vatid, buyer_identifier);
+CREATE TABLE IF NOT EXISTS synced_days (
+    vatid TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (vatid, day)
+) WITHOUT ROWID;
+"""
+
+CREATED_INVOICE_TYPE = "C0401"
+CANCELLED_INVOICE_TYPE = "C0501"
+
+class InvoiceLedger:
+    """Embedded SQLite record of every invoice this API created, cancelled or synced."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            # Ledgers created before the issue_* columns existed
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(invoices)")}
+            for column in ("issue_request", "issue_response"):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE invoices ADD COLUMN {column} TEXT")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def record_created(self, vatid: str, data: dict, response: dict):
+        """Store an invoice returned by /json/f0401 together with the request body that created it."""
+        invoice_time = response.get("invoice_time")
+        issued = datetime.fromtimestamp(invoice_time) if isinstance(invoice_time, int) else datetime.now()
+        row = {
+            "invoice_number": response["invoice_number"],
+            "order_id": data.get("OrderId"),
+            "invoice_date": int(issued.strftime("%Y%m%d")),
+            "invoice_time": issued.strftime("%H:%M:%S"),
+            "create_date": int(datetime.now().strftime("%Y%m%d")),
+            "buyer_identifier": data.get("BuyerIdentifier"),
+            "total_amount": str(data.get("TotalAmount")),
+            "invoice_type": CREATED_INVOICE_TYPE,
+            "invoice_status": "",
+            "carrier_id1": data.get("CarrierId1", ""),
+            "cancelled": 0,
+        }
+        self._upsert(vatid, [row], "create", [json.dumps(data, ensure_ascii=False)])
+        # Request and response are kept verbatim so the invoice can be re-rendered locally
+        with self._lock:
+            self._conn.execute(
+                "UPDATE invoices SET issue_request = ?, issue_response = ? WHERE vatid = ? AND invoice_number = ?",
+                (json.dumps(data, ensure_ascii=False), json.dumps(response, ensure_ascii=False, default=str),
+                 vatid or INVOICE_API_TAX_ID, response["invoice_number"]),
+            )
+
+    def record_cancelled(self, vatid: str, invoice_numbers: Iterable[str]):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE invoices SET cancelled = 1, invoice_type = ?, updated_at = ? WHERE vatid = ? AND invoice_number = ?",
+                [(CANCELLED_INVOICE_TYPE, now, vatid or INVOICE_API_TAX_ID, number) for number in invoice_numbers],
+            )
+
+    def record_listing(self, vatid: str, items: List[dict]):
+        """Upsert rows from a /json/invoice_list page; upstream is authoritative for the listed fields."""
+        rows = []
+        for item in items:
+            rows.append({
+                "invoice_number": item["invoice_number"],
+                "order_id": item.get("order_id"),
+                "invoice_date": _as_int(item.get("invoice_date")),
+                "invoice_time": item.get("invoice_time"),
+                "create_date": _as_int(item.get("create_date")),
+                "buyer_identifier": item.get("buyer_identifier"),
+                "total_amount": None if item.get("total_amount") is None else str(item["total_amount"]),
+                "invoice_type": item.get("invoice_type"),
+                "invoice_status": None if item.get("invoice_status") is None else str(item["invoice_status"]),
+                "carrier_id1": item.get("carrier_id1", ""),
+                "cancelled": 1 if item.get("invoice_type") == CANCELLED_INVOICE_TYPE else 0,
+            })
+        self._upsert(vatid, rows, "sync", [json.dumps(item, ensure_ascii=False) for item in items])
+
+    def _upsert(self, vatid: str, rows: List[dict], source: str, raws: List[str]):
+        now = time.time()
+        vatid = vatid or INVOICE_API_TAX_ID
+        params = [
+            (
+                vatid, row["invoice_number"], row["order_id"], row["invoice_date"], row["invoice_time"],
+                row["create_date"], row["buyer_identifier"], row["total_amount"], row["invoice_type"],
+                row["invoice_status"], row["carrier_id1"], row["cancelled"], source, raw, now,
+            )
+            for row, raw in zip(rows, raws)
+        ]
+        # COALESCE keeps fields a later listing does not carry (order_id, create_date)
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                """
+                INSERT INTO invoices (
+                    vatid, invoice_number, order_id, invoice_date, invoice_time, create_date,
+                    buyer_identifier, total_amount, invoice_type, invoice_status, carrier_id1,
+                    cancelled, source, raw, updated_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (vatid, invoice_number) DO UPDATE SET
+                    order_id = COALESCE(excluded.order_id, order_id),
+                    invoice_date = COALESCE(excluded.invoice_date, invoice_date),
+                    invoice_time = COALESCE(excluded.invoice_time, invoice_time),
+                    create_date = COALESCE(excluded.create_date, create_date),
+                    buyer_identifier = COALESCE(excluded.buyer_identifier, buyer_identifier),
+                    total_amount = COALESCE(excluded.total_amount, total_amount),
+                    invoice_type = COALESCE(excluded.invoice_type, invoice_type),
+                    invoice_status = COALESCE(excluded.invoice_status, invoice_status),
+                    carrier_id1 = COALESCE(excluded.carrier_id1, carrier_id1),
+                    cancelled = MAX(excluded.cancelled, cancelled),
+                    source = excluded.source,
+                    raw = excluded.raw,
+                    updated_at = excluded.updated_at
+                """,
+                params,
+            )
+            self._conn.execute("COMMIT")
+
+    def find_by_invoice_numbers(self, vatid: str, invoice_numbers: List[str]) -> List[dict]:
+        placeholders = ",".join("?" * len(invoice_numbers))
+        return self._query(
+            f"WHERE vatid = ? AND invoice_number IN ({placeholders})",
+            [vatid or INVOICE_API_TAX_ID, *invoice_numbers],
+        )
+
+    def find_by_order_id(self, vatid: str, order_id: str) -> Optional[dict]:
+        rows = self._query("WHERE vatid = ? AND order_id = ?", [vatid or INVOICE_API_TAX_ID, order_id])
+        return rows[0] if rows else None
+
+    def get_issue(self, vatid: str, invoice_number: str = None, order_id: str = None) -> Optional[tuple]:
+        """(f0401 request body, f0401 response) for an invoice this API created, else None."""
+        column, value = ("order_id", order_id) if order_id else ("invoice_number", invoice_number)
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT issue_request, issue_response, cancelled FROM invoices WHERE vatid = ? AND {column} = ?",
+                (vatid or INVOICE_API_TAX_ID, value),
+            ).fetchone()
+        if row is None or row["issue_request"] is None or row["cancelled"]:
+            return None
+        return json.loads(row["issue_request"]), json.loads(row["issue_response"])
+
+    def find_issued(self, vatid: str, invoice_date: int) -> List[dict]:
+        """Invoices this API created on a day, with the amounts as they were sent to f0401."""
+        with self._lock:
+            cursor = self._conn.execute(
+                """
+                SELECT invoice_number, order_id, cancelled, json_extract(issue_request, '$.TotalAmount') AS total_amount
+                FROM invoices WHERE vatid = ? AND invoice_date = ? AND issue_request IS NOT NULL
+                """,
+                (vatid or INVOICE_API_TAX_ID, invoice_date),
+            )
+            return [dict(row) for row in cursor.fetchall()]
+
+    def mark_synced(self, vatid: str, days: Iterable[int], synced_at: float):
+        """Record that every invoice dated on `days` was listed by a sync that started at synced_at."""
+        with self._lock:
+            self._conn.executemany(
+                """
+                INSERT INTO synced_days (vatid, day, synced_at) VALUES (?, ?, ?)
+                ON CONFLICT (vatid, day) DO UPDATE SET synced_at = MAX(synced_at, excluded.synced_at)
+                """,
+                [(vatid or INVOICE_API_TAX_ID, day, synced_at) for day in days],
+            )
+
+    def covers(self, vatid: str, date_start: int, date_end: int, max_age: float = 0) -> bool:
+        """
+        True when the ledger holds the complete listing of every invoice date in the range:
+        each day was synced after it ended, or, for a day still running, less than max_age ago.
+        Anything else (days before the ledger existed, invoices from another node) is unknown.
+        """
+        try:
+            days = _day_range(date_start, date_end)
+        except ValueError:
+            return False
+        if not days or len(days) > 366:
+            return False
+        with self._lock:
+            synced = dict(self._conn.execute(
+                "SELECT day, synced_at FROM synced_days WHERE vatid = ? AND day BETWEEN ? AND ?",
+                (vatid or INVOICE_API_TAX_ID, days[0], days[-1]),
+            ).fetchall())
+        now = time.time()
+        for day in days:
+            synced_at = synced.get(day)
+            if synced_at is None:
+                return False
+            day_end = (datetime.strptime(str(day), "%Y%m%d") + timedelta(days=1)).timestamp()
+            if synced_at < day_end and not (max_age > 0 and synced_at >= now - max_age):
+                return False
+        return True
+
+    def synced_since(self, vatid: str, days: Iterable[int], since: float) -> set:
+        """The days among `days` that a sync started at or after `since` listed in full."""
+        days = list(days)
+        if not days:
+            return set()
+        placeholders = ",".join("?" * len(days))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT day FROM synced_days WHERE vatid = ? AND day IN ({placeholders}) AND synced_at >= ?",
+                (vatid or INVOICE_API_TAX_ID, *days, since),
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def find_by_buyer(self, vatid: str, buyer_identifier: str) -> List[dict]:
+        return self._query("WHERE vatid = ? AND buyer_identifier = ? ORDER BY invoice_date, invoice_time", [vatid or INVOICE_API_TAX_ID, buyer_identifier])
+
+    def find_by_period(self, vatid: str, date_select: int, date_start: int, date_end: int, limit: int, page: int) -> List[dict]:
+        # date_select 1: 發票日期 2: 建立日期, same as /json/invoice_list
+        column = "create_date" if date_select == 2 else "invoice_date"
+        return self._query(
+            f"WHERE vatid = ? AND {column} BETWEEN ? AND ? ORDER BY {column}, invoice_time, invoice_number LIMIT ? OFFSET ?",
+            [vatid or INVOICE_API_TAX_ID, date_start, date_end, limit, (page - 1) * limit],
+        )
+
+    def _query(self, where: str, params: list) -> List[dict]:
+        with self._lock:
+            cursor = self._conn.execute(f"SELECT {', '.join(LIST_COLUMNS)}, cancelled FROM invoices {where}", params)
+            return [dict(row) for row in cursor.fetchall()]
+
+def _day_range(date_start: int, date_end: int) -> List[int]:
+    start = datetime.strptime(str(date_start), "%Y%m%d")
+    end = datetime.strptime(str(date_end), "%Y%m%d")
+    return [int((start + timedelta(days=offset)).strftime("%Y%m%d")) for offset in range((end - start).days + 1)]
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+_ledger = None
+
+def init_ledger(path: str) -> Optional[InvoiceLedger]:
+    global _ledger
+    if not path:
+        return None
+    _ledger = InvoiceLedger(path)
+    return _ledger
+
+def get_ledger() -> Optional[InvoiceLedger]:
+    return _ledger
+
+def close_ledger():
+    global _ledger
+    if _ledger is not None:
+        _ledger.close()
+        _ledger = None
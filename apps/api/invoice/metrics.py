@@ -0,0 +1,246 @@
+# invoice/metrics.py
+
+import functools
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, List, Sequence, Tuple
+from urllib.parse import urlsplit
+
+from fastapi.routing import APIRoute
+
+# Prometheus text exposition format, version 0.0.4
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds. Request/upstream latencies span ~1 ms to tens of seconds,
+# the in-process stages (parse, packaging, shaping) are in the microsecond range.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+STAGE_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+_registry: List["_Metric"] = []
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    """
+    A metric family. Children (one per label combination) are created on first use and
+    cached, so hot paths look a child up once and then only touch plain attributes.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._default = self._children[()] = self._new_child()
+        _registry.append(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def remove(self, *values: str):
+        self._children.pop(values, None)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default.value += amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default.value += amount
+
+    def dec(self, amount: float = 1):
+        self._default.value -= amount
+
+    def set(self, value: float):
+        self._default.value = value
+
+class _HistogramValue:
+    __slots__ = ("upper", "counts", "sum")
+
+    def __init__(self, upper: Tuple[float, ...]):
+        self.upper = upper
+        # One slot per bucket plus the +Inf overflow; cumulated only when rendering
+        self.counts = [0] * (len(upper) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.upper, value)] += 1
+        self.sum += value
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.upper = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.upper)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def _render_child(self, values, child) -> List[str]:
+        lines = []
+        cumulative = 0
+        for upper, count in zip(self.upper + (float("inf"),), list(child.counts)):
+            cumulative += count
+            le = f'le="{_format_value(float(upper))}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# --- API metrics -------------------------------------------------------------
+
+HTTP_REQUESTS = Counter("invoice_http_requests_total", "Requests handled, by route and response status.", ("route", "status"))
+HTTP_LATENCY = Histogram("invoice_http_request_seconds", "End-to-end request latency by route.", ("route",))
+HTTP_IN_FLIGHT = Gauge("invoice_http_requests_in_flight", "Requests currently being handled.")
+STAGE_LATENCY = Histogram(
+    "invoice_stage_seconds",
+    "Per-request stage latency: parse (headers and pydantic body validation), handler, shape (formatting and serializing the answer).",
+    ("route", "stage"),
+    buckets=STAGE_BUCKETS + LATENCY_BUCKETS[3:],
+)
+PACKAGE_LATENCY = Histogram("invoice_package_seconds", "Time spent in create_package(s): JSON encoding, signing, URL encoding.", buckets=STAGE_BUCKETS)
+UPSTREAM_LATENCY = Histogram("invoice_upstream_request_seconds", "Invoice provider call latency by URI.", ("uri",))
+UPSTREAM_ERRORS = Counter("invoice_upstream_errors_total", "Failed invoice provider calls by URI and HTTP status (or error kind).", ("uri", "status"))
+UPSTREAM_IN_FLIGHT = Gauge("invoice_upstream_requests_in_flight", "Invoice provider calls currently on the wire, by URI.", ("uri",))
+
+@functools.lru_cache(maxsize=64)
+def upstream_uri(url: str) -> str:
+    return urlsplit(url).path or "/"
+
+# [request start, handler start, shaping start, handler end] for the request running in this
+# context; a mutable list so the endpoint and its wrapper can fill it in for the middleware
+_request_times: ContextVar[list] = ContextVar("invoice_request_times", default=None)
+
+def timed_endpoint(endpoint):
+    """Wrap an async route endpoint so the middleware can split parse/handler/shape time."""
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        times = _request_times.get()
+        if times is not None:
+            times[1] = time.perf_counter()
+        try:
+            return await endpoint(*args, **kwargs)
+        finally:
+            if times is not None:
+                times[3] = time.perf_counter()
+    return wrapper
+
+def mark_shaping():
+    """Called by an endpoint once the upstream work is done and it starts formatting its answer."""
+    times = _request_times.get()
+    if times is not None:
+        times[2] = time.perf_counter()
+
+class TimedRoute(APIRoute):
+    """Route class for routers whose endpoints should report stage timings."""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, timed_endpoint(endpoint), **kwargs)
+
+class MetricsMiddleware:
+    """Pure ASGI middleware (no BaseHTTPMiddleware task hop) recording per-route request metrics."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        perf_counter = time.perf_counter
+        times = [perf_counter(), 0.0, 0.0, 0.0]
+        token = _request_times.set(times)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                route = scope.get("route")
+                if times[3]:
+                    # Requests rejected before the endpoint ran (422, 404) have no stages
+                    path = route.path if route is not None else "unmatched"
+                    shaping = times[2] or times[3]
+                    STAGE_LATENCY.labels(path, "parse").observe(times[1] - times[0])
+                    STAGE_LATENCY.labels(path, "handler").observe(shaping - times[1])
+                    STAGE_LATENCY.labels(path, "shape").observe(perf_counter() - shaping)
+            await send(message)
+
+        HTTP_IN_FLIGHT._default.value += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT._default.value -= 1
+            _request_times.reset(token)
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            HTTP_LATENCY.labels(path).observe(perf_counter() - times[0])
+            HTTP_REQUESTS.labels(path, str(status[0])).inc()
@@ -0,0 +1,258 @@
+# invoice/outbox.py
+
+import asyncio
+import hmac
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from invoice.create import create_full_invoice, new_order_id, find_issued_invoice
+from invoice.constants import (
+    OUTBOX_WORKERS,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_BACKOFF_BASE,
+    OUTBOX_BACKOFF_MAX,
+    OUTBOX_POLL_INTERVAL,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id TEXT NOT NULL UNIQUE,
+    vatid TEXT,
+    api_key TEXT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    invoice_number TEXT,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at);
+"""
+
+PENDING = "pending"
+INFLIGHT = "inflight"
+DONE = "done"
+FAILED = "failed"
+
+# Window used for the reported drain rate (seconds)
+DRAIN_RATE_WINDOW = 60
+
+class InvoiceOutbox:
+    """
+    Durable queue of invoice creations. A job is committed to SQLite before the till
+    gets its answer, and workers drain it with retries and exponential backoff.
+    OrderId is fixed at enqueue time, so retries of a job never create a second invoice.
+    """
+
+    def __init__(self, path: str, exclusive: bool = True):
+        self.path = path
+        # False when other worker processes drain the same file; their in-flight jobs are not ours to reset
+        self.exclusive = exclusive
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._loop = None
+        self._workers = []
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=FULL")
+            self._conn.executescript(SCHEMA)
+        if exclusive:
+            # Jobs left in flight by a crash are retried; the fixed OrderId keeps that safe
+            self.recover()
+
+    def enqueue(self, data: dict, api_key: str = None, vatid: str = None, order_id: str = None) -> str:
+        """Persist an order and return its OrderId; enqueuing the same OrderId twice is a no-op."""
+        order_id = order_id or data.get("OrderId") or new_order_id()
+        data = dict(data, OrderId=order_id)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO outbox (order_id, vatid, api_key, payload, status, next_attempt_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (order_id) DO NOTHING
+                """,
+                (order_id, vatid, api_key, json.dumps(data, ensure_ascii=False), PENDING, now, now, now),
+            )
+        if self._wakeup is not None:
+            # enqueue runs in a worker thread (asyncio.to_thread); asyncio.Event is only safe on its loop
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return order_id
+
+    def get(self, order_id: str, api_key: str = None, vatid: str = None) -> Optional[dict]:
+        """The job queued under this OrderId, or None if there is none for this VATID and key."""
+        with self._lock:
+            row = self._conn.execute(
+                """
+                SELECT order_id, vatid, api_key, status, attempts, invoice_number, last_error, created_at, updated_at
+                FROM outbox WHERE order_id = ?
+                """,
+                (order_id,),
+            ).fetchone()
+        if row is None or row["vatid"] != vatid or not hmac.compare_digest((row["api_key"] or "").encode(), (api_key or "").encode()):
+            return None
+        job = dict(row)
+        del job["vatid"], job["api_key"]
+        return job
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+            oldest = self._conn.execute(
+                "SELECT MIN(created_at) FROM outbox WHERE status IN (?, ?)", (PENDING, INFLIGHT)
+            ).fetchone()[0]
+            drained = self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = ? AND updated_at >= ?", (DONE, now - DRAIN_RATE_WINDOW)
+            ).fetchone()[0]
+        return {
+            "depth": counts.get(PENDING, 0) + counts.get(INFLIGHT, 0),
+            "pending": counts.get(PENDING, 0),
+            "inflight": counts.get(INFLIGHT, 0),
+            "done": counts.get(DONE, 0),
+            "failed": counts.get(FAILED, 0),
+            "oldest_age_seconds": round(now - oldest, 3) if oldest else 0.0,
+            "drain_rate_per_second": round(drained / DRAIN_RATE_WINDOW, 3),
+            "workers": len(self._workers),
+        }
+
+    def recover(self, older_than: float = 0) -> int:
+        """Put in-flight jobs untouched for older_than seconds back in the queue."""
+        with self._lock:
+            return self._conn.execute(
+                "UPDATE outbox SET status = ? WHERE status = ? AND updated_at <= ?",
+                (PENDING, INFLIGHT, time.time() - older_than),
+            ).rowcount
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        now = time.time()
+        with self._lock:
+            return self._conn.execute(
+                """
+                UPDATE outbox SET status = ?, attempts = attempts + 1, updated_at = ?
+                WHERE id = (
+                    SELECT id FROM outbox WHERE status = ? AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at, id LIMIT 1
+                )
+                RETURNING id, order_id, vatid, api_key, payload, attempts
+                """,
+                (INFLIGHT, now, PENDING, now),
+            ).fetchone()
+
+    def _finish(self, job_id: int, invoice_number: str):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, invoice_number = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+                (DONE, invoice_number, time.time(), job_id),
+            )
+
+    def _retry_later(self, job_id: int, attempts: int, error: str):
+        now = time.time()
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            status, next_attempt_at = FAILED, now
+        else:
+            # Exponential backoff, jittered between half and the full delay
+            delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)))
+            status, next_attempt_at = PENDING, now + random.uniform(delay / 2, delay)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                (status, next_attempt_at, error, now, job_id),
+            )
+
+    def _defer(self, job_id: int, delay: float, error: str):
+        """Reschedule without spending an attempt; used while the provider's circuit is open."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = attempts - 1, next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                (PENDING, now + delay, error, now, job_id),
+            )
+
+    def _next_due_in(self) -> Optional[float]:
+        with self._lock:
+            due = self._conn.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = ?", (PENDING,)
+            ).fetchone()[0]
+        return None if due is None else max(0.0, due - time.time())
+
+    async def _process(self, job):
+        if job["attempts"] > 1:
+            # An earlier attempt may have reached the provider after all
+            invoice_number = await find_issued_invoice(job["order_id"], job["api_key"], job["vatid"])
+            if invoice_number:
+                await asyncio.to_thread(self._finish, job["id"], invoice_number)
+                return
+        data = json.loads(job["payload"])
+        response = await create_full_invoice(data, job["api_key"], job["vatid"], order_id=job["order_id"])
+        if "invoice_number" in response and "error" not in response:
+            await asyncio.to_thread(self._finish, job["id"], response["invoice_number"])
+        elif response.get("circuit_open"):
+            await asyncio.to_thread(self._defer, job["id"], max(response.get("retry_after", 0), OUTBOX_BACKOFF_BASE), response["error"])
+        else:
+            error = response.get("error") or response.get("msg") or "Create failed"
+            await asyncio.to_thread(self._retry_later, job["id"], job["attempts"], str(error))
+
+    async def _worker(self):
+        while True:
+            self._wakeup.clear()
+            # Every SQLite call runs in a thread: with synchronous=FULL a commit waits for fsync
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                due_in = await asyncio.to_thread(self._next_due_in)
+                timeout = OUTBOX_POLL_INTERVAL if due_in is None else min(due_in, OUTBOX_POLL_INTERVAL)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._process(job)
+            except Exception as e:
+                logging.error(f"Outbox job {job['order_id']} failed: {e}")
+                await asyncio.to_thread(self._retry_later, job["id"], job["attempts"], str(e))
+
+    def start(self, workers: int = None) -> List[asyncio.Task]:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(workers or OUTBOX_WORKERS)]
+        return self._workers
+
+    async def stop(self):
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self.exclusive:
+            self.recover()
+        with self._lock:
+            self._conn.close()
+
+_outbox = None
+
+def init_outbox(path: str, workers: int = None, exclusive: bool = True) -> Optional[InvoiceOutbox]:
+    global _outbox
+    if not path:
+        return None
+    _outbox = InvoiceOutbox(path, exclusive)
+    _outbox.start(workers)
+    return _outbox
+
+def get_outbox() -> Optional[InvoiceOutbox]:
+    return _outbox
+
+async def close_outbox():
+    global _outbox
+    if _outbox is not None:
+        await _outbox.stop()
+        _outbox = None
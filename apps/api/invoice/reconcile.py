@@ -0,0 +1,343 @@
+# invoice/reconcile.py
+
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from typing import Dict, List, Optional
+
+from invoice.search import get_invoice_status_by_period, iter_invoice_pages
+from invoice.ledger import get_ledger, CANCELLED_INVOICE_TYPE
+from invoice.constants import INVOICE_API_TAX_ID, RECONCILE_PAGE_SIZE, RECONCILE_MAX_DAYS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recon_days (
+    vatid TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    page_size INTEGER NOT NULL,
+    row_count INTEGER NOT NULL,
+    watermark TEXT NOT NULL,
+    last_run_at REAL NOT NULL,
+    last_full_at REAL NOT NULL,
+    PRIMARY KEY (vatid, day)
+);
+CREATE TABLE IF NOT EXISTS recon_pages (
+    vatid TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    row_count INTEGER NOT NULL,
+    first_number TEXT,
+    hash TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (vatid, day, page)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS recon_rows (
+    vatid TEXT NOT NULL,
+    invoice_number TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    order_id TEXT,
+    total_amount TEXT,
+    invoice_type TEXT,
+    PRIMARY KEY (vatid, invoice_number)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_recon_rows_day ON recon_rows (vatid, day, page);
+"""
+
+# apply_page outcomes
+SAME = "same"
+CHANGED = "changed"
+SHIFTED = "shifted"
+
+class ReconcileError(Exception):
+    def __init__(self, response: dict):
+        super().__init__(str(response.get("error") or response.get("msg")))
+        self.response = response
+
+def page_hash(items: List[dict]) -> str:
+    return hashlib.sha1(json.dumps(items, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+class ReconcileStore:
+    """
+    What the provider's invoice_list looked like at the last run, per VATID and invoice date:
+    a hash per page, the rows of every page, and a watermark (hash of the page hashes) per day.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def day_state(self, vatid: str, day: int) -> Optional[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute("SELECT * FROM recon_days WHERE vatid = ? AND day = ?", (vatid, day)).fetchone()
+
+    def pages(self, vatid: str, day: int) -> Dict[int, sqlite3.Row]:
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM recon_pages WHERE vatid = ? AND day = ?", (vatid, day)).fetchall()
+        return {row["page"]: row for row in rows}
+
+    def rows(self, vatid: str, day: int) -> Dict[str, dict]:
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT invoice_number, page, order_id, total_amount, invoice_type FROM recon_rows WHERE vatid = ? AND day = ?",
+                (vatid, day),
+            )
+            return {row["invoice_number"]: dict(row) for row in cursor.fetchall()}
+
+    def apply_page(self, vatid: str, day: int, page: int, items: List[dict], stored: Optional[sqlite3.Row]) -> str:
+        """Store a freshly fetched page unless its hash is unchanged; SHIFTED means page boundaries moved."""
+        digest = page_hash(items)
+        if stored is not None:
+            if stored["hash"] == digest:
+                return SAME
+            first_number = items[0]["invoice_number"] if items else None
+            # The listing only grows at the end, so a page that starts elsewhere or shrank cannot be patched in place
+            if (stored["row_count"] and first_number != stored["first_number"]) or len(items) < stored["row_count"]:
+                return SHIFTED
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM recon_rows WHERE vatid = ? AND day = ? AND page = ?", (vatid, day, page))
+            self._conn.executemany(
+                """
+                INSERT OR REPLACE INTO recon_rows (vatid, invoice_number, day, page, order_id, total_amount, invoice_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                [
+                    (vatid, item["invoice_number"], day, page, item.get("order_id"),
+                     None if item.get("total_amount") is None else str(item["total_amount"]), item.get("invoice_type"))
+                    for item in items
+                ],
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO recon_pages (vatid, day, page, row_count, first_number, hash, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (vatid, day, page, len(items), items[0]["invoice_number"] if items else None, digest, time.time()),
+            )
+            self._conn.execute("COMMIT")
+        return CHANGED
+
+    def reset_day(self, vatid: str, day: int):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM recon_rows WHERE vatid = ? AND day = ?", (vatid, day))
+            self._conn.execute("DELETE FROM recon_pages WHERE vatid = ? AND day = ?", (vatid, day))
+            self._conn.execute("COMMIT")
+
+    def save_day(self, vatid: str, day: int, page_size: int, full: bool) -> sqlite3.Row:
+        now = time.time()
+        with self._lock:
+            pages = self._conn.execute(
+                "SELECT hash, row_count FROM recon_pages WHERE vatid = ? AND day = ? ORDER BY page", (vatid, day)
+            ).fetchall()
+            watermark = hashlib.sha1("".join(row["hash"] for row in pages).encode("ascii")).hexdigest()
+            self._conn.execute(
+                """
+                INSERT INTO recon_days (vatid, day, page_size, row_count, watermark, last_run_at, last_full_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (vatid, day) DO UPDATE SET
+                    page_size = excluded.page_size,
+                    row_count = excluded.row_count,
+                    watermark = excluded.watermark,
+                    last_run_at = excluded.last_run_at,
+                    last_full_at = CASE WHEN ? THEN excluded.last_full_at ELSE last_full_at END
+                """,
+                (vatid, day, page_size, sum(row["row_count"] for row in pages), watermark, now, now, full),
+            )
+            return self._conn.execute("SELECT * FROM recon_days WHERE vatid = ? AND day = ?", (vatid, day)).fetchone()
+
+def _page_items(response: dict) -> List[dict]:
+    if "error" in response or response.get("code", 0) != 0:
+        raise ReconcileError(response)
+    return response.get("data") or []
+
+def _period_query(day: int, page: int, page_size: int) -> dict:
+    return {"date_select": 1, "date_start": day, "date_end": day, "limit": page_size, "page": page}
+
+async def _walk(store: ReconcileStore, vatid: str, day: int, start_page: int, pages: dict, page_size: int, api_key: str, stats: dict) -> bool:
+    """Fetch pages from start_page until a short one; False if page boundaries moved."""
+    page = start_page
+    responses = iter_invoice_pages(_period_query(day, start_page, page_size), api_key, vatid)
+    try:
+        async for response in responses:
+            items = _page_items(response)
+            stats["pages_fetched"] += 1
+            outcome = await asyncio.to_thread(store.apply_page, vatid, day, page, items, pages.get(page))
+            if outcome == SHIFTED:
+                return False
+            stats["pages_changed"] += outcome == CHANGED
+            page += 1
+    finally:
+        # Cancels the prefetched next page when we stop early
+        await responses.aclose()
+    return True
+
+async def refresh_day(store: ReconcileStore, vatid: str, day: int, local: List[dict], api_key: str = None, full: bool = False) -> tuple:
+    """
+    Bring the stored listing of one day up to date; returns (stats, rows by invoice number).
+    Pages already seen are fetched again only when the ledger knows of a change on them (an
+    invoice cancelled since); everything past the high-water mark, i.e. from the last known
+    page on, is always fetched. Changes made outside this API need a `full` run to be seen.
+    """
+    page_size = RECONCILE_PAGE_SIZE
+    state = await asyncio.to_thread(store.day_state, vatid, day)
+    stats = {"mode": "incremental", "pages_fetched": 0, "pages_changed": 0}
+    full = full or state is None or state["page_size"] != page_size
+    cached = None
+    if not full:
+        pages = await asyncio.to_thread(store.pages, vatid, day)
+        cached = await asyncio.to_thread(store.rows, vatid, day)
+        tail = max(pages) if pages else 1
+        dirty = sorted({
+            cached[row["invoice_number"]]["page"] for row in local
+            if row["cancelled"] and row["invoice_number"] in cached
+            and cached[row["invoice_number"]]["invoice_type"] != CANCELLED_INVOICE_TYPE
+        } - {tail})
+        responses = await asyncio.gather(*(
+            get_invoice_status_by_period(_period_query(day, page, page_size), api_key, vatid) for page in dirty
+        ))
+        for page, response in zip(dirty, responses):
+            items = _page_items(response)
+            stats["pages_fetched"] += 1
+            outcome = await asyncio.to_thread(store.apply_page, vatid, day, page, items, pages[page])
+            if outcome == SHIFTED:
+                full = True
+                break
+            stats["pages_changed"] += outcome == CHANGED
+        if not full:
+            full = not await _walk(store, vatid, day, tail, pages, page_size, api_key, stats)
+    if full:
+        stats["mode"] = "full"
+        await asyncio.to_thread(store.reset_day, vatid, day)
+        await _walk(store, vatid, day, 1, {}, page_size, api_key, stats)
+    state = await asyncio.to_thread(store.save_day, vatid, day, page_size, full)
+    stats["watermark"] = state["watermark"]
+    stats["upstream_rows"] = state["row_count"]
+    if full or stats["pages_changed"]:
+        cached = await asyncio.to_thread(store.rows, vatid, day)
+    return stats, cached
+
+def _amount(value) -> Optional[Decimal]:
+    try:
+        return Decimal(str(value))
+    except (InvalidOperation, TypeError):
+        return None
+
+def diff_day(local: List[dict], upstream: Dict[str, dict]) -> dict:
+    """Compare the orders this API issued with the provider's listing, both indexed by hash lookups."""
+    missing, cancelled, mismatched = [], [], []
+    invoices_by_order = defaultdict(set)
+    for row in local:
+        number, order_id = row["invoice_number"], row["order_id"]
+        listed = upstream.get(number)
+        if listed is None:
+            missing.append({"invoice_number": number, "order_id": order_id})
+            continue
+        if listed["invoice_type"] == CANCELLED_INVOICE_TYPE:
+            cancelled.append({"invoice_number": number, "order_id": order_id})
+            continue
+        if order_id:
+            invoices_by_order[order_id].add(number)
+        # Strings compare equal in the common case; Decimal only settles "100" vs "100.0"
+        if row["total_amount"] != listed["total_amount"] and _amount(row["total_amount"]) != _amount(listed["total_amount"]):
+            mismatched.append({
+                "invoice_number": number,
+                "order_id": order_id,
+                "local_amount": row["total_amount"],
+                "upstream_amount": listed["total_amount"],
+            })
+    local_numbers = {row["invoice_number"] for row in local}
+    unrecorded = 0
+    for number, listed in upstream.items():
+        if listed["invoice_type"] == CANCELLED_INVOICE_TYPE:
+            continue
+        if listed["order_id"]:
+            invoices_by_order[listed["order_id"]].add(number)
+        unrecorded += number not in local_numbers
+    duplicates = [
+        {"order_id": order_id, "invoice_numbers": sorted(numbers)}
+        for order_id, numbers in invoices_by_order.items() if len(numbers) > 1
+    ]
+    return {
+        "missing": missing,
+        "duplicates": duplicates,
+        "cancelled": cancelled,
+        "amount_mismatch": mismatched,
+        # Valid invoices in the listing that this API did not issue (other tills, the provider's portal)
+        "unrecorded": unrecorded,
+    }
+
+def _days(date_start: int, date_end: int) -> List[int]:
+    start = datetime.strptime(str(date_start), "%Y%m%d").date()
+    end = datetime.strptime(str(date_end), "%Y%m%d").date()
+    return [int((start + timedelta(days=offset)).strftime("%Y%m%d")) for offset in range((end - start).days + 1)]
+
+_store = None
+# One run per VATID at a time; two would fetch the same pages and race on the watermarks
+_locks: Dict[str, asyncio.Lock] = {}
+
+async def reconcile(date_start: int, date_end: int, api_key: str = None, vatid: str = None, full: bool = False) -> dict:
+    """Reconcile every invoice date in the range; `full` ignores the watermarks and refetches everything."""
+    ledger = get_ledger()
+    if _store is None or ledger is None:
+        return {"error": "Reconciliation needs RECONCILE_DB and LEDGER_DB", "status_code": 404}
+    try:
+        days = _days(date_start, date_end)
+    except ValueError:
+        return {"error": "date_start and date_end must be YYYYMMDD", "status_code": 400}
+    if not days or len(days) > RECONCILE_MAX_DAYS:
+        return {"error": f"A range of 1 to {RECONCILE_MAX_DAYS} days is required", "status_code": 400}
+
+    vatid = vatid or INVOICE_API_TAX_ID
+    started = time.perf_counter()
+    reports = []
+    async with _locks.setdefault(vatid, asyncio.Lock()):
+        for day in days:
+            local = await asyncio.to_thread(ledger.find_issued, vatid, day)
+            try:
+                stats, upstream = await refresh_day(_store, vatid, day, local, api_key, full)
+            except ReconcileError as e:
+                return {
+                    "error": f"Listing for {day} failed: {e}",
+                    "status_code": e.response.get("status_code", 502),
+                    "days": reports,
+                }
+            report = {"date": day, "local_orders": len(local), **stats}
+            report.update(await asyncio.to_thread(diff_day, local, upstream))
+            reports.append(report)
+    totals = {
+        key: sum(len(report[key]) for report in reports)
+        for key in ("missing", "duplicates", "cancelled", "amount_mismatch")
+    }
+    totals["unrecorded"] = sum(report["unrecorded"] for report in reports)
+    totals["pages_fetched"] = sum(report["pages_fetched"] for report in reports)
+    return {"seconds": round(time.perf_counter() - started, 3), "totals": totals, "days": reports}
+
+def init_reconcile(path: str) -> Optional[ReconcileStore]:
+    global _store
+    if not path:
+        return None
+    _store = ReconcileStore(path)
+    return _store
+
+def get_reconcile_store() -> Optional[ReconcileStore]:
+    return _store
+
+def close_reconcile():
+    global _store
+    if _store is not None:
+        _store.close()
+        _store = None
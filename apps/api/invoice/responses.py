@@ -0,0 +1,56 @@
+# invoice/responses.py
+
+import json
+from json.encoder import encode_basestring
+from typing import Iterable, List
+
+from fastapi.responses import Response
+
+JSON_MEDIA_TYPE = "application/json"
+
+# Bytes that force escaping inside a JSON string: control characters, quote, backslash
+_JSON_ESCAPED = bytes(range(0x20)) + b'"\\'
+
+def json_bytes(content) -> bytes:
+    """
+    The exact body FastAPI's JSONResponse would send, minus the jsonable_encoder walk.
+    Only for plain JSON data (dict/list/str/int/float/bool/None), e.g. parsed upstream responses.
+    """
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def json_string_bytes(text: str) -> bytes:
+    """A str as a JSON string body, byte-identical to json_bytes(text)."""
+    raw = text.encode("utf-8")
+    # translate() with a delete table is a single C pass; rows almost never need escaping
+    if len(raw.translate(None, _JSON_ESCAPED)) == len(raw):
+        return b"".join((b'"', raw, b'"'))
+    return encode_basestring(text).encode("utf-8")
+
+def json_response(content, status_code: int = 200) -> Response:
+    return Response(json_bytes(content), status_code=status_code, media_type=JSON_MEDIA_TYPE)
+
+def text_response(text: str, status_code: int = 200) -> Response:
+    """Plain-text answers for the PowerBuilder client; still a JSON string on the wire, as before."""
+    return Response(json_string_bytes(text), status_code=status_code, media_type=JSON_MEDIA_TYPE)
+
+def queued_response(order_id: str) -> Response:
+    """
+    202 for an order that was queued instead of issued. A JSON object, never a bare string,
+    so a till reading the body as an invoice number cannot mistake the OrderId for one.
+    """
+    return json_response(
+        {"queued": True, "order_id": order_id, "status_url": f"/api/v1/queue/order/{order_id}"},
+        status_code=202,
+    )
+
+def format_period_row(item: dict) -> str:
+    # "$date,$time,$invoice_id,$vat_id,$amount,$type,$state,$carrier_id" row of the PowerBuilder period listing
+    return f"{item['invoice_date']},{item['invoice_time']},{item['invoice_number']},{item['buyer_identifier']},{item['total_amount']},{item['invoice_type']},{item['invoice_status']},{item['carrier_id1']}"
+
+def format_period_rows(items: Iterable[dict]) -> List[str]:
+    # An f-string per row beats %-formatting, str.format and column-wise map/zip in CPython
+    return [format_period_row(item) for item in items]
+
+def period_response(items: Iterable[dict]) -> Response:
+    """The "。"-separated period listing; rows are joined once and encoded once."""
+    return text_response("。".join(format_period_rows(items)))
@@ -1,59 +1,341 @@
 # invoice/search.py
 
+import asyncio
+import hashlib
+import hmac
+import logging
 import time
+from datetime import date, timedelta
 from typing import List
 from urllib.parse import urljoin
-from invoice.utils import create_package, send_request
+from invoice.utils import create_package, send_request_async
 from invoice.utils import InvoiceNumberItem
-from invoice.constants import INVOICE_API_BASE_URL, STATUS_INVOICE_URI, SEARCH_INVOICE_LIST_URI, GET_INVOICE_PRINT_URI, GET_COMPANY_VAT_INFO_URI
+from invoice.constants import INVOICE_API_BASE_URL, STATUS_INVOICE_URI, SEARCH_INVOICE_URI, SEARCH_INVOICE_LIST_URI, GET_INVOICE_PRINT_URI, GET_COMPANY_VAT_INFO_URI
+from invoice.constants import BAN_CACHE_SIZE, BAN_CACHE_TTL, BAN_CACHE_NEGATIVE_TTL, PERIOD_EXPORT_PAGE_SIZE
+from invoice.constants import LEDGER_SYNC_DAYS, LEDGER_SYNC_INTERVAL, PRINT_CACHE_SIZE, PRINT_CACHE_TTL
+from invoice.constants import INVOICE_API_KEY, INVOICE_API_TAX_ID, INVOICE_API_COMPANY_NAME, LOCAL_PRINT_RENDER
+from invoice.escpos import render_invoice_base64
+from invoice.singleflight import SingleFlight
+from invoice.batcher import StatusBatcher
+from invoice.constants import STATUS_BATCH_WINDOW, STATUS_BATCH_MAX, STATUS_CACHE_SIZE, STATUS_CACHE_TTL
+from invoice.cache import TTLCache, MISSING
+from invoice.ledger import get_ledger
 
 from invoice.utils import InvoiceNumberByPeriod
 
-def get_invoice_status(
+# BAN -> company item from /json/ban_query, or None when the BAN is unknown ("0018")
+ban_cache = TTLCache(maxsize=BAN_CACHE_SIZE, ttl=BAN_CACHE_TTL)
+
+# (credential, vatid, type, order id / invoice number, printer_type, print_invoice_type) -> /json/invoice_print response
+print_cache = TTLCache(maxsize=PRINT_CACHE_SIZE, ttl=PRINT_CACHE_TTL)
+
+# (credential, vatid, invoice number) -> its /json/invoice_status row; only used when STATUS_CACHE_TTL > 0
+status_cache = TTLCache(maxsize=STATUS_CACHE_SIZE, ttl=STATUS_CACHE_TTL)
+
+def credential(api_key: str = None) -> str:
+    """
+    Cache-key part for the caller's key. Without a tenant registry any Authorization is
+    passed through, so an entry must only answer the key that fetched it. Hashed, because
+    the shared state file is readable by every worker.
+    """
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:32]
+
+# Identical in-flight lookups share one upstream call; keys include the credentials
+status_flight = SingleFlight("invoice_status")
+print_flight = SingleFlight("invoice_print")
+ban_flight = SingleFlight("ban_query")
+
+async def get_invoice_status(
     invoice_numbers: List[InvoiceNumberItem] = [],
     api_key: str = None,
-    vatid: str = None
+    vatid: str = None,
+    local_first: bool = False,
 ):
-    timestamp = int(time.time())
     # check invoice_numberse at least one item
     if not invoice_numbers:
         raise ValueError("At least one invoice number is required for search.")
     if len(invoice_numbers) == 0:
         raise ValueError("invoice_numbers cannot be empty.")
+    key = (api_key, vatid, local_first, tuple(item["InvoiceNumber"] for item in invoice_numbers))
+    return await status_flight.do(key, lambda: _get_invoice_status(invoice_numbers, api_key, vatid, local_first))
+
+async def _get_invoice_status(
+    invoice_numbers: List[InvoiceNumberItem],
+    api_key: str = None,
+    vatid: str = None,
+    local_first: bool = False,
+):
+    ledger = get_ledger()
+    if local_first and ledger is not None and LEDGER_SYNC_INTERVAL > 0:
+        rows = await asyncio.to_thread(local_invoice_status, ledger, [item["InvoiceNumber"] for item in invoice_numbers], vatid)
+        if rows is not None:
+            return {"code": 0, "msg": "", "data": rows, "source": "local"}
+    if STATUS_CACHE_TTL > 0:
+        vatid_key = (credential(api_key), vatid or INVOICE_API_TAX_ID)
+        cached = [status_cache.get((*vatid_key, number)) for number in dict.fromkeys(item["InvoiceNumber"] for item in invoice_numbers)]
+        if MISSING not in cached:
+            return {"code": 0, "msg": "", "data": cached, "cached": True}
+    if STATUS_BATCH_WINDOW > 0:
+        response = await status_batcher.lookup([item["InvoiceNumber"] for item in invoice_numbers], api_key, vatid)
+    else:
+        response = await send_invoice_status(invoice_numbers, api_key, vatid)
+    if STATUS_CACHE_TTL > 0 and "error" not in response and response.get("code", 0) == 0:
+        for row in response.get("data") or []:
+            if isinstance(row, dict) and row.get("invoice_number"):
+                status_cache.set((*vatid_key, row["invoice_number"]), row)
+    return response
+
+def local_invoice_status(ledger, invoice_numbers: List[str], vatid: str = None):
+    """
+    /json/invoice_status rows from the ledger, or None unless every number is known and its
+    invoice date was listed by a sync within LEDGER_SYNC_INTERVAL. The upload status changes
+    after issue, so rows only written at create time, or synced long ago, are not answered.
+    """
+    numbers = list(dict.fromkeys(invoice_numbers))
+    rows = ledger.find_by_invoice_numbers(vatid, numbers)
+    if len(rows) != len(numbers) or any(not row["invoice_status"] or row["invoice_date"] is None for row in rows):
+        return None
+    days = {row["invoice_date"] for row in rows}
+    if ledger.synced_since(vatid, days, time.time() - LEDGER_SYNC_INTERVAL) != days:
+        return None
+    by_number = {row["invoice_number"]: row for row in rows}
+    answer = []
+    for number in numbers:
+        row = by_number[number]
+        # The ledger keeps the listing's value as text; upstream answers a number
+        status = int(row["invoice_status"]) if row["invoice_status"].isdigit() else row["invoice_status"]
+        answer.append({"invoice_number": number, "invoice_type": row["invoice_type"], "invoice_status": status})
+    return answer
+
+def forget_invoice_status(invoice_numbers: List[str], api_key: str = None, vatid: str = None):
+    """Drop cached status rows of invoices whose state just changed (e.g. a cancellation)."""
+    if STATUS_CACHE_TTL > 0:
+        for number in invoice_numbers:
+            status_cache.delete((credential(api_key), vatid or INVOICE_API_TAX_ID, number))
+
+async def send_invoice_status(
+    invoice_numbers: List[InvoiceNumberItem],
+    api_key: str = None,
+    vatid: str = None
+):
+    timestamp = int(time.time())
     url = urljoin(INVOICE_API_BASE_URL, STATUS_INVOICE_URI)
     package = create_package(timestamp, invoice_numbers, api_key, vatid)
 
-    return send_request(url, package)
+    return await send_request_async(url, package, vatid)
 
-def get_invoice_status_by_period(
-    data: InvoiceNumberByPeriod,
+status_batcher = StatusBatcher(send_invoice_status, STATUS_BATCH_WINDOW, STATUS_BATCH_MAX)
+
+async def query_invoice_by_order(
+    order_id: str,
     api_key: str = None,
     vatid: str = None
 ):
+    timestamp = int(time.time())
+    url = urljoin(INVOICE_API_BASE_URL, SEARCH_INVOICE_URI)
+    package = create_package(timestamp, {"type": "order", "order_id": order_id}, api_key, vatid)
+
+    return await send_request_async(url, package, vatid)
+
+async def get_invoice_status_by_period(
+    data: InvoiceNumberByPeriod,
+    api_key: str = None,
+    vatid: str = None,
+    local_first: bool = False,
+):
+    ledger = get_ledger()
+    # Only a range a completed sync has listed is known in full; the ledger alone may hold part of it.
+    # Syncs list by invoice date, so date_select 2 (建立日期) always goes upstream.
+    if (
+        local_first and ledger is not None and int(data.get("date_select", 1)) == 1
+        and await asyncio.to_thread(ledger.covers, vatid, data["date_start"], data["date_end"], LEDGER_SYNC_INTERVAL)
+    ):
+        rows = await asyncio.to_thread(
+            ledger.find_by_period, vatid, 1, data["date_start"], data["date_end"],
+            data.get("limit", 20), data.get("page", 1),
+        )
+        return {"code": 0, "msg": "", "data": rows, "source": "local"}
+
     timestamp = int(time.time())
     url = urljoin(INVOICE_API_BASE_URL, SEARCH_INVOICE_LIST_URI)
     package = create_package(timestamp, data, api_key, vatid)
 
-    return send_request(url, package)
+    response = await send_request_async(url, package, vatid)
+    # Every upstream listing refreshes the ledger for free
+    if ledger is not None and "error" not in response and response.get("data"):
+        await asyncio.to_thread(ledger.record_listing, vatid, response["data"])
+    return response
+
+async def iter_invoice_pages(
+    data: InvoiceNumberByPeriod,
+    api_key: str = None,
+    vatid: str = None
+):
+    """
+    Yield every /json/invoice_list page for the date range, starting at data["page"].
+    The next page is requested while the caller consumes the current one, so at
+    most two pages are held in memory. An error response is yielded and ends the walk.
+    """
+    query = dict(data)
+    query.setdefault("page", 1)
+    query["limit"] = query.get("limit") or PERIOD_EXPORT_PAGE_SIZE
+
+    next_page = asyncio.ensure_future(get_invoice_status_by_period(dict(query), api_key, vatid))
+    try:
+        while next_page is not None:
+            response = await next_page
+            next_page = None
+            if "error" in response or "data" not in response:
+                yield response
+                return
+            # A short page is the last one
+            if len(response["data"]) >= query["limit"]:
+                query["page"] += 1
+                next_page = asyncio.ensure_future(get_invoice_status_by_period(dict(query), api_key, vatid))
+            yield response
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+async def sync_ledger(days: int = None, api_key: str = None, vatid: str = None) -> int:
+    """Refresh the ledger from /json/invoice_list for the last `days` days; returns rows seen."""
+    end = date.today()
+    start = end - timedelta(days=(days or LEDGER_SYNC_DAYS) - 1)
+    query = {"date_select": 1, "date_start": int(start.strftime("%Y%m%d")), "date_end": int(end.strftime("%Y%m%d")), "page": 1}
+    seen = 0
+    # Invoices issued while the pages are walked may be missed, so coverage dates from the start
+    started = time.time()
+    async for page in iter_invoice_pages(query, api_key, vatid):
+        if "error" in page or page.get("code", 0) != 0:
+            logging.error(f"Ledger sync stopped: {page.get('error') or page.get('msg')}")
+            return seen
+        # A listing with no invoices may come back without "data"
+        seen += len(page.get("data") or [])
+    ledger = get_ledger()
+    if ledger is not None:
+        days = [int((start + timedelta(days=offset)).strftime("%Y%m%d")) for offset in range((end - start).days + 1)]
+        await asyncio.to_thread(ledger.mark_synced, vatid, days, started)
+    return seen
+
+async def run_ledger_sync(interval: float, api_key: str = None, vatid: str = None):
+    while True:
+        try:
+            await sync_ledger(api_key=api_key, vatid=vatid)
+        except Exception as e:
+            logging.error(f"Ledger sync failed: {e}")
+        await asyncio.sleep(interval)
+
+def print_cache_key(data: dict, api_key: str = None, vatid: str = None) -> tuple:
+    lookup = data.get("order_id") if data.get("type") == "order" else data.get("invoice_number")
+    return (
+        credential(api_key),
+        vatid or INVOICE_API_TAX_ID,
+        data.get("type"),
+        lookup,
+        int(data.get("printer_type", 2)),
+        int(data.get("print_invoice_type", 1)),
+    )
+
+async def get_print_invoice(
+    data: InvoiceNumberByPeriod,
+    api_key: str = None,
+    vatid: str = None
+):
+    key = print_cache_key(data, api_key, vatid)
+    cached = print_cache.get(key)
+    if cached is not MISSING:
+        return cached
+    return await print_flight.do(key, lambda: _get_print_invoice(data, key, api_key, vatid))
 
-def get_print_invoice(
+async def _get_print_invoice(
     data: InvoiceNumberByPeriod,
+    key: tuple,
     api_key: str = None,
     vatid: str = None
 ):
+    if LOCAL_PRINT_RENDER:
+        response = await asyncio.to_thread(render_print_locally, data, api_key, vatid)
+        if response is not None:
+            print_cache.set(key, response)
+            return response
+
     timestamp = int(time.time())
     url = urljoin(INVOICE_API_BASE_URL, GET_INVOICE_PRINT_URI)
     package = create_package(timestamp, data, api_key, vatid)
 
-    return send_request(url, package)
+    response = await send_request_async(url, package, vatid)
+    # Only keep responses that actually carry printable data
+    if "error" not in response and response.get("code", 0) == 0 and (response.get("data") or {}).get("base64_data"):
+        print_cache.set(key, response)
+    return response
+
+def render_print_locally(data: dict, api_key: str = None, vatid: str = None):
+    """Build the /json/invoice_print response from the ledger copy of the f0401 exchange."""
+    ledger = get_ledger()
+    # The seller header needs the company name, which is only configured for our own VATID
+    if ledger is None or (vatid or INVOICE_API_TAX_ID) != INVOICE_API_TAX_ID:
+        return None
+    # The provider checks the key on every call; without it, only our own key may read the ledger
+    if not hmac.compare_digest((api_key or INVOICE_API_KEY).encode(), INVOICE_API_KEY.encode()):
+        return None
+    if data.get("type") == "order":
+        issue = ledger.get_issue(vatid, order_id=data.get("order_id"))
+    else:
+        issue = ledger.get_issue(vatid, invoice_number=data.get("invoice_number"))
+    if issue is None:
+        return None
+    order, issue_response = issue
+    base64_data = render_invoice_base64(
+        order,
+        issue_response,
+        INVOICE_API_COMPANY_NAME,
+        INVOICE_API_TAX_ID,
+        printer_type=int(data.get("printer_type", 2)),
+        print_invoice_type=int(data.get("print_invoice_type", 1)),
+    )
+    if base64_data is None:
+        return None
+    return {"code": 0, "msg": "", "data": {"base64_data": base64_data}, "source": "local"}
 
-def get_company_vat_info(
+async def get_company_vat_info(
     data: InvoiceNumberByPeriod,
     api_key: str = None,
     vatid: str = None
+):
+    bans = [item["ban"] for item in data]
+    cached = [ban_cache.get(ban) for ban in bans]
+    if MISSING not in cached:
+        return {"code": 0, "msg": "", "data": [item for item in cached if item is not None], "cached": True}
+    return await ban_flight.do((api_key, vatid, tuple(bans)), lambda: _get_company_vat_info(data, bans, api_key, vatid))
+
+async def _get_company_vat_info(
+    data: InvoiceNumberByPeriod,
+    bans: List[str],
+    api_key: str = None,
+    vatid: str = None
 ):
     timestamp = int(time.time())
     url = urljoin(INVOICE_API_BASE_URL, GET_COMPANY_VAT_INFO_URI)
     package = create_package(timestamp, data, api_key, vatid)
 
-    return send_request(url, package)
+    response = await send_request_async(url, package, vatid)
+    # A provider error (bad key, clock skew, quota) says nothing about the BANs; caching it would answer "0018"
+    if "error" not in response and response.get("code", 0) == 0:
+        cache_ban_response(bans, response)
+    return response
+
+def cache_ban_response(bans: List[str], response: dict):
+    items = response.get("data") or []
+    if len(bans) == 1:
+        found = {bans[0]: items[0]} if items else {}
+    else:
+        # Only trust the mapping when the upstream echoes the BAN back
+        found = {item["ban"]: item for item in items if isinstance(item, dict) and "ban" in item}
+        if len(found) != len(items):
+            return
+    for ban in bans:
+        item = found.get(ban)
+        if item is None:
+            ban_cache.set(ban, None, ttl=BAN_CACHE_NEGATIVE_TTL)
+        else:
+            ban_cache.set(ban, item)
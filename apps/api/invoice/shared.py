@@ -0,0 +1,259 @@
+# invoice/shared.py
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+from invoice.cache import MISSING
+from invoice.constants import SHARED_STATE_BUSY_TIMEOUT
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache (namespace, expires_at);
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+# Expired and over-size entries of a namespace are trimmed every this many writes
+TRIM_EVERY = 256
+
+def _key(key) -> str:
+    # Cache keys are strings or tuples of scalars; JSON gives the same text in every process
+    return json.dumps(key, ensure_ascii=False, separators=(",", ":"))
+
+class SharedState:
+    """
+    Cache entries and token buckets that every worker process on the host reads and writes,
+    kept in one SQLite file. On tmpfs (/dev/shm) nothing touches the disk, and SQLite's file
+    locking makes each operation atomic across processes without a separate server.
+    The file next to it with a ".leader" suffix elects the worker that runs background jobs.
+
+    get/set/reserve run on the event loop, so they wait at most busy_timeout for another
+    worker's lock and then give up: a cache miss, a skipped write, or the caller's own
+    per-process budget. Everything else uses a second connection that may wait and is only
+    called from threads, startup or shutdown.
+    """
+
+    def __init__(self, path: str, busy_timeout: float = None):
+        self.path = path
+        self.leader = False
+        self.busy = 0
+        self._writes = {}
+        self._leader_file = None
+        self._conn = self._connect(SHARED_STATE_BUSY_TIMEOUT if busy_timeout is None else busy_timeout)
+        self._lock = threading.Lock()
+        self._background = self._connect(10)
+        self._background_lock = threading.Lock()
+        with self._background_lock:
+            self._background.executescript(SCHEMA)
+
+    def _connect(self, timeout: float) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=timeout)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Cached state can always be rebuilt from upstream, so there is nothing to fsync
+        conn.execute("PRAGMA synchronous=OFF")
+        return conn
+
+    def _in_background(self, target, *args):
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    def _execute_blocking(self, sql: str, params: tuple):
+        try:
+            with self._background_lock:
+                self._background.execute(sql, params)
+        except sqlite3.Error as e:
+            logging.error(f"Shared state write failed ({self.path}): {e}")
+
+    # Cache
+
+    def get(self, namespace: str, key):
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires_at >= ?",
+                    (namespace, _key(key), time.time()),
+                ).fetchone()
+        except sqlite3.OperationalError:
+            self.busy += 1
+            return MISSING
+        return MISSING if row is None else json.loads(row[0])
+
+    def set(self, namespace: str, key, value, expires_at: float, maxsize: int = 0):
+        value = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                    (namespace, _key(key), value, expires_at),
+                )
+                writes = self._writes[namespace] = self._writes.get(namespace, 0) + 1
+        except sqlite3.OperationalError:
+            # A lost cache write only costs a later upstream call
+            self.busy += 1
+            return
+        if maxsize and writes % TRIM_EVERY == 0:
+            self._in_background(self.trim, namespace, maxsize)
+
+    def delete(self, namespace: str, key):
+        sql, params = "DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, _key(key))
+        try:
+            with self._lock:
+                self._conn.execute(sql, params)
+        except sqlite3.OperationalError:
+            # Unlike a write, a lost invalidation would serve stale data, so it is retried off the loop
+            self.busy += 1
+            self._in_background(self._execute_blocking, sql, params)
+
+    def clear(self, namespace: str):
+        with self._background_lock:
+            self._background.execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+
+    def size(self, namespace: str) -> int:
+        with self._background_lock:
+            return self._background.execute("SELECT COUNT(*) FROM cache WHERE namespace = ?", (namespace,)).fetchone()[0]
+
+    def items(self, namespace: str) -> List[tuple]:
+        """(key, expires_at, value) of the unexpired entries."""
+        with self._background_lock:
+            rows = self._background.execute(
+                "SELECT key, expires_at, value FROM cache WHERE namespace = ? AND expires_at >= ?",
+                (namespace, time.time()),
+            ).fetchall()
+        return [(json.loads(key), expires_at, json.loads(value)) for key, expires_at, value in rows]
+
+    def trim(self, namespace: str, maxsize: int) -> int:
+        """
+        Drop expired entries, then the ones closest to expiry until at most maxsize remain.
+        Reads do not write here, so this evicts by age rather than by last use.
+        """
+        with self._background_lock:
+            self._background.execute("BEGIN IMMEDIATE")
+            removed = self._background.execute(
+                "DELETE FROM cache WHERE namespace = ? AND expires_at < ?", (namespace, time.time())
+            ).rowcount
+            excess = self._background.execute("SELECT COUNT(*) FROM cache WHERE namespace = ?", (namespace,)).fetchone()[0] - maxsize
+            if excess > 0:
+                removed += self._background.execute(
+                    """
+                    DELETE FROM cache WHERE namespace = ? AND key IN (
+                        SELECT key FROM cache WHERE namespace = ? ORDER BY expires_at LIMIT ?
+                    )
+                    """,
+                    (namespace, namespace, excess),
+                ).rowcount
+            self._background.execute("COMMIT")
+        return removed
+
+    # Rate limiting
+
+    def reserve(self, name: str, rate: float, burst: float, max_wait: float):
+        """
+        TokenBucket.reserve against the bucket every worker shares, or MISSING when the file
+        stayed locked for busy_timeout and the caller should use its own budget instead.
+        """
+        with self._lock:
+            # IMMEDIATE takes the write lock up front, so no other process refills the bucket in between
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError:
+                self.busy += 1
+                return MISSING
+            try:
+                now = time.time()
+                row = self._conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+                wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+                if wait > max_wait:
+                    return None
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)", (name, tokens - 1, now)
+                )
+                return wait
+            finally:
+                self._conn.execute("COMMIT")
+
+    # Leadership
+
+    def try_lead(self) -> bool:
+        """Become the host's leader if no live worker is; the OS drops the lock when its holder exits."""
+        if self.leader:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            # No flock on Windows, where the tills run a single worker: it is always the leader
+            self.leader = True
+            return True
+        leader_file = open(f"{self.path}.leader", "a+")
+        try:
+            fcntl.flock(leader_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            leader_file.close()
+            return False
+        leader_file.seek(0)
+        leader_file.truncate()
+        leader_file.write(str(os.getpid()))
+        leader_file.flush()
+        self._leader_file = leader_file
+        self.leader = True
+        return True
+
+    async def wait_for_leadership(self, interval: float = 1.0):
+        while not self.try_lead():
+            await asyncio.sleep(interval)
+        logging.info(f"Worker {os.getpid()} is the leader for {self.path}")
+
+    def stats(self) -> dict:
+        with self._background_lock:
+            namespaces = dict(self._background.execute("SELECT namespace, COUNT(*) FROM cache GROUP BY namespace").fetchall())
+            buckets = self._background.execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+        return {
+            "path": self.path,
+            "pid": os.getpid(),
+            "leader": self.leader,
+            "cache": namespaces,
+            "buckets": buckets,
+            "busy_fallbacks": self.busy,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        with self._background_lock:
+            self._background.close()
+        if self._leader_file is not None:
+            self._leader_file.close()
+            self._leader_file = None
+            self.leader = False
+
+_state = None
+
+def init_shared_state(path: str) -> Optional[SharedState]:
+    global _state
+    if not path:
+        return None
+    _state = SharedState(path)
+    return _state
+
+def get_shared_state() -> Optional[SharedState]:
+    return _state
+
+def close_shared_state():
+    global _state
+    if _state is not None:
+        _state.close()
+        _state = None
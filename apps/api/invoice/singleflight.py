@@ -0,0 +1,37 @@
+# invoice/singleflight.py
+
+import asyncio
+from typing import Awaitable, Callable, Hashable
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller starts the upstream
+    call and everyone arriving while it is in flight awaits the same result.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.executions = 0
+        self._inflight = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is None:
+            self.executions += 1
+            # Run detached so one caller disconnecting does not cancel it for the others
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        shared = self.calls - self.executions
+        return {
+            "calls": self.calls,
+            "upstream_calls": self.executions,
+            "coalesced": shared,
+            "coalescing_ratio": round(shared / self.calls, 4) if self.calls else 0.0,
+            "inflight": len(self._inflight),
+        }
@@ -0,0 +1,201 @@
+# invoice/tenants.py
+
+import hmac
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from invoice.ban import is_valid_ban
+from invoice.cache import MISSING
+from invoice.constants import (
+    INVOICE_API_TAX_ID,
+    INVOICE_API_TEST_KEY,
+    TENANTS,
+    TENANTS_FILE,
+    TENANT_DEFAULT_RATE,
+    TENANT_DEFAULT_BURST,
+    TENANT_DEFAULT_CONCURRENCY,
+    TENANT_UNREGISTERED_MAX,
+)
+from invoice.metrics import Counter
+
+TENANT_RATE_LIMITED = Counter("invoice_tenant_rate_limited_total", "Upstream calls refused by a tenant's rate budget, by VATID.", ("vatid",))
+
+# VATIDs that fail the check-digit rule all share one budget under this name
+INVALID_VATID = "invalid"
+
+class TenantError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+class TokenBucket:
+    """
+    `rate` calls per second with bursts of up to `burst`; a rate of 0 means unlimited.
+    A bucket given a SharedState is kept there under `name`, one budget for all workers.
+    """
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.shared = None
+        self.name = None
+
+    def share(self, state, name: str):
+        self.shared, self.name = state, name
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        """
+        Take a token, returning how long to wait before using it, or None when the wait
+        would exceed max_wait. Tokens may go negative: that is the queue of reservations.
+        """
+        if self.rate <= 0:
+            return 0.0
+        if self.shared is not None:
+            wait = self.shared.reserve(self.name, self.rate, self.burst, max_wait)
+            if wait is not MISSING:
+                return wait
+            # The shared file is locked by another worker: this process's own bucket stands in
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        if wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+class Tenant:
+    def __init__(self, vatid: str, api_key: Optional[str], name: str = "", rate: float = None, burst: float = None, concurrency: int = None):
+        self.vatid = vatid
+        self.api_key = api_key
+        self.name = name
+        self.concurrency = TENANT_DEFAULT_CONCURRENCY if concurrency is None else int(concurrency)
+        self.bucket = TokenBucket(
+            TENANT_DEFAULT_RATE if rate is None else float(rate),
+            TENANT_DEFAULT_BURST if burst is None else float(burst),
+        )
+        self.calls = 0
+        self.rate_limited = 0
+        self._rate_limited_counter = TENANT_RATE_LIMITED.labels(vatid)
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        """Seconds to wait before this tenant's next upstream call, None if over budget."""
+        wait = self.bucket.reserve(max_wait)
+        if wait is None:
+            self.rate_limited += 1
+            self._rate_limited_counter.value += 1
+        else:
+            self.calls += 1
+        return wait
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "rate_per_second": self.bucket.rate,
+            "burst": self.bucket.burst,
+            "concurrency": self.concurrency,
+            "calls": self.calls,
+            "rate_limited": self.rate_limited,
+        }
+
+class TenantRegistry:
+    """
+    Provider credentials per store (VATID), loaded once at startup. With no tenants
+    configured every VATID is accepted with whatever key the request carries, as before;
+    once tenants are configured only their VATIDs are served, and only to callers presenting
+    the key registered for that VATID.
+    """
+
+    def __init__(self):
+        self.tenants: Dict[str, Tenant] = {}
+        # Budgets for VATIDs seen while the registry is empty (open mode), least recently used first
+        self._unregistered: "OrderedDict[str, Tenant]" = OrderedDict()
+        self.shared = None
+
+    def share(self, state):
+        """Draw every tenant's rate budget from `state`, so N workers together stay within it."""
+        self.shared = state
+        for tenant in {**self._unregistered, **self.tenants}.values():
+            tenant.bucket.share(state, f"tenant:{tenant.vatid}")
+
+    def load(self, path: str = None, spec: str = None) -> int:
+        tenants = {}
+        if path:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for entry in data.get("tenants", data) if isinstance(data, dict) else data:
+                tenants[entry["vatid"]] = Tenant(
+                    entry["vatid"], entry["api_key"], entry.get("name", ""),
+                    entry.get("rate"), entry.get("burst"), entry.get("concurrency"),
+                )
+        # TENANTS="12345678:key,87654321:key" for deployments without a file
+        for item in (spec or "").split(","):
+            vatid, _, api_key = item.strip().partition(":")
+            if vatid and api_key:
+                tenants[vatid] = Tenant(vatid, api_key)
+        self.tenants = tenants
+        if self.shared is not None:
+            self.share(self.shared)
+        return len(tenants)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.tenants)
+
+    def get(self, vatid: str) -> Tenant:
+        tenant = self.tenants.get(vatid)
+        if tenant is not None:
+            return tenant
+        # The VATID header is client input: arbitrary strings must not each get a budget and metric labels
+        if vatid != INVOICE_API_TAX_ID and not is_valid_ban(vatid or ""):
+            vatid = INVALID_VATID
+        tenant = self._unregistered.get(vatid)
+        if tenant is not None:
+            self._unregistered.move_to_end(vatid)
+            return tenant
+        tenant = self._unregistered[vatid] = Tenant(vatid, None)
+        if self.shared is not None:
+            tenant.bucket.share(self.shared, f"tenant:{vatid}")
+        while len(self._unregistered) > TENANT_UNREGISTERED_MAX:
+            evicted, _ = self._unregistered.popitem(last=False)
+            TENANT_RATE_LIMITED.remove(evicted)
+        return tenant
+
+    def resolve_api_key(self, vatid: str, authorization: Optional[str]) -> str:
+        """The provider key to use for this request; raises TenantError when it must be refused."""
+        if not self.enabled:
+            return authorization or INVOICE_API_TEST_KEY
+        tenant = self.tenants.get(vatid)
+        if tenant is None:
+            raise TenantError(403, f"Unknown VATID {vatid}")
+        # VATIDs are public, so the caller has to prove it holds the tenant's key
+        if not authorization:
+            raise TenantError(401, "Authorization is required for this VATID")
+        if not hmac.compare_digest(authorization.encode(), tenant.api_key.encode()):
+            raise TenantError(401, "Authorization does not match the key registered for this VATID")
+        return tenant.api_key
+
+    def status(self, semaphore=None) -> dict:
+        status = {}
+        for vatid, tenant in {**self._unregistered, **self.tenants}.items():
+            status[vatid] = tenant.status()
+            if semaphore is not None:
+                status[vatid].update(semaphore.tenant_stats(vatid))
+        return status
+
+registry = TenantRegistry()
+
+def init_tenants(path: str = None, spec: str = None) -> TenantRegistry:
+    path = TENANTS_FILE if path is None else path
+    spec = TENANTS if spec is None else spec
+    # A configured but missing file is an error: silently serving every VATID would be worse
+    count = registry.load(path, spec)
+    if count:
+        logging.info("Loaded %d tenant(s)", count)
+    return registry
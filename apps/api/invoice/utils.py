@@ -1,12 +1,16 @@
 # invoice/utils.py
 
+import asyncio
 import hashlib
 import json
 import logging
+import math
 import urllib.parse
 import time
+import httpx
 import requests
-from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from json.encoder import encode_basestring_ascii
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode, quote_plus
 from pydantic import BaseModel, Field
 from typing import List, Optional
 import posixpath
@@ -15,7 +19,13 @@ from invoice.constants import (
     INVOICE_API_BASE_URL,
     INVOICE_API_KEY,
     INVOICE_API_TAX_ID,
+    PACKAGE_FAST_JSON,
+    TENANT_RATE_MAX_WAIT,
 )
+from invoice.client import get_session, get_timeout, get_async_client, get_async_timeout, get_semaphore
+from invoice.breaker import get_breaker
+from invoice.tenants import registry as tenant_registry
+from invoice.metrics import PACKAGE_LATENCY, UPSTREAM_LATENCY, UPSTREAM_ERRORS, UPSTREAM_IN_FLIGHT, upstream_uri
 
 class InvoiceNumberItem(BaseModel):
     InvoiceNumber: str = Field(..., description="發票號碼")
@@ -59,53 +69,191 @@ def normalize_url(url):
     
     return urlunparse((scheme, netloc, path, '', query, ''))
 
-def create_package(timestamp: int, data: dict, api_key: str = None, vatid: str = None) -> str:
-    from invoice.constants import INVOICE_API_KEY, INVOICE_API_TAX_ID
+# create_package signs json.dumps(data, indent=0); the reference encoder is built once
+_reference_encoder = json.JSONEncoder(indent=0)
+
+class _UnsupportedValue(Exception):
+    pass
+
+def _encode_indent0(o, parts: list):
+    # Same layout as json.dumps(o, indent=0): newline after "[" / "{", ",\n" between items, ": " after keys
+    t = type(o)
+    if t is str:
+        parts.append(encode_basestring_ascii(o))
+    elif t is dict:
+        if not o:
+            parts.append("{}")
+            return
+        parts.append("{\n")
+        first = True
+        for key, value in o.items():
+            if type(key) is not str:
+                raise _UnsupportedValue(key)
+            if first:
+                first = False
+            else:
+                parts.append(",\n")
+            parts.append(encode_basestring_ascii(key))
+            parts.append(": ")
+            _encode_indent0(value, parts)
+        parts.append("\n}")
+    elif t is list or t is tuple:
+        if not o:
+            parts.append("[]")
+            return
+        parts.append("[\n")
+        first = True
+        for value in o:
+            if first:
+                first = False
+            else:
+                parts.append(",\n")
+            _encode_indent0(value, parts)
+        parts.append("\n]")
+    elif o is None:
+        parts.append("null")
+    elif o is True:
+        parts.append("true")
+    elif o is False:
+        parts.append("false")
+    elif t is int:
+        parts.append(int.__repr__(o))
+    elif t is float and math.isfinite(o):
+        parts.append(float.__repr__(o))
+    else:
+        # Subclasses, NaN/Infinity and anything needing default() take the reference path
+        raise _UnsupportedValue(o)
+
+def encode_data(data) -> str:
+    """Serialize data exactly as json.dumps(data, indent=0) does."""
+    if PACKAGE_FAST_JSON:
+        parts = []
+        try:
+            _encode_indent0(data, parts)
+            return "".join(parts)
+        except _UnsupportedValue:
+            pass
+    return _reference_encoder.encode(data)
 
+def create_packages(timestamp: int, items: List[dict], api_key: str = None, vatid: str = None) -> List[str]:
+    """Sign and URL-encode many payloads that share a timestamp and credentials."""
+    started = time.perf_counter()
     invoice_api_key = api_key or INVOICE_API_KEY
     invoice_api_tax_id = vatid or INVOICE_API_TAX_ID
 
-    # JSON serialization must match the server format
-    # indent=0 keeps the newline formatting used in the official reference
-    encoded_data = json.dumps(data, indent = 0) 
+    # The signature is md5(data + time + key); everything after the data is shared by the batch
+    sign_suffix = (str(timestamp) + invoice_api_key).encode("utf-8")
+    # Same field order and quoting as urlencode({"invoice", "data", "time", "sign"}, doseq=True)
+    head = "invoice=" + quote_plus(str(invoice_api_tax_id)) + "&data="
+    tail = "&time=" + quote_plus(str(timestamp)) + "&sign="
 
-    # Build the raw signature string
-    raw_string = encoded_data + str(timestamp) + invoice_api_key
+    md5 = hashlib.md5
+    packages = []
+    for data in items:
+        # JSON serialization must match the server format
+        # indent=0 keeps the newline formatting used in the official reference
+        encoded_data = encode_data(data)
+        m = md5(encoded_data.encode("utf-8"))
+        m.update(sign_suffix)
+        packages.append(head + quote_plus(encoded_data) + tail + m.hexdigest())
+    PACKAGE_LATENCY.observe(time.perf_counter() - started)
+    logging.debug("Packaged %d payload(s) for invoice %s at %s", len(packages), invoice_api_tax_id, timestamp)
+    return packages
 
-    m = hashlib.md5()
-    m.update(raw_string.encode("utf-8"))
-    sign = m.hexdigest()
+def create_package(timestamp: int, data: dict, api_key: str = None, vatid: str = None) -> str:
+    return create_packages(timestamp, [data], api_key, vatid)[0]
 
-    # Final payload structure
-    payload = {
-        "invoice": invoice_api_tax_id,
-        "data": encoded_data,
-        "time": timestamp,
-        "sign": sign,
-    }
+def _record_error(uri: str, response, error: Exception):
+    status = str(response.status_code) if response is not None else type(error).__name__
+    UPSTREAM_ERRORS.labels(uri, status).inc()
 
-    # URL-encode the entire payload
-    print(payload)
-    return urllib.parse.urlencode(payload, doseq=True)
+def _record_http_error(breaker, response, latency: float):
+    # Transport errors, timeouts and 5xx count against the endpoint; a 4xx means the
+    # provider is up and answering, so it is not an outage
+    if response is None or response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success(latency)
 
-def send_request(url: str, data: str) -> dict:
-    headers = {
-        "Content-Type": "application/x-www-form-urlencoded",
-        "User-Agent": "invoice-app/1.0"
+def circuit_open_response(breaker) -> dict:
+    return {
+        "error": "Circuit open",
+        "status_code": 503,
+        "circuit_open": True,
+        "retry_after": round(breaker.retry_after(), 3),
     }
 
+def send_request(url: str, data: str) -> dict:
+    response = None
+    uri = upstream_uri(url)
+    breaker = get_breaker(uri)
+    if not breaker.allow():
+        return circuit_open_response(breaker)
+    in_flight = UPSTREAM_IN_FLIGHT.labels(uri)
+    in_flight.inc()
+    started = time.perf_counter()
+    latency = 0.0
     try:
-        proxies = {
-            "http": "http://localhost:8080",
-            "https": "http://localhost:8080"
-        }
-        response = requests.post(url, headers=headers, data=data, verify=False)
+        try:
+            response = get_session().post(url, data=data, timeout=get_timeout(url, breaker))
+        finally:
+            latency = time.perf_counter() - started
+            UPSTREAM_LATENCY.labels(uri).observe(latency)
+            in_flight.dec()
         response.raise_for_status()
 
-        return response.json()
+        result = response.json()
+        breaker.record_success(latency)
+        return result
     except requests.RequestException as e:
         logging.error(f"Request failed: {e}")
-        return {"error": "Request failed", "details": e, "status_code": response.status_code if response else 500}
+        _record_error(uri, response, e)
+        _record_http_error(breaker, response, latency)
+        return {"error": "Request failed", "details": e, "status_code": response.status_code if response is not None else 500}
+    except json.JSONDecodeError as e:
+        logging.error(f"JSON decode error: {e}")
+        _record_error(uri, None, e)
+        breaker.record_failure()
+        return {"error": "Invalid JSON response", "status_code": 500, "details": e}
+
+async def send_request_async(url: str, data: str, vatid: str = None) -> dict:
+    response = None
+    uri = upstream_uri(url)
+    breaker = get_breaker(uri)
+    if not breaker.allow():
+        return circuit_open_response(breaker)
+    # Provider quotas are per VATID: wait for the tenant's token, then for a fair share of the pool
+    tenant = tenant_registry.get(vatid or INVOICE_API_TAX_ID)
+    wait = tenant.reserve(TENANT_RATE_MAX_WAIT)
+    if wait is None:
+        return {"error": "Rate limit exceeded", "status_code": 429}
+    if wait:
+        await asyncio.sleep(wait)
+    latency = 0.0
+    try:
+        async with get_semaphore().slot(tenant.vatid, tenant.concurrency):
+            # Timed inside the semaphore so queueing for a connection slot is not counted as provider latency
+            in_flight = UPSTREAM_IN_FLIGHT.labels(uri)
+            in_flight.inc()
+            started = time.perf_counter()
+            try:
+                response = await get_async_client().post(url, content=data, timeout=get_async_timeout(url, breaker))
+            finally:
+                latency = time.perf_counter() - started
+                UPSTREAM_LATENCY.labels(uri).observe(latency)
+                in_flight.dec()
+        response.raise_for_status()
+
+        result = response.json()
+        breaker.record_success(latency)
+        return result
+    except httpx.HTTPError as e:
+        logging.error(f"Request failed: {e}")
+        _record_error(uri, response, e)
+        _record_http_error(breaker, response, latency)
+        return {"error": "Request failed", "details": e, "status_code": response.status_code if response is not None else 500}
     except json.JSONDecodeError as e:
         logging.error(f"JSON decode error: {e}")
-        return {"error": "Invalid JSON response", "status_code": 500, "details": e}
\ No newline at end of file
+        _record_error(uri, None, e)
+        breaker.record_failure()
+        return {"error": "Invalid JSON response", "status_code": 500, "details": e}
@@ -1,33 +1,129 @@
 # main.py
+import asyncio
+import json
+import logging
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, condecimal, Field
 from typing import Optional, List, Annotated, Literal
-from fastapi import APIRouter, Body, Query, Header
+from fastapi import APIRouter, Body, Query, Header, Depends
+from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.exception_handlers import request_validation_exception_handler
 from fastapi.middleware.cors import CORSMiddleware
 
-from invoice.create import create_full_invoice
+from invoice.create import create_full_invoice, create_invoices
 from invoice.search import (
     get_invoice_status,
     get_invoice_status_by_period,
+    iter_invoice_pages,
+    run_ledger_sync,
     get_print_invoice,
     get_company_vat_info,
+    ban_cache,
+    print_cache,
+    status_cache,
+    status_flight,
+    print_flight,
+    ban_flight,
+    status_batcher,
 )
 from invoice.cancel import cancel_invoices
-from invoice.constants import INVOICE_API_TEST_KEY, INVOICE_API_TAX_ID
+from invoice.amounts import check_amounts, check_amounts_batch
+from invoice.idempotency import init_idempotency, get_idempotency, close_idempotency, idempotency_key, request_fingerprint, IdempotencyConflict
+from invoice.bulk_cancel import init_cancel_store, close_cancel_store, resume_bulk_cancels, start_bulk_cancel, job_status, new_job_id, get_cancel_store
+from invoice.bulk_cancel import check_job, CancelJobConflict
+from invoice.client import init_session, close_session, init_async_client, close_async_client, get_semaphore
+from invoice.tenants import init_tenants, TenantError, registry as tenant_registry
+from invoice.ledger import init_ledger, close_ledger
+from invoice.outbox import init_outbox, get_outbox, close_outbox
+from invoice.breaker import breaker_status
+from invoice.reconcile import init_reconcile, close_reconcile, reconcile
+from invoice.shared import init_shared_state, get_shared_state, close_shared_state
+from invoice import metrics
+from invoice.responses import json_response, text_response, queued_response, period_response, format_period_rows
+from invoice.constants import INVOICE_API_TEST_KEY, INVOICE_API_TAX_ID, BAN_CACHE_FILE, PERIOD_EXPORT_PAGE_SIZE
+from invoice.constants import LEDGER_DB, LEDGER_LOCAL_FIRST, LEDGER_SYNC_INTERVAL, RECONCILE_DB
+from invoice.constants import OUTBOX_DB, OUTBOX_ENQUEUE, OUTBOX_FALLBACK, BREAKER_ENQUEUE_CREATE, CANCEL_JOBS_DB
+from invoice.constants import INVOICE_AMOUNT_CHECK, IDEMPOTENCY_DB, SHARED_STATE_DB, WORKER_STALE_AFTER
 
 from invoice.api_requests import (
     CreateInvoiceRequest,
+    CreateInvoicesRequest,
+    buyer_identifier_error,
     QueryInvoicesRequest,
     CancelInvoicesRequest,
+    BulkCancelInvoicesRequest,
     InvoiceByPeriodRequest,
+    ReconcileRequest,
     InvoicePrintDetailsRequest,
     CompanyVATInfoRequest,
 )
 
-app = FastAPI(title="發票開立 API")
+async def run_background_jobs(shared=None):
+    """
+    Ledger sync and the takeover of interrupted bulk cancels and outbox jobs. With several
+    workers only the host's leader runs them; another worker steps in when it exits.
+    """
+    if shared is None:
+        await resume_bulk_cancels()
+        if LEDGER_DB and LEDGER_SYNC_INTERVAL > 0:
+            await run_ledger_sync(LEDGER_SYNC_INTERVAL)
+        return
+    await shared.wait_for_leadership()
+    sync_task = None
+    if LEDGER_DB and LEDGER_SYNC_INTERVAL > 0:
+        sync_task = asyncio.create_task(run_ledger_sync(LEDGER_SYNC_INTERVAL))
+    try:
+        while True:
+            try:
+                outbox = get_outbox()
+                if outbox is not None:
+                    await asyncio.to_thread(outbox.recover, WORKER_STALE_AFTER)
+                await resume_bulk_cancels(WORKER_STALE_AFTER)
+            except Exception as e:
+                logging.error(f"Takeover of stalled work failed: {e}")
+            await asyncio.sleep(WORKER_STALE_AFTER / 4)
+    finally:
+        if sync_task is not None:
+            sync_task.cancel()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_tenants()
+    # Caches and rate budgets shared by all worker processes on the host, when configured
+    shared = init_shared_state(SHARED_STATE_DB)
+    if shared is not None:
+        tenant_registry.share(shared)
+        ban_cache.share(shared, "ban")
+        print_cache.share(shared, "print")
+        status_cache.share(shared, "status")
+    # Pooled keep-alive clients to the invoice provider for the whole process
+    init_session()
+    init_async_client()
+    ban_cache.load(BAN_CACHE_FILE)
+    init_ledger(LEDGER_DB)
+    init_reconcile(RECONCILE_DB)
+    init_idempotency(IDEMPOTENCY_DB)
+    init_outbox(OUTBOX_DB, exclusive=shared is None)
+    init_cancel_store(CANCEL_JOBS_DB)
+    background = asyncio.create_task(run_background_jobs(shared))
+    yield
+    background.cancel()
+    await asyncio.gather(background, return_exceptions=True)
+    await close_cancel_store()
+    await close_outbox()
+    close_idempotency()
+    close_reconcile()
+    close_ledger()
+    ban_cache.dump(BAN_CACHE_FILE)
+    await close_async_client()
+    close_session()
+    close_shared_state()
+
+app = FastAPI(title="發票開立 API", lifespan=lifespan)
 
 # Middleware
 app.add_middleware(
@@ -37,44 +133,143 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*", "Authorization"],  # Important
 )
+# Outermost, so request latency includes the other middleware
+app.add_middleware(metrics.MetricsMiddleware)
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
     return JSONResponse(
         status_code=422,
-        content={"detail": exc.errors(), "body": exc.body}
+        # Errors raised by field validators carry the exception object in ctx
+        content=jsonable_encoder({"detail": exc.errors(), "body": exc.body}),
     )
 
-router = APIRouter(prefix="/api/v1")
+router = APIRouter(prefix="/api/v1", route_class=metrics.TimedRoute)
+
+def tenant_api_key(
+    authorization: Annotated[Optional[str], Header(alias="Authorization")] = None,
+    vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
+) -> str:
+    """Provider key for the request's VATID, checked against the tenant registry."""
+    try:
+        return tenant_registry.resolve_api_key(vatid, authorization)
+    except TenantError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
 
 @router.post("/create/invoice", summary="開立發票")
-def create_invoice_request(
-    authorization: Annotated[str, Header(alias="Authorization")] = INVOICE_API_TEST_KEY,
+async def create_invoice_request(
+    authorization: Annotated[str, Depends(tenant_api_key)],
     vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
     debug: Annotated[Literal["true", "false"], Header(alias="debug")] = 'false',
+    enqueue: Annotated[Literal["true", "false"], Header(alias="enqueue")] = OUTBOX_ENQUEUE,
+    client_key: Annotated[Optional[str], Header(alias="Idempotency-Key", max_length=255)] = None,
     req: CreateInvoiceRequest = Body(...),
 ):
+    """
+    Answers for the PowerBuilder client:
+
+    - 200, the invoice number as a JSON string: issued.
+    - 200, "1": not issued (debug: true returns the provider's answer instead).
+    - 202, {"queued": true, "order_id", "status_url"}: not issued yet but queued. That
+      happens with the enqueue: true header, when the circuit to the provider is open and
+      BREAKER_ENQUEUE_CREATE is set, or after an upstream error with OUTBOX_FALLBACK set.
+      Poll status_url for the invoice number. Only clients that check the status code should
+      enable the last two.
+    """
     # convert req to JSON
     invoice_data = req.dict()
-    response = create_full_invoice(invoice_data, authorization, vatid)
+    if INVOICE_AMOUNT_CHECK in ("log", "reject"):
+        # Inconsistent totals would only be refused by the provider after a round trip
+        errors = check_amounts(invoice_data)
+        if errors and INVOICE_AMOUNT_CHECK == "reject":
+            raise HTTPException(status_code=422, detail=errors)
+        if errors:
+            logging.warning(f"Amount check failed for {invoice_data.get('OrderId') or 'new order'}: {'；'.join(errors)}")
+    outbox = get_outbox()
+    # A retried request (same Idempotency-Key, or same body when IDEMPOTENCY_BODY_WINDOW is set) keeps its OrderId
+    key, ttl = idempotency_key(invoice_data, vatid, client_key)
+    if enqueue == "true" and outbox is not None and key:
+        try:
+            entry, _ = await asyncio.to_thread(get_idempotency().reserve, key, ttl, request_fingerprint(invoice_data))
+        except IdempotencyConflict as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        if entry["response"] is None:
+            # Answer once the order is on disk; the caller polls /queue/order/{order_id} for the invoice number
+            return queued_response(await asyncio.to_thread(outbox.enqueue, invoice_data, authorization, vatid, order_id=entry["order_id"]))
+        # Already answered under this key: replay that rather than queueing the order a second time
+        response = get_idempotency().replay(entry)
+    elif enqueue == "true" and outbox is not None:
+        return queued_response(await asyncio.to_thread(outbox.enqueue, invoice_data, authorization, vatid))
+    elif key:
+        try:
+            response = await get_idempotency().create(key, ttl, invoice_data, authorization, vatid)
+        except IdempotencyConflict as e:
+            raise HTTPException(status_code=422, detail=str(e))
+    else:
+        response = await create_full_invoice(invoice_data, authorization, vatid)
+    if response.get("circuit_open") and BREAKER_ENQUEUE_CREATE and outbox is not None:
+        # The provider is known to be down and nothing was sent, so queueing cannot double-issue
+        return queued_response(await asyncio.to_thread(outbox.enqueue, invoice_data, authorization, vatid, order_id=invoice_data["OrderId"]))
     if debug == "true":
         return response
     if "invoice_number" not in response or "error" in response:
+        if OUTBOX_FALLBACK and outbox is not None and "error" in response:
+            # Same OrderId as the failed attempt, so a request that did reach the provider is not issued twice
+            return queued_response(await asyncio.to_thread(outbox.enqueue, invoice_data, authorization, vatid, order_id=invoice_data["OrderId"]))
         return "1" if debug == 'false' else response
-    return response["invoice_number"]
+    return text_response(response["invoice_number"])
+
+@router.post("/create/invoices", summary="批次開立發票")
+async def create_invoices_request(
+    req: CreateInvoicesRequest,
+    authorization: Annotated[str, Depends(tenant_api_key)],
+    vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
+    debug: Annotated[Literal["true", "false"], Header(alias="debug")] = 'false',
+):
+    orders = [item.dict() for item in req]
+    problems = check_amounts_batch(orders) if INVOICE_AMOUNT_CHECK in ("log", "reject") else [[] for _ in orders]
+    if INVOICE_AMOUNT_CHECK == "log":
+        for index, errors in enumerate(problems):
+            if errors:
+                logging.warning(f"Amount check failed for batch order {index}: {'；'.join(errors)}")
+        problems = [[] for _ in orders]
+    for order, errors in zip(orders, problems):
+        error = buyer_identifier_error(order.get("BuyerIdentifier"))
+        if error:
+            errors.append(error)
+    # Only orders whose amounts add up and whose BAN is valid are sent; the others answer with their problems
+    responses = iter(await create_invoices([order for order, errors in zip(orders, problems) if not errors], authorization, vatid))
+    metrics.mark_shaping()
+    results = []
+    for index, errors in enumerate(problems):
+        if errors:
+            results.append({"index": index, "error": "；".join(errors), "status_code": 422})
+            continue
+        response = next(responses)
+        if "invoice_number" in response and "error" not in response:
+            results.append({"index": index, "invoice_number": response["invoice_number"]})
+        else:
+            results.append({
+                "index": index,
+                "error": str(response.get("error") or response.get("msg") or "Create failed"),
+                "status_code": response.get("status_code"),
+            })
+    failed = sum(1 for result in results if "error" in result)
+    return {"total": len(results), "success": len(results) - failed, "failed": failed, "results": results}
 
 
 
 @router.post("/get/invoices", summary="Search invoices")
-def get_inovices_request(
+async def get_inovices_request(
     req: QueryInvoicesRequest,
-    authorization: Annotated[str, Header(alias="Authorization")] = INVOICE_API_TEST_KEY,
+    authorization: Annotated[str, Depends(tenant_api_key)],
     vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
     debug: Annotated[Literal["true", "false"], Header(alias="debug")] = 'false',
+    local_first: Annotated[Literal["true", "false"], Header(alias="local-first")] = LEDGER_LOCAL_FIRST,
 ):
     # convert req to JSON
     invoice_numbers_json = [item.dict() for item in req]
-    response = get_invoice_status(invoice_numbers_json, authorization, vatid)
+    response = await get_invoice_status(invoice_numbers_json, authorization, vatid, local_first == "true")
     if debug == "true":
         return response
     if "error" in response:
@@ -84,32 +279,69 @@ def get_inovices_request(
         return "1"
     # preprocess into a "$date,$time,$invoice_id,$vat_id,$amount,$state,$carrier_id。$date,$time,$invoice_id,$vat_id,$amount,$state,$carrier_id" format
     # csv headless foramt but replace \n with '。'
-    return response
+    metrics.mark_shaping()
+    return json_response(response)
 
 @router.post("/cancel/invoices", summary="Cancel multiple invoices")
-def cancel_invoices_request(
+async def cancel_invoices_request(
     req: CancelInvoicesRequest,
-    authorization: Annotated[str, Header(alias="Authorization")] = INVOICE_API_TEST_KEY,
+    authorization: Annotated[str, Depends(tenant_api_key)],
     vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
     debug: Annotated[Literal["true", "false"], Header(alias="debug")] = 'false',
 ):
     # convert req to JSON
     cancel_invoice_numbers_json = [item.dict() for item in req]
-    response = cancel_invoices(cancel_invoice_numbers_json, authorization, vatid)
+    response = await cancel_invoices(cancel_invoice_numbers_json, authorization, vatid)
     if "error" in response:
         raise HTTPException(status_code=response.get("status_code", 500), detail=response["error"])
-    return response
+    return json_response(response)
+
+@router.post("/cancel/invoices/bulk", summary="批次作廢發票（分批並行，逐張回報結果）")
+async def bulk_cancel_invoices_request(
+    req: BulkCancelInvoicesRequest,
+    authorization: Annotated[str, Depends(tenant_api_key)],
+    vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
+    job_id: Annotated[Optional[str], Header(alias="job-id")] = None,
+    wait: Annotated[Literal["true", "false"], Header(alias="wait")] = "true",
+):
+    if wait == "false" and get_cancel_store() is None:
+        raise HTTPException(status_code=400, detail="wait=false needs CANCEL_JOBS_DB to keep the job's progress")
+    # Re-sending the same job-id resumes the job from its checkpoint
+    job_id = job_id or new_job_id()
+    try:
+        await asyncio.to_thread(check_job, job_id, authorization, vatid)
+        task = start_bulk_cancel([item.CancelInvoiceNumber for item in req], authorization, vatid, job_id)
+    except CancelJobConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if wait == "false":
+        # Poll /cancel/jobs/{job_id} for progress
+        return {"job_id": job_id, "status": "running"}
+    # Shielded: a client that hangs up does not stop the job half way
+    return json_response(await asyncio.shield(task))
+
+@router.get("/cancel/jobs/{job_id}", summary="查詢批次作廢進度與逐張結果")
+async def get_bulk_cancel_job(
+    job_id: str,
+    authorization: Annotated[str, Depends(tenant_api_key)],
+    vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
+):
+    # Another tenant's job answers as if it did not exist
+    status = await asyncio.to_thread(job_status, job_id, authorization, vatid)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Cancel job not found")
+    return json_response(status)
 
 @router.post("/get/invoice/period", summary="發票列表/發票的主檔資料")
-def get_invoice_by_period_request(
-    authorization: Annotated[str, Header(alias="Authorization")] = INVOICE_API_TEST_KEY,
+async def get_invoice_by_period_request(
+    authorization: Annotated[str, Depends(tenant_api_key)],
     vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
     req: InvoiceByPeriodRequest = Body(...),
     debug: Annotated[Literal["true", "false"], Header(alias="debug")] = 'false',
+    local_first: Annotated[Literal["true", "false"], Header(alias="local-first")] = LEDGER_LOCAL_FIRST,
 ):
     # convert req to JSON
     invoice_data = req.dict()
-    response = get_invoice_status_by_period(invoice_data, authorization, vatid)
+    response = await get_invoice_status_by_period(invoice_data, authorization, vatid, local_first == "true")
     if debug == 'true':
         return response
     if "error" in response:
@@ -119,40 +351,93 @@ def get_invoice_by_period_request(
     if "data" not in response:
         print(response)
         return "2"
-    ret_data = []
-    for item in response["data"]:
-        ret_data.append(
-            f"{item['invoice_date']},{item['invoice_time']},{item['invoice_number']},{item['buyer_identifier']},{item['total_amount']},{item['invoice_type']},{item['invoice_status']},{item['carrier_id1']}"
-        )
-    return "。".join(ret_data)
+    metrics.mark_shaping()
+    return period_response(response["data"])
     # return response
 
+@router.post("/get/invoice/period/export", summary="匯出日期區間內所有發票（自動分頁串流）")
+async def export_invoice_by_period_request(
+    authorization: Annotated[str, Depends(tenant_api_key)],
+    vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
+    req: InvoiceByPeriodRequest = Body(...),
+    fmt: Annotated[Literal["csv", "ndjson"], Query(alias="format")] = "csv",
+):
+    invoice_data = req.dict()
+    invoice_data["limit"] = PERIOD_EXPORT_PAGE_SIZE
+    pages = iter_invoice_pages(invoice_data, authorization, vatid)
+    # Check the first page before committing to a 200 streaming response
+    first_page = await anext(pages)
+    if "error" in first_page:
+        await pages.aclose()
+        return "1"
+    if "data" not in first_page:
+        await pages.aclose()
+        return "2"
+
+    async def stream():
+        separator = ""
+        async for page in _chain_pages(first_page, pages):
+            if "error" in page or "data" not in page:
+                # Headers are already sent; stop the stream where it is and leave a trace of why
+                logging.getLogger(__name__).error(
+                    f"Period export cut short: {page.get('error') or page.get('msg') or 'no data'} (status {page.get('status_code', page.get('code'))})"
+                )
+                return
+            if not page["data"]:
+                continue
+            # One chunk per page keeps memory bounded by the page size
+            if fmt == "ndjson":
+                yield "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in page["data"])
+            else:
+                yield separator + "。".join(format_period_rows(page["data"]))
+                separator = "。"
+
+    media_type = "application/x-ndjson" if fmt == "ndjson" else "text/plain; charset=utf-8"
+    return StreamingResponse(stream(), media_type=media_type)
+
+async def _chain_pages(first_page: dict, pages):
+    yield first_page
+    async for page in pages:
+        yield page
+
+@router.post("/reconcile", summary="對帳：已開立訂單與發票列表比對（增量）")
+async def reconcile_request(
+    authorization: Annotated[str, Depends(tenant_api_key)],
+    vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
+    req: ReconcileRequest = Body(...),
+):
+    response = await reconcile(req.date_start, req.date_end, authorization, vatid, req.full)
+    if "error" in response:
+        raise HTTPException(status_code=response.get("status_code", 500), detail=response["error"])
+    metrics.mark_shaping()
+    return json_response(response)
+
 @router.post("/print/invoice", summary="發票/發票列印")
-def get_print_invoice_data(
-    authorization: Annotated[str, Header(alias="Authorization")] = INVOICE_API_TEST_KEY,
+async def get_print_invoice_data(
+    authorization: Annotated[str, Depends(tenant_api_key)],
     vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
     req: InvoicePrintDetailsRequest = Body(...),
     debug: Annotated[Literal["true", "false"], Header(alias="debug")] = 'false',
 ):
     # convert req to JSON
     invoice_data = req.dict()
-    response = get_print_invoice(invoice_data, authorization, vatid)
+    response = await get_print_invoice(invoice_data, authorization, vatid)
 
-    if debug == "true":
+    if debug == "true" or "error" in response:
         return response
 
-    return response
+    return json_response(response)
 
-@router.post("company/vat/info", summary="查詢統一編號對應的公司名稱")
-def get_info_from_vatid(
-    authorization: Annotated[str, Header(alias="Authorization")] = INVOICE_API_TEST_KEY,
+@router.post("/company/vat/info", summary="查詢統一編號對應的公司名稱")
+async def get_info_from_vatid(
+    authorization: Annotated[str, Depends(tenant_api_key)],
     vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
     req: CompanyVATInfoRequest = Body(...),
     debug: Annotated[Literal["true", "false"], Header(alias="debug")] = 'false',
 ):
     # convert req to JSON
     data_in_json = [item.dict() for item in req]
-    response = get_company_vat_info(data_in_json, authorization, vatid)
+    response = await get_company_vat_info(data_in_json, authorization, vatid)
     if debug == 'true':
         return response
     if "error" in response:
@@ -160,5 +445,61 @@ def get_info_from_vatid(
     # check response['data'][0] exist then return the data['name']
     if "data" not in response or len(response["data"]) == 0:
         return "0018"
-    return response["data"][0]["name"]
-app.include_router(router)
\ No newline at end of file
+    return text_response(response["data"][0]["name"])
+
+@router.get("/queue/status", summary="離線開立佇列狀態")
+async def get_queue_status():
+    outbox = get_outbox()
+    if outbox is None:
+        raise HTTPException(status_code=404, detail="Outbox is disabled")
+    return await asyncio.to_thread(outbox.stats)
+
+@router.get("/queue/order/{order_id}", summary="查詢佇列中訂單的開立結果")
+async def get_queued_order(
+    order_id: str,
+    authorization: Annotated[str, Depends(tenant_api_key)],
+    vatid: Annotated[str, Header(alias="VATID")] = INVOICE_API_TAX_ID,
+):
+    outbox = get_outbox()
+    # Another tenant's order answers as if it was never queued
+    job = await asyncio.to_thread(outbox.get, order_id, authorization, vatid) if outbox is not None else None
+    if job is None:
+        raise HTTPException(status_code=404, detail="Order not found in queue")
+    return job
+
+@router.get("/coalescing/stats", summary="重複查詢合併統計")
+async def get_coalescing_stats():
+    stats = {flight.name: flight.stats() for flight in (status_flight, print_flight, ban_flight)}
+    stats["invoice_status_batching"] = status_batcher.stats()
+    stats["idempotent_create"] = get_idempotency().stats()
+    return stats
+
+@router.get("/upstream/breakers", summary="上游 API 斷路器狀態")
+async def get_upstream_breakers():
+    return breaker_status()
+
+@router.get("/tenants/status", summary="各店家（VATID）流量與連線配額")
+async def get_tenants_status():
+    return {"pool": get_semaphore().stats(), "tenants": tenant_registry.status(get_semaphore())}
+
+@router.get("/workers/shared", summary="多程序共用快取與配額狀態")
+async def get_shared_state_stats():
+    shared = get_shared_state()
+    if shared is None:
+        return {"enabled": False, "pid": os.getpid()}
+    return dict(await asyncio.to_thread(shared.stats), enabled=True)
+
+@router.get("/print/cache", summary="列印資料快取命中統計")
+async def get_print_cache_stats():
+    # Counting a shared cache's entries reads SQLite
+    return await asyncio.to_thread(print_cache.stats)
+
+@router.get("/company/vat/cache", summary="統一編號快取命中統計")
+async def get_vat_cache_stats():
+    return await asyncio.to_thread(ban_cache.stats)
+
+@app.get("/metrics", summary="Prometheus 監控指標", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+app.include_router(router)
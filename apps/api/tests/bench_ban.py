@@ -0,0 +1,21 @@
+# tests/bench_ban.py
+"""
+Micro-benchmark of the BAN check: python -m tests.bench_ban from apps/api.
+Compares the lookup-table check against the digit-by-digit reference the tests use.
+"""
+
+import random
+import timeit
+
+from invoice.ban import is_valid_ban
+from tests.test_ban import reference_is_valid_ban
+
+def main(count: int = 100_000, repeat: int = 5):
+    rng = random.Random(0)
+    bans = [f"{rng.randrange(10 ** 8):08d}" for _ in range(count)]
+    for name, check in (("table", is_valid_ban), ("reference", reference_is_valid_ban)):
+        best = min(timeit.repeat(lambda: [check(ban) for ban in bans], number=1, repeat=repeat))
+        print(f"{name:>10}: {best / count * 1e9:8.1f} ns/BAN ({count} BANs, best of {repeat})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+# tests/bench_escpos.py
+"""
+Micro-benchmark of the local print render: python -m tests.bench_escpos from apps/api.
+Reports renders/sec of render_invoice for each print-out the snapshot tests cover.
+"""
+
+import timeit
+
+from invoice.escpos import PRINTER_TYPE_DETAILS, PRINTER_TYPE_ORIGINAL, PRINTER_TYPE_REPRINT
+from tests.test_escpos import render
+
+def main(count: int = 2_000, repeat: int = 5):
+    for name, printer_type in (
+        ("reprint", PRINTER_TYPE_REPRINT),
+        ("original", PRINTER_TYPE_ORIGINAL),
+        ("details", PRINTER_TYPE_DETAILS),
+    ):
+        best = min(timeit.repeat(lambda: render(printer_type=printer_type), number=count, repeat=repeat))
+        print(f"{name:>10}: {count / best:10.0f} renders/sec ({best / count * 1e6:7.1f} us/render, best of {repeat})")
+
+if __name__ == "__main__":
+    main()
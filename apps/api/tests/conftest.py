@@ -0,0 +1,67 @@
+# tests/conftest.py
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+# The tests import the app's modules the way main.py does, from apps/api
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK_DIR = os.path.join(os.path.dirname(API_DIR), "mock")
+sys.path.insert(0, API_DIR)
+
+class AmegoMock:
+    """apps/mock/amego_mock.py running in a subprocess, so timeouts and hangs are real."""
+
+    def __init__(self, url: str):
+        self.url = url
+
+    def configure(self, **faults):
+        import httpx
+        return httpx.post(f"{self.url}/_mock/config", json=faults, timeout=5).json()
+
+    def calls(self, uri: str) -> int:
+        import httpx
+        return httpx.get(f"{self.url}/_mock/stats", timeout=5).json()["calls"].get(uri, 0)
+
+@pytest.fixture(scope="session")
+def amego_mock_server():
+    pytest.importorskip("uvicorn")
+    httpx = pytest.importorskip("httpx")
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "amego_mock:app", "--port", str(port), "--log-level", "warning"],
+        cwd=MOCK_DIR,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                httpx.get(f"{url}/_mock/stats", timeout=1)
+                break
+            except httpx.HTTPError:
+                if time.time() > deadline:
+                    raise RuntimeError("amego_mock did not come up")
+                time.sleep(0.2)
+        yield AmegoMock(url)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            # Graceful shutdown waits for requests the tests left hanging
+            process.kill()
+            process.wait()
+
+@pytest.fixture
+def amego_mock(amego_mock_server):
+    """The mock with its faults reset before and after the test."""
+    amego_mock_server.configure(reset=True)
+    yield amego_mock_server
+    amego_mock_server.configure(reset=True)
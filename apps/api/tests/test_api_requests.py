@@ -0,0 +1,30 @@
+# tests/test_api_requests.py
+
+import pytest
+from pydantic import TypeAdapter, ValidationError
+
+from invoice.api_requests import BUYER_IDENTIFIER_ERROR, CreateInvoiceRequest, CreateInvoicesRequest, buyer_identifier_error
+
+ORDER = {
+    "ProductItem": [{"Description": "測試商品", "Quantity": "1", "UnitPrice": "100", "Amount": "100", "Remark": "", "TaxType": "1"}],
+    "SalesAmount": "100",
+    "FreeTaxSalesAmount": "0",
+    "ZeroTaxSalesAmount": "0",
+    "TaxType": "1",
+    "TaxRate": "0.05",
+    "TaxAmount": "0",
+    "TotalAmount": "100",
+}
+
+@pytest.mark.parametrize("value, error", [(None, None), ("0000000000", None), ("04595257", None), ("04595258", BUYER_IDENTIFIER_ERROR), ("", BUYER_IDENTIFIER_ERROR)])
+def test_buyer_identifier_error(value, error):
+    assert buyer_identifier_error(value) == error
+
+def test_single_create_rejects_a_bad_ban():
+    assert CreateInvoiceRequest(**ORDER).BuyerIdentifier == "0000000000"
+    with pytest.raises(ValidationError):
+        CreateInvoiceRequest(**dict(ORDER, BuyerIdentifier="04595258"))
+
+def test_batch_accepts_a_bad_ban_for_per_order_reporting():
+    orders = TypeAdapter(CreateInvoicesRequest).validate_python([ORDER, dict(ORDER, BuyerIdentifier="04595258")])
+    assert [buyer_identifier_error(order.BuyerIdentifier) for order in orders] == [None, BUYER_IDENTIFIER_ERROR]
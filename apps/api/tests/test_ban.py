@@ -0,0 +1,78 @@
+# tests/test_ban.py
+
+import itertools
+
+import pytest
+
+from invoice.ban import BAN_WEIGHTS, NO_BAN, _CONTRIBUTIONS, is_valid_ban, is_valid_buyer_identifier, validate_bans
+
+def reference_is_valid_ban(ban: str, legacy: bool = False) -> bool:
+    """The Ministry of Finance rule written out digit by digit, to check the table against."""
+    if len(ban) != 8 or not all(ch in "0123456789" for ch in ban):
+        return False
+    divisor = 10 if legacy else 5
+    total = 0
+    for digit, weight in zip(ban, BAN_WEIGHTS):
+        product = int(digit) * weight
+        total += sum(int(ch) for ch in str(product))
+    if total % divisor == 0:
+        return True
+    # 7 * 4 = 28 -> 2 + 8 = 10 -> 1 + 0 = 1, or 0 when the last carry is dropped
+    return ban[6] == "7" and (total + 1) % divisor == 0
+
+def test_contribution_table_is_exhaustive():
+    assert len(_CONTRIBUTIONS) == 8
+    for position, weight in enumerate(BAN_WEIGHTS):
+        assert set(_CONTRIBUTIONS[position]) == set("0123456789")
+        for digit in range(10):
+            product = digit * weight
+            assert _CONTRIBUTIONS[position][str(digit)] == sum(int(ch) for ch in str(product))
+
+@pytest.mark.parametrize("legacy", [False, True])
+@pytest.mark.parametrize("position", range(8))
+def test_every_digit_in_every_position(position, legacy):
+    # Vary one position over 0-9 against several fixed backgrounds, including 7 in the 7th digit
+    for background in ("00000000", "12345678", "99999999", "04595257", "10458575", "77777777"):
+        for digit in "0123456789":
+            ban = background[:position] + digit + background[position + 1:]
+            assert is_valid_ban(ban, legacy) == reference_is_valid_ban(ban, legacy), ban
+
+@pytest.mark.parametrize("legacy", [False, True])
+def test_all_check_digits_over_prefix_grid(legacy):
+    # Every combination of the 7th and 8th digits (the rule's special cases) over a grid of prefixes
+    for prefix in itertools.product("079", repeat=6):
+        head = "".join(prefix)
+        for tail in itertools.product("0123456789", repeat=2):
+            ban = head + "".join(tail)
+            assert is_valid_ban(ban, legacy) == reference_is_valid_ban(ban, legacy), ban
+
+@pytest.mark.parametrize("ban", ["04595257", "10458575", "22099131", "53212539"])
+def test_known_valid_bans(ban):
+    assert is_valid_ban(ban)
+
+def test_seventh_digit_seven():
+    # 10458575 only passes when the 7th digit's 10 is counted as 1
+    assert reference_is_valid_ban("10458575")
+    assert is_valid_ban("10458575")
+    # The same totals without a 7 in the 7th digit do not get the extra chance
+    assert not is_valid_ban("10458565")
+
+def test_divisor_five_is_looser_than_legacy():
+    # Total 15: divisible by 5, not by 10
+    assert is_valid_ban("12345601")
+    assert not is_valid_ban("12345601", legacy=True)
+    assert is_valid_ban("04595257", legacy=True)
+
+@pytest.mark.parametrize("ban", ["", "1234567", "123456789", "1234567a", "１２３４５６７８", "-1234567", " 0459525"])
+def test_malformed(ban):
+    assert not is_valid_ban(ban)
+    assert not is_valid_ban(ban, legacy=True)
+
+def test_validate_bans():
+    assert validate_bans(["04595257", "04595258", ""]) == [True, False, False]
+
+def test_buyer_identifier_accepts_no_ban():
+    assert is_valid_buyer_identifier(NO_BAN)
+    assert is_valid_buyer_identifier("04595257")
+    assert not is_valid_buyer_identifier("000000000")
+    assert not is_valid_buyer_identifier("04595258")
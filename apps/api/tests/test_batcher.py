@@ -0,0 +1,64 @@
+# tests/test_batcher.py
+
+import asyncio
+import gc
+
+from invoice.batcher import StatusBatcher
+
+class FakeStatus:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, items, api_key=None, vatid=None):
+        numbers = [item["InvoiceNumber"] for item in items]
+        self.calls.append(numbers)
+        await asyncio.sleep(0)
+        if any(not number.startswith("AB") for number in numbers):
+            return {"code": 1004, "msg": "invoice number format error"}
+        return {"code": 0, "msg": "", "data": [{"invoice_number": number, "invoice_type": "C0401", "invoice_status": 99} for number in numbers]}
+
+def test_lookups_in_one_window_share_a_call():
+    send = FakeStatus()
+    batcher = StatusBatcher(send, window=0.01, max_items=100)
+
+    async def run():
+        return await asyncio.gather(*(batcher.lookup([f"AB0000000{i}"]) for i in range(5)))
+
+    responses = asyncio.run(run())
+    assert len(send.calls) == 1
+    assert [response["data"][0]["invoice_number"] for response in responses] == [f"AB0000000{i}" for i in range(5)]
+
+def test_one_malformed_number_only_fails_its_caller():
+    send = FakeStatus()
+    batcher = StatusBatcher(send, window=0.01, max_items=100)
+
+    async def run():
+        return await asyncio.gather(
+            batcher.lookup(["AB00000001"]),
+            batcher.lookup(["not-a-number"]),
+            batcher.lookup(["AB00000002", "AB00000003"]),
+        )
+
+    good, bad, other = asyncio.run(run())
+    assert good["code"] == 0 and [row["invoice_number"] for row in good["data"]] == ["AB00000001"]
+    assert bad["code"] == 1004
+    assert other["code"] == 0 and len(other["data"]) == 2
+    # The merged call, then one call per caller
+    assert len(send.calls) == 4
+    assert batcher.stats()["split_batches"] == 1
+
+def test_flushed_batch_survives_garbage_collection():
+    send = FakeStatus()
+    batcher = StatusBatcher(send, window=0.01, max_items=1)
+
+    async def run():
+        lookup = asyncio.ensure_future(batcher.lookup(["AB00000001"]))
+        await asyncio.sleep(0)
+        gc.collect()
+        assert len(batcher._tasks) == 1
+        response = await lookup
+        await asyncio.sleep(0)
+        return response
+
+    assert asyncio.run(run())["code"] == 0
+    assert not batcher._tasks
@@ -0,0 +1,113 @@
+# tests/test_breaker.py
+
+import asyncio
+import time
+
+import pytest
+
+from invoice import breaker as breaker_module
+from invoice.breaker import CLOSED, MIN_LATENCY_SAMPLES, OPEN, get_breaker
+from invoice.client import close_async_client, get_timeout, init_async_client
+from invoice.constants import (
+    BREAKER_FAILURE_THRESHOLD,
+    CREATE_INVOICE_URI,
+    INVOICE_API_READ_TIMEOUTS,
+    INVOICE_API_TAX_ID,
+    STATUS_INVOICE_URI,
+)
+from invoice.utils import create_package, send_request_async
+
+ORDER = {
+    "OrderId": "",
+    "BuyerIdentifier": "0000000000",
+    "ProductItem": [{"Description": "測試商品", "Quantity": "1", "UnitPrice": "100", "Amount": "100", "Remark": "", "TaxType": "1"}],
+    "SalesAmount": "100",
+    "FreeTaxSalesAmount": "0",
+    "ZeroTaxSalesAmount": "0",
+    "TaxType": "1",
+    "TaxRate": "0.05",
+    "TaxAmount": "0",
+    "TotalAmount": "100",
+}
+
+@pytest.fixture(autouse=True)
+def fresh_breakers(monkeypatch):
+    monkeypatch.setattr(breaker_module, "_breakers", {})
+    monkeypatch.setattr(breaker_module, "BREAKER_RESET_TIMEOUT", 0.5)
+    monkeypatch.setattr(breaker_module, "BREAKER_TIMEOUT_MIN", 0.3)
+
+def run(coroutine_function):
+    async def with_client():
+        init_async_client()
+        try:
+            return await coroutine_function()
+        finally:
+            await close_async_client()
+    return asyncio.run(with_client())
+
+async def status_call(mock) -> dict:
+    package = create_package(int(time.time()), [{"InvoiceNumber": "AB00000001"}], None, INVOICE_API_TAX_ID)
+    return await send_request_async(mock.url + STATUS_INVOICE_URI, package, INVOICE_API_TAX_ID)
+
+async def create_call(mock, index: int) -> dict:
+    package = create_package(int(time.time()), dict(ORDER, OrderId=f"BREAKER{time.time_ns()}{index}"), None, INVOICE_API_TAX_ID)
+    return await send_request_async(mock.url + CREATE_INVOICE_URI, package, INVOICE_API_TAX_ID)
+
+def test_failures_open_the_circuit(amego_mock):
+    amego_mock.configure(endpoints={STATUS_INVOICE_URI: {"error_rate": 1}})
+    before = amego_mock.calls(STATUS_INVOICE_URI)
+
+    async def calls():
+        return [await status_call(amego_mock) for _ in range(BREAKER_FAILURE_THRESHOLD + 3)]
+
+    responses = run(calls)
+    assert all("error" in response for response in responses)
+    assert [response.get("circuit_open", False) for response in responses[BREAKER_FAILURE_THRESHOLD:]] == [True] * 3
+    # Calls after the trip fail fast without reaching the provider
+    assert amego_mock.calls(STATUS_INVOICE_URI) - before == BREAKER_FAILURE_THRESHOLD
+    assert get_breaker(STATUS_INVOICE_URI).state == OPEN
+
+def test_probe_closes_the_circuit_once_the_provider_recovers(amego_mock):
+    amego_mock.configure(endpoints={STATUS_INVOICE_URI: {"error_rate": 1}})
+
+    async def calls():
+        for _ in range(BREAKER_FAILURE_THRESHOLD):
+            await status_call(amego_mock)
+        amego_mock.configure(reset=True)
+        rejected = await status_call(amego_mock)
+        await asyncio.sleep(0.6)
+        return rejected, await status_call(amego_mock)
+
+    rejected, probe = run(calls)
+    assert rejected.get("circuit_open")
+    assert probe.get("code") == 0
+    assert get_breaker(STATUS_INVOICE_URI).state == CLOSED
+
+def test_adaptive_timeout_cuts_a_hanging_lookup(amego_mock):
+    async def calls():
+        for _ in range(MIN_LATENCY_SAMPLES + 5):
+            assert (await status_call(amego_mock)).get("code") == 0
+        amego_mock.configure(endpoints={STATUS_INVOICE_URI: {"hang_rate": 1}})
+        started = time.monotonic()
+        response = await status_call(amego_mock)
+        return response, time.monotonic() - started
+
+    response, elapsed = run(calls)
+    assert "error" in response
+    # Cut at the adaptive floor instead of the configured 5s
+    assert elapsed < INVOICE_API_READ_TIMEOUTS[STATUS_INVOICE_URI] / 2
+
+def test_create_keeps_the_configured_timeout(amego_mock):
+    async def calls():
+        for index in range(MIN_LATENCY_SAMPLES + 5):
+            assert (await create_call(amego_mock, index)).get("code") == 0
+        breaker = get_breaker(CREATE_INVOICE_URI)
+        # The history alone would allow 0.3s; a create slower than that must still complete
+        assert breaker.read_timeout(INVOICE_API_READ_TIMEOUTS[CREATE_INVOICE_URI]) < 1
+        timeout = get_timeout(amego_mock.url + CREATE_INVOICE_URI, breaker)[1]
+        amego_mock.configure(endpoints={CREATE_INVOICE_URI: {"latency": 1}})
+        return timeout, await create_call(amego_mock, -1)
+
+    timeout, response = run(calls)
+    assert timeout == INVOICE_API_READ_TIMEOUTS[CREATE_INVOICE_URI]
+    assert response.get("code") == 0 and response.get("invoice_number")
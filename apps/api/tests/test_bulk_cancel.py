@@ -0,0 +1,98 @@
+# tests/test_bulk_cancel.py
+
+import asyncio
+import os
+
+import pytest
+
+from invoice import bulk_cancel as bulk_cancel_module
+from invoice.bulk_cancel import CANCELLED, FAILED, CancelJobConflict, bulk_cancel, check_job, job_status
+
+NUMBERS = [f"AB{n:08d}" for n in range(100)]
+
+class FakeF0501:
+    """f0501 that refuses a whole package when it holds a bad number, or refuses everything."""
+
+    def __init__(self, bad=(), refuse_all: int = None):
+        self.bad = set(bad)
+        self.refuse_all = refuse_all
+        self.calls = 0
+
+    async def __call__(self, items, api_key=None, vatid=None):
+        self.calls += 1
+        if self.refuse_all:
+            return {"code": self.refuse_all, "msg": "sign error"}
+        bad = [item["CancelInvoiceNumber"] for item in items if item["CancelInvoiceNumber"] in self.bad]
+        if bad:
+            return {"code": 1005, "msg": f"invoice not found: {','.join(bad)}"}
+        return {"code": 0, "msg": ""}
+
+@pytest.fixture
+def f0501(monkeypatch):
+    def install(**kwargs):
+        fake = FakeF0501(**kwargs)
+        monkeypatch.setattr(bulk_cancel_module, "cancel_invoices", fake)
+        return fake
+
+    async def nothing_cancelled(items, api_key=None, vatid=None):
+        return {"code": 0, "data": []}
+
+    monkeypatch.setattr(bulk_cancel_module, "send_invoice_status", nothing_cancelled)
+    monkeypatch.setattr(bulk_cancel_module, "_store", None)
+    return install
+
+def test_one_bad_number_is_isolated(f0501):
+    fake = f0501(bad={"AB00000042"})
+    summary = asyncio.run(bulk_cancel(NUMBERS, chunk_size=100))
+    assert summary["failed"] == 1 and summary["cancelled"] == 99
+    assert summary["results"]["AB00000042"]["status"] == FAILED
+    # One call for the chunk, then two per level down to the single number
+    assert fake.calls <= 1 + 2 * 7
+
+def test_error_about_the_request_is_not_halved(f0501):
+    fake = f0501(refuse_all=1001)
+    summary = asyncio.run(bulk_cancel(NUMBERS, chunk_size=100))
+    assert summary["failed"] == 100
+    # The chunk and its two halves, not 2n - 1
+    assert fake.calls == 3
+
+def test_split_codes_isolate_bad_numbers_in_both_halves(f0501, monkeypatch):
+    fake = f0501(bad={"AB00000010", "AB00000090"})
+    summary = asyncio.run(bulk_cancel(NUMBERS, chunk_size=100))
+    # Without knowing 1005 names a number, both halves refused alike look like a request error
+    assert summary["failed"] == 100
+
+    monkeypatch.setattr(bulk_cancel_module, "CANCEL_SPLIT_CODES", {1005})
+    summary = asyncio.run(bulk_cancel(NUMBERS, chunk_size=100))
+    assert summary["failed"] == 2 and summary["cancelled"] == 98
+    assert {n for n, outcome in summary["results"].items() if outcome["status"] == FAILED} == {"AB00000010", "AB00000090"}
+
+def test_jobs_are_scoped_to_their_caller(tmp_path, f0501, monkeypatch):
+    f0501()
+    store = bulk_cancel_module.CancelJobStore(os.path.join(tmp_path, "cancel.db"))
+    monkeypatch.setattr(bulk_cancel_module, "_store", store)
+    summary = asyncio.run(bulk_cancel(NUMBERS[:3], "key-a", "12345678", job_id="JOB1"))
+    assert summary["cancelled"] == 3
+
+    assert job_status("JOB1", "key-a", "12345678")["cancelled"] == 3
+    assert job_status("JOB1", "key-b", "12345678") is None
+    assert job_status("JOB1", "key-a", "87654321") is None
+
+    check_job("JOB1", "key-a", "12345678")
+    with pytest.raises(CancelJobConflict):
+        check_job("JOB1", "key-b", "87654321")
+    store.close()
+
+def test_running_job_is_not_started_again(f0501):
+    f0501()
+
+    async def run():
+        task = bulk_cancel_module.start_bulk_cancel(NUMBERS[:3], job_id="JOB2")
+        with pytest.raises(CancelJobConflict):
+            bulk_cancel_module.start_bulk_cancel(NUMBERS[3:6], job_id="JOB2")
+        with pytest.raises(CancelJobConflict):
+            check_job("JOB2")
+        return await task
+
+    assert asyncio.run(run())["cancelled"] == 3
+    assert all(outcome["status"] == CANCELLED for outcome in asyncio.run(bulk_cancel(NUMBERS[:3]))["results"].values())
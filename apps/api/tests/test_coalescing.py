@@ -0,0 +1,111 @@
+# tests/test_coalescing.py
+
+import asyncio
+import time
+
+import pytest
+
+from invoice import search
+from invoice.cache import TTLCache
+from invoice.client import close_async_client, init_async_client
+from invoice.constants import (
+    CREATE_INVOICE_URI,
+    GET_COMPANY_VAT_INFO_URI,
+    GET_INVOICE_PRINT_URI,
+    INVOICE_API_KEY,
+    INVOICE_API_TAX_ID,
+    STATUS_INVOICE_URI,
+)
+from invoice.singleflight import SingleFlight
+from invoice.utils import create_package, send_request_async
+
+CONCURRENT = 50
+
+ORDER = {
+    "OrderId": "",
+    "BuyerIdentifier": "0000000000",
+    "ProductItem": [{"Description": "測試商品", "Quantity": "1", "UnitPrice": "100", "Amount": "100", "Remark": "", "TaxType": "1"}],
+    "SalesAmount": "100",
+    "FreeTaxSalesAmount": "0",
+    "ZeroTaxSalesAmount": "0",
+    "TaxType": "1",
+    "TaxRate": "0.05",
+    "TaxAmount": "0",
+    "TotalAmount": "100",
+}
+
+@pytest.fixture
+def mock(amego_mock, monkeypatch):
+    # Slow enough that every lookup arrives while the first one is in flight
+    amego_mock.configure(latency=0.3)
+    monkeypatch.setattr(search, "INVOICE_API_BASE_URL", amego_mock.url)
+    monkeypatch.setattr(search, "STATUS_BATCH_WINDOW", 0)
+    monkeypatch.setattr(search, "STATUS_CACHE_TTL", 0)
+    monkeypatch.setattr(search, "LOCAL_PRINT_RENDER", False)
+    monkeypatch.setattr(search, "print_cache", TTLCache(maxsize=100, ttl=60))
+    monkeypatch.setattr(search, "ban_cache", TTLCache(maxsize=100, ttl=60))
+    for name in ("status_flight", "print_flight", "ban_flight"):
+        monkeypatch.setattr(search, name, SingleFlight(name))
+    return amego_mock
+
+def run(coroutine_function):
+    async def with_client():
+        init_async_client()
+        try:
+            return await coroutine_function()
+        finally:
+            await close_async_client()
+    return asyncio.run(with_client())
+
+def concurrently(make_lookups):
+    async def lookups():
+        return await asyncio.gather(*make_lookups())
+    return run(lookups)
+
+def issue_invoice(mock) -> str:
+    order = dict(ORDER, OrderId=f"COALESCE{time.time_ns()}")
+
+    async def create():
+        package = create_package(int(time.time()), order, None, INVOICE_API_TAX_ID)
+        return await send_request_async(mock.url + CREATE_INVOICE_URI, package, INVOICE_API_TAX_ID)
+
+    return run(create)["invoice_number"]
+
+def test_identical_status_lookups_make_one_upstream_call(mock):
+    number = issue_invoice(mock)
+    before = mock.calls(STATUS_INVOICE_URI)
+    responses = concurrently(lambda: [
+        search.get_invoice_status([{"InvoiceNumber": number}], INVOICE_API_KEY, INVOICE_API_TAX_ID) for _ in range(CONCURRENT)
+    ])
+    assert all(response["data"][0]["invoice_number"] == number for response in responses)
+    assert mock.calls(STATUS_INVOICE_URI) - before == 1
+    assert search.status_flight.stats()["coalesced"] == CONCURRENT - 1
+
+def test_identical_print_lookups_make_one_upstream_call(mock):
+    number = issue_invoice(mock)
+    before = mock.calls(GET_INVOICE_PRINT_URI)
+    data = {"type": "invoice", "invoice_number": number, "printer_type": 2, "print_invoice_type": 1}
+    responses = concurrently(lambda: [
+        search.get_print_invoice(dict(data), INVOICE_API_KEY, INVOICE_API_TAX_ID) for _ in range(CONCURRENT)
+    ])
+    assert all(response["data"]["base64_data"] for response in responses)
+    assert mock.calls(GET_INVOICE_PRINT_URI) - before == 1
+
+def test_identical_ban_lookups_make_one_upstream_call(mock):
+    before = mock.calls(GET_COMPANY_VAT_INFO_URI)
+    responses = concurrently(lambda: [
+        search.get_company_vat_info([{"ban": "04595257"}], INVOICE_API_KEY, INVOICE_API_TAX_ID) for _ in range(CONCURRENT)
+    ])
+    assert all(response["code"] == 0 for response in responses)
+    assert mock.calls(GET_COMPANY_VAT_INFO_URI) - before == 1
+
+def test_lookups_with_other_credentials_are_not_shared(mock):
+    number = issue_invoice(mock)
+    before = mock.calls(STATUS_INVOICE_URI)
+    responses = concurrently(lambda: [
+        search.get_invoice_status([{"InvoiceNumber": number}], key, INVOICE_API_TAX_ID)
+        for key in (INVOICE_API_KEY, "another-key") for _ in range(CONCURRENT // 2)
+    ])
+    # One call per credential; the wrong key gets the provider's refusal, not the other caller's rows
+    assert mock.calls(STATUS_INVOICE_URI) - before == 2
+    assert responses[0]["code"] == 0 and responses[-1]["code"] != 0
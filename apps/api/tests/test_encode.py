@@ -0,0 +1,110 @@
+# tests/test_encode.py
+
+import enum
+import json
+import random
+
+import pytest
+
+from invoice import utils
+from invoice.utils import _UnsupportedValue, _encode_indent0, encode_data
+
+def fast(o) -> str:
+    parts = []
+    _encode_indent0(o, parts)
+    return "".join(parts)
+
+CASES = [
+    {},
+    [],
+    (),
+    "",
+    0,
+    -1,
+    10 ** 30,
+    0.0,
+    -0.0,
+    1.5,
+    0.1 + 0.2,
+    1e-7,
+    1e22,
+    123456789.123456789,
+    None,
+    True,
+    False,
+    "發票 測試",
+    "emoji \U0001f9fe and é",
+    'quotes " and \\ backslash \n\t\r\x00\x1f\x7f',
+    "  ",
+    {"a": {}, "b": [], "c": {"d": [{}], "e": [[], [[]]]}},
+    {"MerchantOrderNo": "A001", "ProductItem": [{"Description": "咖啡", "Quantity": "1", "UnitPrice": 50.0}]},
+    [1, "1", 1.0, None, True, [False, {"x": ""}]],
+    {"": "empty key", "中文鍵": "value"},
+    {"b": 1, "a": 2},
+]
+
+@pytest.mark.parametrize("o", CASES, ids=lambda o: repr(o)[:40])
+def test_matches_json_dumps(o):
+    assert fast(o).encode("utf-8") == json.dumps(o, indent=0).encode("utf-8")
+
+def _random_value(rng: random.Random, depth: int = 0):
+    kinds = ["str", "int", "float", "none", "bool"] + (["dict", "list"] * 2 if depth < 4 else [])
+    kind = rng.choice(kinds)
+    if kind == "str":
+        return "".join(chr(rng.choice([rng.randrange(32, 127), rng.randrange(0, 32), rng.randrange(0x4E00, 0x9FFF), rng.randrange(0x1F300, 0x1FAFF)])) for _ in range(rng.randrange(6)))
+    if kind == "int":
+        return rng.randrange(-10 ** 12, 10 ** 12)
+    if kind == "float":
+        return rng.uniform(-1e6, 1e6) * rng.choice([1, 1e-9, 1e12])
+    if kind == "none":
+        return None
+    if kind == "bool":
+        return rng.random() < 0.5
+    if kind == "dict":
+        return {_random_value(rng, 99) if rng.random() < 0.3 else f"k{i}": _random_value(rng, depth + 1) for i in range(rng.randrange(4))}
+    return [_random_value(rng, depth + 1) for _ in range(rng.randrange(4))]
+
+def test_matches_json_dumps_random():
+    rng = random.Random(0)
+    for _ in range(2000):
+        o = _random_value(rng)
+        if isinstance(o, dict) and any(type(k) is not str for k in o):
+            continue
+        try:
+            encoded = fast(o)
+        except _UnsupportedValue:
+            continue
+        assert encoded.encode("utf-8") == json.dumps(o, indent=0).encode("utf-8")
+
+class Kind(str, enum.Enum):
+    A = "a"
+
+class Amount(float):
+    pass
+
+@pytest.mark.parametrize(
+    "o",
+    [
+        float("nan"),
+        float("inf"),
+        {"x": [float("-inf")]},
+        {1: "int key"},
+        {"nested": {2.5: "float key"}},
+        Kind.A,
+        {"kind": Kind.A},
+        Amount(1.5),
+        [Amount(2.0)],
+    ],
+    ids=repr,
+)
+def test_unsupported_values_fall_back(o, monkeypatch):
+    with pytest.raises(_UnsupportedValue):
+        fast(o)
+    monkeypatch.setattr(utils, "PACKAGE_FAST_JSON", True)
+    assert encode_data(o) == json.dumps(o, indent=0)
+
+@pytest.mark.parametrize("enabled", [True, False])
+def test_encode_data(enabled, monkeypatch):
+    monkeypatch.setattr(utils, "PACKAGE_FAST_JSON", enabled)
+    for o in CASES:
+        assert encode_data(o) == json.dumps(o, indent=0)
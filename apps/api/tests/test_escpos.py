@@ -0,0 +1,85 @@
+# tests/test_escpos.py
+
+import os
+from datetime import datetime
+
+import pytest
+
+from invoice.escpos import (
+    ESC,
+    GS,
+    PAGE_MODE,
+    PAGE_PRINT,
+    PAPER_DOTS,
+    PRINTER_TYPE_DETAILS,
+    PRINTER_TYPE_ORIGINAL,
+    PRINTER_TYPE_REPRINT,
+    print_area,
+    qr_codes_side_by_side,
+    render_invoice,
+)
+
+# Snapshots of render_invoice's own output, not captures of the provider's print-out: they catch
+# unintended layout changes only. Rewrite them from render() when the layout changes on purpose.
+SNAPSHOTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshots")
+QR_PRINT = GS + b"(k\x03\x001Q0"
+
+ORDER = {
+    "BuyerIdentifier": "28080623",
+    "ProductItem": [
+        {"Description": "美式咖啡", "Quantity": "2", "UnitPrice": "50", "Amount": "100"},
+        {"Description": "Bagel", "Quantity": "1", "UnitPrice": "60", "Amount": "60"},
+    ],
+    "SalesAmount": "152",
+    "TaxAmount": "8",
+    "TotalAmount": "160",
+    "MainRemark": "",
+}
+
+ISSUE = {
+    "invoice_number": "AB12345678",
+    # Local time, as render_invoice reads it back with datetime.fromtimestamp
+    "invoice_time": int(datetime(2025, 7, 15, 12, 30, 45).timestamp()),
+    "random_number": "1234",
+    "qrcode_left": "AB123456781140715123400000098000000a028080623045952577Pq1dzXuVOrS4OSGYQBv8ZA==:**********:2:2:1:美式咖啡:2:50",
+    "qrcode_right": "**:Bagel:1:60",
+}
+
+def render(**kwargs) -> bytes:
+    return render_invoice(ORDER, ISSUE, "測試商店", "04595257", **kwargs)
+
+@pytest.mark.parametrize(
+    "name, kwargs",
+    [
+        ("reprint_b2b.bin", {"printer_type": PRINTER_TYPE_REPRINT}),
+        ("original_b2b.bin", {"printer_type": PRINTER_TYPE_ORIGINAL}),
+        ("details.bin", {"printer_type": PRINTER_TYPE_DETAILS}),
+    ],
+)
+def test_snapshot(name, kwargs):
+    with open(os.path.join(SNAPSHOTS, name), "rb") as f:
+        assert render(**kwargs) == f.read()
+
+def test_qr_codes_side_by_side():
+    raw = qr_codes_side_by_side("left", "right")
+    assert raw.startswith(PAGE_MODE) and raw.endswith(PAGE_PRINT)
+    # One page, two print areas splitting the paper in halves, one symbol in each
+    half = PAPER_DOTS // 2
+    left_area = raw.index(print_area(0, 0, half, 180))
+    right_area = raw.index(print_area(half, 0, half, 180))
+    assert raw.count(QR_PRINT) == 2
+    first_qr = raw.index(QR_PRINT)
+    second_qr = raw.index(QR_PRINT, first_qr + 1)
+    assert left_area < raw.index(b"1P0left") < first_qr < right_area < raw.index(b"1P0right") < second_qr
+    assert raw.count(PAGE_MODE) == 1 and raw.count(PAGE_PRINT) == 1
+
+def test_invoice_prints_qr_codes_on_one_page():
+    raw = render()
+    page = raw[raw.index(PAGE_MODE):raw.index(PAGE_PRINT) + 1]
+    assert page.count(QR_PRINT) == 2
+    assert raw.count(QR_PRINT) == 2
+    # Nothing but the two QR codes is laid out in page mode
+    assert ESC + b"a" not in page
+
+def test_missing_qr_payload_falls_back():
+    assert render_invoice(ORDER, dict(ISSUE, qrcode_right=""), "測試商店", "04595257") is None
@@ -0,0 +1,33 @@
+# tests/test_idempotency.py
+
+import os
+
+import pytest
+
+from invoice.idempotency import IdempotencyConflict, IdempotencyIndex, request_fingerprint
+
+@pytest.fixture
+def index(tmp_path):
+    index = IdempotencyIndex(os.path.join(tmp_path, "idempotency.db"))
+    yield index
+    index.close()
+
+def test_reserve_keeps_the_order_id(index):
+    entry, created = index.reserve("k", 60, "body-a")
+    again, created_again = index.reserve("k", 60, "body-a")
+    assert created and not created_again
+    assert again["order_id"] == entry["order_id"]
+
+def test_key_reused_with_another_body_conflicts(index):
+    index.reserve("k", 60, request_fingerprint({"TotalAmount": "100"}))
+    with pytest.raises(IdempotencyConflict):
+        index.reserve("k", 60, request_fingerprint({"TotalAmount": "200"}))
+
+def test_answered_key_is_replayed(index):
+    entry, _ = index.reserve("k", 60, "body-a")
+    index.complete("k", entry, {"invoice_number": "AB00000001"}, 60)
+    entry, created = index.reserve("k", 60, "body-a")
+    # The enqueue path replays this instead of queueing the order again
+    assert not created and entry["response"] == {"invoice_number": "AB00000001"}
+    assert index.replay(entry) == {"invoice_number": "AB00000001", "idempotent_replay": True}
+    assert index.replayed == 1
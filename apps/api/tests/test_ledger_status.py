@@ -0,0 +1,57 @@
+# tests/test_ledger_status.py
+
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+from invoice.ledger import InvoiceLedger
+from invoice.search import local_invoice_status
+
+VATID = "12345678"
+TODAY = int(datetime.now().strftime("%Y%m%d"))
+
+@pytest.fixture
+def ledger(tmp_path):
+    ledger = InvoiceLedger(os.path.join(tmp_path, "ledger.db"))
+    yield ledger
+    ledger.close()
+
+def listed(number: str, status="99", invoice_type="C0401") -> dict:
+    return {
+        "invoice_number": number,
+        "invoice_date": TODAY,
+        "invoice_time": "12:00:00",
+        "buyer_identifier": "0000000000",
+        "total_amount": 100,
+        "invoice_type": invoice_type,
+        "invoice_status": status,
+        "order_id": f"O{number}",
+    }
+
+def test_created_rows_are_not_answered(ledger):
+    ledger.record_created(VATID, {"OrderId": "O1", "TotalAmount": "100"}, {"invoice_number": "AB00000001", "invoice_time": int(time.time())})
+    ledger.mark_synced(VATID, [TODAY], time.time())
+    # invoice_status is only known once a listing has reported it
+    assert local_invoice_status(ledger, ["AB00000001"], VATID) is None
+
+def test_synced_rows_answer_in_status_shape(ledger, monkeypatch):
+    monkeypatch.setattr("invoice.search.LEDGER_SYNC_INTERVAL", 60)
+    ledger.record_listing(VATID, [listed("AB00000001"), listed("AB00000002", invoice_type="C0501")])
+    ledger.mark_synced(VATID, [TODAY], time.time())
+    assert local_invoice_status(ledger, ["AB00000002", "AB00000001"], VATID) == [
+        {"invoice_number": "AB00000002", "invoice_type": "C0501", "invoice_status": 99},
+        {"invoice_number": "AB00000001", "invoice_type": "C0401", "invoice_status": 99},
+    ]
+
+def test_stale_or_partial_syncs_go_upstream(ledger, monkeypatch):
+    monkeypatch.setattr("invoice.search.LEDGER_SYNC_INTERVAL", 60)
+    ledger.record_listing(VATID, [listed("AB00000001")])
+    # Listed, but by a sync older than the interval
+    ledger.mark_synced(VATID, [TODAY], time.time() - 120)
+    assert local_invoice_status(ledger, ["AB00000001"], VATID) is None
+    ledger.mark_synced(VATID, [TODAY], time.time())
+    assert local_invoice_status(ledger, ["AB00000001"], VATID) is not None
+    # One unknown number sends the whole lookup upstream
+    assert local_invoice_status(ledger, ["AB00000001", "AB00000003"], VATID) is None
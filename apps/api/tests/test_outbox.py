@@ -0,0 +1,46 @@
+# tests/test_outbox.py
+
+import asyncio
+import os
+import time
+
+from invoice import outbox as outbox_module
+from invoice.outbox import InvoiceOutbox
+
+def test_enqueue_from_a_thread_wakes_the_worker(tmp_path, monkeypatch):
+    issued = []
+
+    async def create_full_invoice(data, api_key=None, vatid=None, order_id=None):
+        issued.append(time.monotonic())
+        return {"invoice_number": "AB00000001"}
+
+    monkeypatch.setattr(outbox_module, "create_full_invoice", create_full_invoice)
+    monkeypatch.setattr(outbox_module, "OUTBOX_POLL_INTERVAL", 30)
+
+    async def run():
+        outbox = InvoiceOutbox(os.path.join(tmp_path, "outbox.db"))
+        outbox.start(1)
+        # Let the worker find the queue empty and go to sleep
+        await asyncio.sleep(0.1)
+        queued_at = time.monotonic()
+        order_id = await asyncio.to_thread(outbox.enqueue, {"ProductItem": []})
+        for _ in range(100):
+            if issued:
+                break
+            await asyncio.sleep(0.01)
+        job = await asyncio.to_thread(outbox.get, order_id)
+        await outbox.stop()
+        return queued_at, job
+
+    queued_at, job = asyncio.run(run(), debug=True)
+    # Woken by the enqueue, not by the 30s poll
+    assert issued and issued[0] - queued_at < 1
+    assert job["status"] == "done" and job["invoice_number"] == "AB00000001"
+
+def test_get_is_scoped_to_the_vatid_and_key(tmp_path):
+    outbox = InvoiceOutbox(os.path.join(tmp_path, "outbox.db"))
+    order_id = outbox.enqueue({"ProductItem": []}, "key-a", "12345678")
+    assert outbox.get(order_id, "key-a", "12345678")["status"] == "pending"
+    assert outbox.get(order_id, "key-a", "87654321") is None
+    assert outbox.get(order_id, "key-b", "12345678") is None
+    assert "api_key" not in outbox.get(order_id, "key-a", "12345678")
@@ -0,0 +1,72 @@
+# tests/test_search_cache.py
+
+import asyncio
+import hashlib
+from urllib.parse import parse_qs
+
+import pytest
+
+from invoice import search
+from invoice.cache import TTLCache
+
+GOOD_KEY = "good-key"
+
+class FakeProvider:
+    """Answers only packages signed with GOOD_KEY, like the provider's sign check."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, url, package, vatid=None):
+        self.calls.append(url)
+        fields = parse_qs(package)
+        if fields["sign"][0] != self.expected_sign(fields):
+            return {"code": 1001, "msg": "sign error"}
+        if url.endswith("invoice_print"):
+            return {"code": 0, "msg": "", "data": {"base64_data": "UFJJTlQ="}}
+        return {"code": 0, "msg": "", "data": [{"invoice_number": "AB00000001", "invoice_type": "C0401"}]}
+
+    @staticmethod
+    def expected_sign(fields) -> str:
+        data, timestamp = fields["data"][0], fields["time"][0]
+        return hashlib.md5((data + timestamp + GOOD_KEY).encode("utf-8")).hexdigest()
+
+@pytest.fixture
+def provider(monkeypatch):
+    fake = FakeProvider()
+    monkeypatch.setattr(search, "send_request_async", fake)
+    monkeypatch.setattr(search, "print_cache", TTLCache(maxsize=100, ttl=60))
+    monkeypatch.setattr(search, "status_cache", TTLCache(maxsize=100, ttl=60))
+    monkeypatch.setattr(search, "STATUS_CACHE_TTL", 60)
+    monkeypatch.setattr(search, "STATUS_BATCH_WINDOW", 0)
+    monkeypatch.setattr(search, "LOCAL_PRINT_RENDER", False)
+    return fake
+
+def test_print_cache_only_answers_the_key_that_filled_it(provider):
+    data = {"type": "invoice", "invoice_number": "AB00000001", "printer_type": 2, "print_invoice_type": 1}
+
+    async def run():
+        first = await search.get_print_invoice(dict(data), GOOD_KEY, "12345678")
+        again = await search.get_print_invoice(dict(data), GOOD_KEY, "12345678")
+        other = await search.get_print_invoice(dict(data), "any-other-key", "12345678")
+        return first, again, other
+
+    first, again, other = asyncio.run(run())
+    assert first["data"]["base64_data"] and again == first
+    assert "data" not in other and other["code"] != 0
+    # The cached answer served the same key; the other key went to the provider and was refused
+    assert len(provider.calls) == 2
+
+def test_status_cache_only_answers_the_key_that_filled_it(provider):
+    numbers = [{"InvoiceNumber": "AB00000001"}]
+
+    async def run():
+        first = await search.get_invoice_status(numbers, GOOD_KEY, "12345678")
+        again = await search.get_invoice_status(numbers, GOOD_KEY, "12345678")
+        other = await search.get_invoice_status(numbers, "any-other-key", "12345678")
+        return first, again, other
+
+    first, again, other = asyncio.run(run())
+    assert again.get("cached") and again["data"] == first["data"]
+    assert other["code"] != 0 and not other.get("cached")
+    assert len(provider.calls) == 2
@@ -0,0 +1,22 @@
+# tests/test_shared.py
+
+import os
+import sys
+
+from invoice.shared import SharedState
+
+def test_leadership_without_flock(tmp_path, monkeypatch):
+    # What Windows looks like: importing fcntl fails
+    monkeypatch.setitem(sys.modules, "fcntl", None)
+    state = SharedState(os.path.join(tmp_path, "shared.db"))
+    assert state.try_lead() and state.leader
+    state.close()
+
+def test_only_one_leader_per_file(tmp_path):
+    path = os.path.join(tmp_path, "shared.db")
+    first, second = SharedState(path), SharedState(path)
+    assert first.try_lead()
+    assert not second.try_lead()
+    first.close()
+    assert second.try_lead()
+    second.close()
@@ -0,0 +1,359 @@
+# amego_mock.py
+"""
+Local stand-in for the amego invoice API (https://invoice-api.amego.tw) for development
+and load tests. It keeps invoices in memory, checks every request's MD5 sign the way the
+provider does, and can inject latency and failures.
+
+    uvicorn amego_mock:app --port 8081
+    INVOICE_API_BASE_URL=http://127.0.0.1:8081 uvicorn main:app     (in apps/api)
+
+Fault injection is configured with MOCK_* environment variables or at runtime:
+
+    curl -X POST localhost:8081/_mock/config -d '{"latency": 0.2, "error_rate": 0.1}'
+    curl -X POST localhost:8081/_mock/config -d '{"endpoints": {"/json/f0401": {"hang_rate": 0.5}}}'
+
+Error codes in application-level failures are the mock's own, not the provider's.
+"""
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+TEST_TAX_ID = "12345678"
+TEST_KEY = "sHeq7t8G1wiQvhAuIM27"
+NO_BAN = "0000000000"
+
+# MOCK_KEYS="12345678:key,87654321:key" lists the VATIDs the mock accepts
+KEYS = {
+    vatid: key
+    for vatid, _, key in (item.strip().partition(":") for item in os.getenv("MOCK_KEYS", f"{TEST_TAX_ID}:{TEST_KEY}").split(","))
+    if vatid and key
+}
+# The provider rejects timestamps too far from its own clock (seconds; 0 disables the check)
+TIME_SKEW = float(os.getenv("MOCK_TIME_SKEW", "300"))
+# Invoices present at startup for each VATID, spread over the last MOCK_SEED_DAYS days
+SEED_INVOICES = int(os.getenv("MOCK_SEED_INVOICES", "0"))
+SEED_DAYS = int(os.getenv("MOCK_SEED_DAYS", "30"))
+
+FAULT_KEYS = ("latency", "jitter", "error_rate", "error_status", "app_error_rate", "hang_rate", "bad_json_rate")
+DEFAULT_FAULTS = {
+    "latency": float(os.getenv("MOCK_LATENCY", "0")),          # seconds added to every call
+    "jitter": float(os.getenv("MOCK_JITTER", "0")),            # +- uniform seconds
+    "error_rate": float(os.getenv("MOCK_ERROR_RATE", "0")),    # share answered with HTTP error_status
+    "error_status": int(os.getenv("MOCK_ERROR_STATUS", "500")),
+    "app_error_rate": float(os.getenv("MOCK_APP_ERROR_RATE", "0")),  # HTTP 200 with code != 0
+    "hang_rate": float(os.getenv("MOCK_HANG_RATE", "0")),      # never answers (until the client gives up)
+    "bad_json_rate": float(os.getenv("MOCK_BAD_JSON_RATE", "0")),
+}
+
+CODE_OK = 0
+CODE_SIGN_ERROR = 1001
+CODE_TIME_ERROR = 1002
+CODE_VATID_ERROR = 1003
+CODE_DATA_ERROR = 1004
+CODE_NOT_FOUND = 1005
+CODE_DUPLICATE_ORDER = 1006
+CODE_ALREADY_CANCELLED = 1007
+CODE_INJECTED = 9999
+
+# Check-digit rule for 統一編號, same as apps/api/invoice/ban.py
+BAN_WEIGHTS = (1, 2, 1, 2, 1, 2, 4, 1)
+
+def is_valid_ban(ban: str) -> bool:
+    if len(ban) != 8 or not ban.isdigit():
+        return False
+    total = sum((int(d) * w) // 10 + (int(d) * w) % 10 for d, w in zip(ban, BAN_WEIGHTS))
+    return total % 5 == 0 or (ban[6] == "7" and (total + 1) % 5 == 0)
+
+class MockState:
+    def __init__(self):
+        self.faults = dict(DEFAULT_FAULTS)
+        self.endpoint_faults = {}
+        self.invoices = {}      # (vatid, invoice_number) -> invoice
+        self.orders = {}        # (vatid, order_id) -> invoice_number
+        self.by_vatid = {}      # vatid -> [invoice], in issue order
+        self.sequence = itertools.count(1)
+        self.calls = {}
+        self.sign_failures = 0
+        self.injected = 0
+
+    def faults_for(self, path: str) -> dict:
+        return {**self.faults, **self.endpoint_faults.get(path, {})}
+
+    def issue(self, vatid: str, order: dict, issued: datetime = None) -> dict:
+        issued = issued or datetime.now()
+        number = f"AB{next(self.sequence):08d}"
+        random_number = f"{random.randint(0, 9999):04d}"
+        total = int(float(order.get("TotalAmount") or 0))
+        sales = int(float(order.get("SalesAmount") or 0))
+        buyer = order.get("BuyerIdentifier") or NO_BAN
+        roc_date = f"{issued.year - 1911:03d}{issued:%m%d}"
+        items = order.get("ProductItem") or []
+        invoice = {
+            "invoice_number": number,
+            "invoice_date": issued.strftime("%Y%m%d"),
+            "invoice_time": issued.strftime("%H:%M:%S"),
+            "create_date": datetime.now().strftime("%Y%m%d"),
+            "timestamp": int(issued.timestamp()),
+            "buyer_identifier": buyer,
+            "total_amount": total,
+            "invoice_type": "C0401",
+            "invoice_status": 99,
+            "carrier_id1": order.get("CarrierId1", ""),
+            "order_id": order.get("OrderId", ""),
+            "random_number": random_number,
+            "order": order,
+            # 發票字軌 + 民國日期 + 隨機碼 + 銷售額/總計(16進位) + 買受人/賣方統編 + 加密驗證資訊(mock)
+            "qrcode_left": (
+                f"{number}{roc_date}{random_number}{sales:08x}{total:08x}"
+                f"{buyer[-8:] if buyer != NO_BAN else '00000000'}{vatid}{'0' * 24}:**********:{len(items)}:{len(items)}:1:"
+            ),
+            "qrcode_right": "**" + ":".join(f"{item.get('Description', '')}:{item.get('Quantity', '')}:{item.get('UnitPrice', '')}" for item in items),
+        }
+        self.invoices[(vatid, number)] = invoice
+        self.by_vatid.setdefault(vatid, []).append(invoice)
+        if invoice["order_id"]:
+            self.orders[(vatid, invoice["order_id"])] = number
+        return invoice
+
+    def seed(self, count: int, days: int):
+        today = datetime.now()
+        for vatid in KEYS:
+            for i in range(count):
+                issued = today - timedelta(days=days - 1 - (i * days) // max(count, 1), seconds=random.randint(0, 3600))
+                self.issue(vatid, {
+                    "OrderId": f"SEED{vatid}{i:08d}",
+                    "BuyerIdentifier": NO_BAN,
+                    "ProductItem": [{"Description": "測試商品", "Quantity": "1", "UnitPrice": "100", "Amount": "100", "TaxType": "1"}],
+                    "SalesAmount": "100", "TaxAmount": "0", "TotalAmount": "100",
+                }, issued)
+        for invoices in self.by_vatid.values():
+            invoices.sort(key=lambda invoice: (invoice["invoice_date"], invoice["invoice_time"], invoice["invoice_number"]))
+
+state = MockState()
+app = FastAPI(title="amego mock")
+
+def listing_row(invoice: dict) -> dict:
+    return {
+        "invoice_number": invoice["invoice_number"],
+        "invoice_date": invoice["invoice_date"],
+        "invoice_time": invoice["invoice_time"],
+        "create_date": invoice["create_date"],
+        "buyer_identifier": invoice["buyer_identifier"],
+        "total_amount": invoice["total_amount"],
+        "invoice_type": invoice["invoice_type"],
+        "invoice_status": invoice["invoice_status"],
+        "carrier_id1": invoice["carrier_id1"],
+        "order_id": invoice["order_id"],
+    }
+
+def fail(code: int, msg: str) -> dict:
+    return {"code": code, "msg": msg}
+
+def verify(form: dict):
+    """Returns (vatid, decoded data) or an error body, checking sign = md5(data + time + key)."""
+    vatid, data, timestamp, sign = (form.get(name, [""])[0] for name in ("invoice", "data", "time", "sign"))
+    key = KEYS.get(vatid)
+    if key is None:
+        return fail(CODE_VATID_ERROR, f"unknown invoice (VATID) {vatid}")
+    expected = hashlib.md5((data + timestamp + key).encode("utf-8")).hexdigest()
+    if not hmac.compare_digest(expected, sign):
+        state.sign_failures += 1
+        return fail(CODE_SIGN_ERROR, "sign mismatch")
+    if TIME_SKEW and (not timestamp.isdigit() or abs(int(timestamp) - time.time()) > TIME_SKEW):
+        return fail(CODE_TIME_ERROR, "time out of range")
+    try:
+        return vatid, json.loads(data)
+    except json.JSONDecodeError:
+        return fail(CODE_DATA_ERROR, "data is not JSON")
+
+@app.middleware("http")
+async def inject_faults(request: Request, call_next):
+    path = request.url.path
+    if not path.startswith("/json/"):
+        return await call_next(request)
+    state.calls[path] = state.calls.get(path, 0) + 1
+    faults = state.faults_for(path)
+    delay = faults["latency"] + (random.uniform(-faults["jitter"], faults["jitter"]) if faults["jitter"] else 0)
+    roll = random.random()
+    if roll < faults["hang_rate"]:
+        state.injected += 1
+        await asyncio.sleep(3600)
+    if delay > 0:
+        await asyncio.sleep(delay)
+    roll -= faults["hang_rate"]
+    if 0 <= roll < faults["error_rate"]:
+        state.injected += 1
+        return Response("mock injected failure", status_code=faults["error_status"])
+    roll -= faults["error_rate"]
+    if 0 <= roll < faults["bad_json_rate"]:
+        state.injected += 1
+        return Response("<html>mock</html>", media_type="application/json")
+    roll -= faults["bad_json_rate"]
+    if 0 <= roll < faults["app_error_rate"]:
+        state.injected += 1
+        return JSONResponse(fail(CODE_INJECTED, "mock injected error"))
+    return await call_next(request)
+
+async def read_request(request: Request):
+    body = (await request.body()).decode("utf-8")
+    return verify(parse_qs(body, keep_blank_values=True))
+
+@app.post("/json/f0401")
+async def f0401(request: Request):
+    verified = await read_request(request)
+    if isinstance(verified, dict):
+        return verified
+    vatid, order = verified
+    if not isinstance(order, dict) or not order.get("ProductItem"):
+        return fail(CODE_DATA_ERROR, "ProductItem is required")
+    order_id = order.get("OrderId")
+    if order_id and (vatid, order_id) in state.orders:
+        return fail(CODE_DUPLICATE_ORDER, f"OrderId {order_id} already issued")
+    invoice = state.issue(vatid, order)
+    return {
+        "code": CODE_OK,
+        "msg": "",
+        "invoice_number": invoice["invoice_number"],
+        "invoice_time": invoice["timestamp"],
+        "random_number": invoice["random_number"],
+        "barcode": f"{int(invoice['invoice_date'][:4]) - 1911:03d}{(int(invoice['invoice_date'][4:6]) + 1) // 2 * 2:02d}{invoice['invoice_number']}{invoice['random_number']}",
+        "qrcode_left": invoice["qrcode_left"],
+        "qrcode_right": invoice["qrcode_right"],
+    }
+
+@app.post("/json/f0501")
+async def f0501(request: Request):
+    verified = await read_request(request)
+    if isinstance(verified, dict):
+        return verified
+    vatid, items = verified
+    if not isinstance(items, list) or not items:
+        return fail(CODE_DATA_ERROR, "a list of CancelInvoiceNumber is required")
+    invoices = [state.invoices.get((vatid, item.get("CancelInvoiceNumber"))) for item in items]
+    missing = [item.get("CancelInvoiceNumber") for item, invoice in zip(items, invoices) if invoice is None]
+    if missing:
+        return fail(CODE_NOT_FOUND, f"invoice not found: {','.join(map(str, missing))}")
+    cancelled = [invoice["invoice_number"] for invoice in invoices if invoice["invoice_type"] == "C0501"]
+    if cancelled:
+        return fail(CODE_ALREADY_CANCELLED, f"already cancelled: {','.join(cancelled)}")
+    for invoice in invoices:
+        invoice["invoice_type"] = "C0501"
+    return {"code": CODE_OK, "msg": ""}
+
+@app.post("/json/invoice_status")
+async def invoice_status(request: Request):
+    verified = await read_request(request)
+    if isinstance(verified, dict):
+        return verified
+    vatid, items = verified
+    if not isinstance(items, list):
+        return fail(CODE_DATA_ERROR, "a list of InvoiceNumber is required")
+    rows = []
+    for item in items:
+        invoice = state.invoices.get((vatid, item.get("InvoiceNumber")))
+        if invoice is not None:
+            rows.append({
+                "invoice_number": invoice["invoice_number"],
+                "invoice_type": invoice["invoice_type"],
+                "invoice_status": invoice["invoice_status"],
+            })
+    return {"code": CODE_OK, "msg": "", "data": rows}
+
+@app.post("/json/invoice_query")
+async def invoice_query(request: Request):
+    verified = await read_request(request)
+    if isinstance(verified, dict):
+        return verified
+    vatid, query = verified
+    number = state.orders.get((vatid, query.get("order_id"))) if query.get("type") == "order" else query.get("invoice_number")
+    invoice = state.invoices.get((vatid, number))
+    if invoice is None:
+        return fail(CODE_NOT_FOUND, "invoice not found")
+    return {"code": CODE_OK, "msg": "", "data": listing_row(invoice)}
+
+@app.post("/json/invoice_list")
+async def invoice_list(request: Request):
+    verified = await read_request(request)
+    if isinstance(verified, dict):
+        return verified
+    vatid, query = verified
+    try:
+        column = "create_date" if int(query.get("date_select", 1)) == 2 else "invoice_date"
+        start, end = str(query["date_start"]), str(query["date_end"])
+        limit = min(500, max(1, int(query.get("limit", 20))))
+        page = max(1, int(query.get("page", 1)))
+    except (KeyError, TypeError, ValueError):
+        return fail(CODE_DATA_ERROR, "date_start and date_end are required")
+    matches = [invoice for invoice in state.by_vatid.get(vatid, []) if start <= invoice[column] <= end]
+    rows = [listing_row(invoice) for invoice in matches[(page - 1) * limit: page * limit]]
+    return {"code": CODE_OK, "msg": "", "data": rows}
+
+@app.post("/json/invoice_print")
+async def invoice_print(request: Request):
+    verified = await read_request(request)
+    if isinstance(verified, dict):
+        return verified
+    vatid, query = verified
+    number = state.orders.get((vatid, query.get("order_id"))) if query.get("type") == "order" else query.get("invoice_number")
+    invoice = state.invoices.get((vatid, number))
+    if invoice is None:
+        return fail(CODE_NOT_FOUND, "invoice not found")
+    # Not a faithful 證明聯, just printable ESC/POS of about the right size
+    text = f"{invoice['invoice_number']}\n{invoice['invoice_date']} {invoice['invoice_time']}\n{invoice['total_amount']}\n"
+    raw = b"\x1b@" + text.encode("ascii") + invoice["qrcode_left"].encode("ascii") + b"\n" * 4 + b"\x1dV\x42\x00"
+    return {"code": CODE_OK, "msg": "", "data": {"base64_data": base64.b64encode(raw).decode("ascii")}}
+
+@app.post("/json/ban_query")
+async def ban_query(request: Request):
+    verified = await read_request(request)
+    if isinstance(verified, dict):
+        return verified
+    _, items = verified
+    if not isinstance(items, list):
+        return fail(CODE_DATA_ERROR, "a list of ban is required")
+    rows = [{"ban": item["ban"], "name": f"測試公司{item['ban']}"} for item in items if is_valid_ban(str(item.get("ban", "")))]
+    return {"code": CODE_OK, "msg": "", "data": rows}
+
+@app.get("/_mock/config")
+async def get_config():
+    return {**state.faults, "endpoints": state.endpoint_faults}
+
+@app.post("/_mock/config")
+async def set_config(request: Request):
+    """Update fault settings; "endpoints" holds per-path overrides, {"reset": true} restores the defaults."""
+    body = await request.json()
+    if body.get("reset"):
+        state.faults = dict(DEFAULT_FAULTS)
+        state.endpoint_faults = {}
+    state.faults.update({key: body[key] for key in FAULT_KEYS if key in body})
+    for path, overrides in (body.get("endpoints") or {}).items():
+        state.endpoint_faults.setdefault(path, {}).update({key: overrides[key] for key in FAULT_KEYS if key in overrides})
+    return await get_config()
+
+@app.get("/_mock/stats")
+async def get_stats():
+    return {
+        "calls": state.calls,
+        "sign_failures": state.sign_failures,
+        "injected_faults": state.injected,
+        "invoices": len(state.invoices),
+    }
+
+if SEED_INVOICES:
+    state.seed(SEED_INVOICES, SEED_DAYS)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=os.getenv("MOCK_HOST", "127.0.0.1"), port=int(os.getenv("MOCK_PORT", "8081")), log_level="warning")
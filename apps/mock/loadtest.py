@@ -0,0 +1,315 @@
+# loadtest.py
+"""
+Drives every /api/v1 route of apps/api/main.py and reports throughput and p50/p99 latency.
+
+    # Start the mock upstream and the API on free ports, then run every route
+    python loadtest.py --spawn
+
+    # Against an API you started yourself (pointed at amego_mock.py)
+    python loadtest.py --api http://127.0.0.1:8000 --routes create_invoice,get_invoices
+
+    # The same with four API worker processes sharing caches and rate budgets
+    python loadtest.py --spawn --workers 4
+
+    # Keep a baseline and fail (exit 1) when a later run regresses by more than 20%
+    python loadtest.py --spawn --save baseline.json
+    python loadtest.py --spawn --compare baseline.json --tolerance 0.2
+
+Each route runs on its own for --duration seconds with --concurrency workers, so the
+numbers of one route are not skewed by another. --spawn passes MOCK_* and every other
+environment variable through, so the API's own settings (INVOICE_API_MAX_CONCURRENCY,
+STATUS_BATCH_WINDOW, ...) can be compared run against run.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.join(HERE, "..", "api")
+
+TEST_TAX_ID = "12345678"
+TEST_KEY = "sHeq7t8G1wiQvhAuIM27"
+BAN_WEIGHTS = (1, 2, 1, 2, 1, 2, 4, 1)
+# Answers the PowerBuilder routes use for "upstream failed" / "no data"
+LEGACY_ERRORS = ('"1"', '"2"', '"0018"')
+
+def order(total: int = 100) -> dict:
+    return {
+        "BuyerIdentifier": "0000000000",
+        "BuyerName": "客人",
+        "ProductItem": [{"Description": "測試商品", "Quantity": "1", "UnitPrice": str(total), "Amount": str(total), "Remark": "", "TaxType": "1"}],
+        "SalesAmount": str(total),
+        "FreeTaxSalesAmount": "0",
+        "ZeroTaxSalesAmount": "0",
+        "TaxType": "1",
+        "TaxRate": "0.05",
+        "TaxAmount": "0",
+        "TotalAmount": str(total),
+    }
+
+def random_ban() -> str:
+    """A random 統一編號 that passes the check-digit rule."""
+    while True:
+        ban = f"{random.randint(0, 99999999):08d}"
+        total = sum((int(d) * w) // 10 + (int(d) * w) % 10 for d, w in zip(ban, BAN_WEIGHTS))
+        if total % 5 == 0:
+            return ban
+
+def percentile(ordered: list, p: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+class Pools:
+    """Invoice numbers created during setup, shared by the routes that need existing invoices."""
+
+    def __init__(self):
+        self.invoices = []
+        self.cancellable = []
+        self.bans = [random_ban() for _ in range(1000)]
+        self.order_ids = []
+
+def legacy_ok(response: httpx.Response) -> bool:
+    return response.status_code == 200 and response.text not in LEGACY_ERRORS
+
+def json_ok(response: httpx.Response) -> bool:
+    if response.status_code != 200:
+        return False
+    body = response.json()
+    return not (isinstance(body, dict) and (body.get("code", 0) != 0 or "error" in body))
+
+def status_ok(response: httpx.Response) -> bool:
+    return response.status_code == 200
+
+def routes(pools: Pools, today: date) -> dict:
+    """name -> (method, path, request builder returning kwargs or None when out of data, success check)."""
+    period = {
+        "date_select": 1,
+        "date_start": int((today - timedelta(days=30)).strftime("%Y%m%d")),
+        "date_end": int(today.strftime("%Y%m%d")),
+        "limit": 500,
+        "page": 1,
+    }
+
+    def some_invoices(n: int) -> list:
+        return random.sample(pools.invoices, min(n, len(pools.invoices)))
+
+    def cancel():
+        if not pools.cancellable:
+            return None
+        return {"json": [{"CancelInvoiceNumber": pools.cancellable.pop()}]}
+
+    def queued_order():
+        order_id = random.choice(pools.order_ids) if pools.order_ids else "NOSUCHORDER"
+        return {"path_args": (order_id,)}
+
+    return {
+        "create_invoice": ("POST", "/api/v1/create/invoice", lambda: {"json": order(random.randint(10, 5000))}, legacy_ok),
+        "create_invoices": ("POST", "/api/v1/create/invoices", lambda: {"json": [order() for _ in range(10)]}, json_ok),
+        "get_invoices": ("POST", "/api/v1/get/invoices", lambda: {"json": [{"InvoiceNumber": n} for n in some_invoices(5)]}, json_ok),
+        "cancel_invoices": ("POST", "/api/v1/cancel/invoices", cancel, json_ok),
+        "invoice_period": ("POST", "/api/v1/get/invoice/period", lambda: {"json": period}, legacy_ok),
+        "invoice_period_export": ("POST", "/api/v1/get/invoice/period/export", lambda: {"json": period, "params": {"format": "csv"}}, legacy_ok),
+        "print_invoice": (
+            "POST", "/api/v1/print/invoice",
+            lambda: {"json": {"type": "invoice", "invoice_number": random.choice(pools.invoices), "printer_type": 2, "print_invoice_type": 1}},
+            json_ok,
+        ),
+        "company_vat_info": ("POST", "/api/v1/company/vat/info", lambda: {"json": [{"ban": random.choice(pools.bans)}]}, legacy_ok),
+        "queue_status": ("GET", "/api/v1/queue/status", lambda: {}, status_ok),
+        # 404 is the answer for an order that is not queued (or with the outbox disabled)
+        "queue_order": ("GET", "/api/v1/queue/order/{}", queued_order, lambda r: r.status_code in (200, 404)),
+        "coalescing_stats": ("GET", "/api/v1/coalescing/stats", lambda: {}, status_ok),
+        "upstream_breakers": ("GET", "/api/v1/upstream/breakers", lambda: {}, status_ok),
+        "tenants_status": ("GET", "/api/v1/tenants/status", lambda: {}, status_ok),
+        "print_cache": ("GET", "/api/v1/print/cache", lambda: {}, status_ok),
+        "company_vat_cache": ("GET", "/api/v1/company/vat/cache", lambda: {}, status_ok),
+        "metrics": ("GET", "/metrics", lambda: {}, status_ok),
+    }
+
+async def setup(client: httpx.AsyncClient, pools: Pools, cancellable: int):
+    """Create the invoices later routes read, print and cancel."""
+    needed = 200 + cancellable
+    while len(pools.invoices) + len(pools.cancellable) < needed:
+        batch = min(500, needed - len(pools.invoices) - len(pools.cancellable))
+        response = await client.post("/api/v1/create/invoices", json=[order() for _ in range(batch)])
+        response.raise_for_status()
+        numbers = [result["invoice_number"] for result in response.json()["results"] if "invoice_number" in result]
+        if not numbers:
+            raise RuntimeError(f"Setup could not create invoices: {response.text[:200]}")
+        for number in numbers:
+            (pools.invoices if len(pools.invoices) < 200 else pools.cancellable).append(number)
+    response = await client.post("/api/v1/create/invoice", json=order(), headers={"enqueue": "true"})
+    if response.status_code == 202:
+        pools.order_ids.append(response.json()["order_id"])
+
+async def run_route(client: httpx.AsyncClient, name: str, route: tuple, duration: float, concurrency: int) -> dict:
+    method, path, build, ok = route
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+    exhausted = False
+
+    async def worker():
+        nonlocal errors, exhausted
+        while not exhausted and time.perf_counter() < deadline:
+            kwargs = build()
+            if kwargs is None:
+                exhausted = True
+                return
+            url = path.format(*kwargs.pop("path_args", ()))
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                success = ok(response)
+            except (httpx.HTTPError, ValueError):
+                success = False
+            latencies.append(time.perf_counter() - started)
+            if not success:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "exhausted": exhausted,
+    }
+
+def print_report(results: dict, baseline: dict = None, tolerance: float = 0.2) -> list:
+    regressions = []
+    header = f"{'route':<24}{'requests':>9}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+    print(header + ("   vs baseline" if baseline else ""))
+    print("-" * (len(header) + (15 if baseline else 0)))
+    for name, result in results.items():
+        line = f"{name:<24}{result['requests']:>9}{result['errors']:>8}{result['rps']:>10}{result['p50_ms']:>10}{result['p99_ms']:>10}"
+        base = (baseline or {}).get(name)
+        if base:
+            notes = []
+            if result["rps"] < base["rps"] * (1 - tolerance):
+                notes.append(f"req/s {base['rps']} -> {result['rps']}")
+            # 1 ms of slack so sub-millisecond routes do not flap
+            if result["p99_ms"] > base["p99_ms"] * (1 + tolerance) + 1:
+                notes.append(f"p99 {base['p99_ms']} -> {result['p99_ms']} ms")
+            if notes:
+                regressions.append((name, notes))
+                line += "   REGRESSION: " + ", ".join(notes)
+            else:
+                line += "   ok"
+        if result.get("exhausted"):
+            line += "   (ran out of invoices)"
+        print(line)
+    return regressions
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for(url: str, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+def spawn(workdir: str, workers: int = 1):
+    """Start amego_mock and the API; returns (api url, processes)."""
+    mock_port, api_port = free_port(), free_port()
+    env = dict(os.environ)
+    env.setdefault("MOCK_SEED_INVOICES", "2000")
+    env.setdefault("MOCK_LATENCY", "0.05")
+    mock = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "amego_mock:app", "--port", str(mock_port), "--log-level", "warning"],
+        cwd=HERE, env=env,
+    )
+    env.update({
+        "INVOICE_API_BASE_URL": f"http://127.0.0.1:{mock_port}",
+        "LEDGER_DB": env.get("LEDGER_DB", os.path.join(workdir, "ledger.db")),
+        "OUTBOX_DB": env.get("OUTBOX_DB", os.path.join(workdir, "outbox.db")),
+        "WEB_CONCURRENCY": str(workers),
+    })
+    if workers > 1:
+        env.setdefault("SHARED_STATE_DB", os.path.join(workdir, "shared.db"))
+    api = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(api_port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=API_DIR, env=env,
+    )
+    wait_for(f"http://127.0.0.1:{mock_port}/_mock/stats")
+    wait_for(f"http://127.0.0.1:{api_port}/metrics")
+    return f"http://127.0.0.1:{api_port}", [api, mock]
+
+async def main(args) -> int:
+    pools = Pools()
+    selected = routes(pools, date.today())
+    names = args.routes.split(",") if args.routes else list(selected)
+    unknown = [name for name in names if name not in selected]
+    if unknown:
+        print(f"Unknown route(s): {', '.join(unknown)}; choose from {', '.join(selected)}")
+        return 2
+
+    headers = {"Authorization": args.key, "VATID": args.vatid}
+    limits = httpx.Limits(max_connections=args.concurrency + 10, max_keepalive_connections=args.concurrency + 10)
+    async with httpx.AsyncClient(base_url=args.api, headers=headers, limits=limits, timeout=args.timeout) as client:
+        await setup(client, pools, args.cancellable)
+        results = {}
+        for name in names:
+            results[name] = await run_route(client, name, selected[name], args.duration, args.concurrency)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["routes"]
+    print(f"\n{args.concurrency} concurrent clients, {args.duration:g}s per route, API {args.api}\n")
+    regressions = print_report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"concurrency": args.concurrency, "duration": args.duration, "routes": results}, f, indent=2)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test every /api/v1 route of the invoice API.")
+    parser.add_argument("--api", default="http://127.0.0.1:8000", help="API base URL (ignored with --spawn)")
+    parser.add_argument("--spawn", action="store_true", help="start amego_mock and the API on free ports")
+    parser.add_argument("--routes", default="", help="comma-separated route names, default all")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per route")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--workers", type=int, default=1, help="API worker processes (with --spawn)")
+    parser.add_argument("--cancellable", type=int, default=2000, help="invoices created up front for the cancel route")
+    parser.add_argument("--vatid", default=TEST_TAX_ID)
+    parser.add_argument("--key", default=TEST_KEY)
+    parser.add_argument("--save", help="write results as JSON")
+    parser.add_argument("--compare", help="baseline JSON from an earlier --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+
+    processes = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            if args.spawn:
+                args.api, processes = spawn(workdir, args.workers)
+            code = asyncio.run(main(args))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+    sys.exit(code)
@@ -1,12 +1,22 @@
 import os
-import socket
+import sys
+import time
+import queue
 import base64
+import threading
 import requests
-import usb.core
-import usb.util
+from concurrent.futures import wait
 from dotenv import load_dotenv
 from pathlib import Path
 
+try:
+    # Native folder events (inotify on Linux, ReadDirectoryChangesW on Windows)
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
 # Load environment variables
 load_dotenv("IveConfig.txt")
 
@@ -14,69 +24,22 @@ SERVER_ADDR = os.getenv("SERVER_ADDR")
 VATID = os.getenv("VATID")
 AUTHORIZATION = os.getenv("Authorization")
 
-PRINTER_IP = os.getenv("PRINTER_IP", "192.168.1.147")
-PRINTER_PORT = int(os.getenv("PRINTER_PORT", "9100"))
 PRINT_FOLDER = os.getenv("PRINT_FOLDER", r"C:\BDPOS7\Invoice")
-PRINT_TIMEOUT = 10  # seconds
-
-# USB printer info from env (strings, convert to int if present)
-USB_VENDOR_ID = os.getenv("PRINTER_VENDOR_ID")
-USB_PRODUCT_ID = os.getenv("PRINTER_PRODUCT_ID")
-INTERFACE = 0  # usually 0
-
-
-def print_to_printer(base64_data: str):
-    """Send print data over TCP to network printer."""
-    raw_bytes = base64.b64decode(base64_data)
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.settimeout(PRINT_TIMEOUT)
-            s.connect((PRINTER_IP, PRINTER_PORT))
-            s.sendall(raw_bytes)
-        print("✅ Print command sent successfully (IP printer).")
-        return True
-    except (socket.timeout, socket.error) as e:
-        print(f"❌ Cannot print via IP printer: {e}")
-        return False
-
-
-def print_to_usb_printer(base64_data: str):
-    """Send raw ESC/POS data to USB printer via pyusb."""
-    if USB_VENDOR_ID is None or USB_PRODUCT_ID is None:
-        raise ValueError("USB Vendor ID and Product ID must be set for USB printing.")
+PRINT_POLL_INTERVAL = float(os.getenv("PRINT_POLL_INTERVAL", "1"))  # seconds, used without watchdog
+# seconds; with watchdog, a slow sweep still picks up files whose events were lost
+# (network shares, event buffer overflows). 0 disables it
+PRINT_RESCAN_INTERVAL = float(os.getenv("PRINT_RESCAN_INTERVAL", "30"))
+# A file whose print failed stays in the folder and is retried by the next scan, at most
+# PRINT_MAX_ATTEMPTS times and no sooner than PRINT_RETRY_DELAY seconds after the last
+# failure; then it is renamed to <name>.failed so it is kept but no longer picked up
+PRINT_MAX_ATTEMPTS = int(os.getenv("PRINT_MAX_ATTEMPTS", "5"))
+PRINT_RETRY_DELAY = float(os.getenv("PRINT_RETRY_DELAY", "30"))
 
-    raw_data = base64.b64decode(base64_data)
+# Imported after load_dotenv so printer settings in IveConfig.txt apply
+from printers import PrinterManager
 
-    vendor_id = int(USB_VENDOR_ID, 16) if USB_VENDOR_ID.startswith("0x") else int(USB_VENDOR_ID)
-    product_id = int(USB_PRODUCT_ID, 16) if USB_PRODUCT_ID.startswith("0x") else int(USB_PRODUCT_ID)
 
-    dev = usb.core.find(idVendor=vendor_id, idProduct=product_id)
-    if dev is None:
-        raise ValueError(f"USB printer not found (VID={vendor_id}, PID={product_id}).")
-
-    # Detach kernel driver if possible, ignore on Windows if not implemented
-    try:
-        if dev.is_kernel_driver_active(INTERFACE):
-            dev.detach_kernel_driver(INTERFACE)
-    except NotImplementedError:
-        pass
-
-    usb.util.claim_interface(dev, INTERFACE)
-
-    cfg = dev.get_active_configuration()
-    intf = cfg[(0, 0)]
-    ep_out = usb.util.find_descriptor(
-        intf,
-        custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT
-    )
-    if ep_out is None:
-        raise ValueError("No OUT endpoint found on USB device.")
-
-    ep_out.write(raw_data, timeout=PRINT_TIMEOUT * 1000)  # pyusb timeout in ms
-    print("✅ Data sent to USB printer.")
-
-    usb.util.release_interface(dev, INTERFACE)
-    usb.util.dispose_resources(dev)
+_http = requests.Session()
 
 
 def get_invoice_data(invoice_number: str, print_invoice_type: int):
@@ -96,7 +59,7 @@ def get_invoice_data(invoice_number: str, print_invoice_type: int):
         "invoice_number": invoice_number
     }
 
-    response = requests.post(url, headers=headers, json=payload, timeout=10)
+    response = _http.post(url, headers=headers, json=payload, timeout=10)
     response.raise_for_status()
     data = response.json()
 
@@ -106,55 +69,246 @@ def get_invoice_data(invoice_number: str, print_invoice_type: int):
         raise ValueError("No base64_data found in API response")
 
 
-def process_latest_invoice():
-    """Find the newest invoice file, print it, then delete it (even if print fails)."""
+class PrintFailures:
+    """Failed attempts per invoice file, shared by the worker and the printer threads."""
+
+    def __init__(self):
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def due(self, invoice_file: Path, now: float = None) -> bool:
+        """False while a failed file waits out PRINT_RETRY_DELAY."""
+        with self._lock:
+            failure = self._failures.get(invoice_file)
+        return failure is None or (now or time.monotonic()) - failure[1] >= PRINT_RETRY_DELAY
+
+    def record(self, invoice_file: Path, error: Exception):
+        with self._lock:
+            attempts = self._failures.get(invoice_file, (0, 0))[0] + 1
+            self._failures[invoice_file] = (attempts, time.monotonic())
+        if attempts < PRINT_MAX_ATTEMPTS:
+            print(f"❌ Cannot print {invoice_file.name} (attempt {attempts}/{PRINT_MAX_ATTEMPTS}), will retry: {error}")
+            return
+        self.forget(invoice_file)
+        print(f"❌ Giving up on {invoice_file.name} after {attempts} attempts: {error}")
+        _remove(invoice_file, invoice_file.with_name(invoice_file.name + ".failed"))
+
+    def forget(self, invoice_file: Path):
+        with self._lock:
+            self._failures.pop(invoice_file, None)
+
+
+def _remove(invoice_file: Path, failed: Path = None):
+    """Delete the file, or move it to `failed` to keep it out of the next scan."""
+    try:
+        if failed is None:
+            invoice_file.unlink()
+            print(f"🗑 Deleted {invoice_file.name}")
+        else:
+            invoice_file.replace(failed)
+            print(f"📁 Moved {invoice_file.name} to {failed.name}")
+    except Exception as e:
+        print(f"⚠ Failed to remove file: {e}")
+
+
+def _report(invoice_file: Path, invoice_number: str, failures: PrintFailures):
+    def done(future):
+        error = future.exception()
+        if error is None:
+            print(f"✅ {invoice_number} printed on {future.result()}.")
+            failures.forget(invoice_file)
+            _remove(invoice_file)
+        else:
+            failures.record(invoice_file, error)
+    return done
+
+
+def process_invoice_file(invoice_file: Path, printer_manager: PrinterManager, failures: PrintFailures = None):
+    """
+    Queue one invoice file on a printer and return the print future, or None if nothing was queued.
+    The file is deleted once it has printed; after a failure it is left for the next scan.
+    """
+    failures = failures or PrintFailures()
+    parts = invoice_file.stem.split("-")
+    if len(parts) != 2 or not parts[1].isdigit():
+        # Retrying cannot fix the name
+        print(f"⚠ Skipping invalid file format: {invoice_file.name}")
+        _remove(invoice_file)
+        return None
+
+    invoice_number = parts[0]
+    print_invoice_type = int(parts[1])
+
+    try:
+        print(f"🖨 Printing {invoice_number} (type {print_invoice_type})...")
+
+        base64_data = get_invoice_data(invoice_number, print_invoice_type)
+
+        # The manager picks a healthy printer and fails over to another one on error
+        future = printer_manager.submit(base64.b64decode(base64_data))
+    except Exception as e:
+        failures.record(invoice_file, e)
+        return None
+    future.add_done_callback(_report(invoice_file, invoice_number, failures))
+    return future
+
+
+def list_pending_invoices(folder_path: Path):
+    """Invoice files in the folder, oldest first."""
+    files = []
+    for f in folder_path.glob("*.xml"):
+        try:
+            files.append((f.stat().st_ctime, f))
+        except FileNotFoundError:
+            pass
+    return [f for _, f in sorted(files)]
+
+
+def process_pending_invoices():
+    """
+    One-shot mode: print every invoice file currently in the folder in FIFO order.
+    Files that fail are kept for the next run; the attempt cap only applies within the daemon.
+    """
     folder_path = Path(PRINT_FOLDER)
     if not folder_path.exists():
         print(f"❌ Print folder not found: {PRINT_FOLDER}")
         return
 
-    files = sorted(folder_path.glob("*.xml"), key=lambda f: f.stat().st_ctime, reverse=True)
-
+    files = list_pending_invoices(folder_path)
     if not files:
         print("ℹ No invoice files found.")
         return
 
-    latest_file = files[0]
+    printer_manager = PrinterManager.from_env()
+    printer_manager.start()
     try:
-        parts = latest_file.stem.split("-")
-        if len(parts) != 2:
-            print(f"⚠ Skipping invalid file format: {latest_file.name}")
+        futures = [process_invoice_file(invoice_file, printer_manager) for invoice_file in files]
+        wait([f for f in futures if f is not None])
+    finally:
+        printer_manager.stop()
+
+
+class PrintDaemon:
+    """
+    Long-running printer agent: folder events feed a FIFO work queue that one worker
+    drains, so files that pile up during a rush are all printed in arrival order.
+    Print jobs are handed to the PrinterManager, which keeps the printers connected.
+    """
+
+    def __init__(self, folder: str = PRINT_FOLDER, printer_manager: PrinterManager = None):
+        self.folder_path = Path(folder)
+        self.printer_manager = printer_manager or PrinterManager.from_env()
+        self.jobs = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._observer = None
+        self.failures = PrintFailures()
+        self.processed = 0
+
+    def enqueue(self, invoice_file: Path):
+        if invoice_file.suffix.lower() != ".xml":
             return
-
-        invoice_number = parts[0]
-        print_invoice_type = int(parts[1])
-
-        print(f"🖨 Printing {invoice_number} (type {print_invoice_type})...")
-
-        base64_data = get_invoice_data(invoice_number, print_invoice_type)
-
-        # Choose printing mode
-        if USB_VENDOR_ID and USB_PRODUCT_ID:
+        with self._lock:
+            if invoice_file in self._queued:
+                return
+            self._queued.add(invoice_file)
+        self.jobs.put(invoice_file)
+
+    def scan(self):
+        now = time.monotonic()
+        for invoice_file in list_pending_invoices(self.folder_path):
+            if self.failures.due(invoice_file, now):
+                self.enqueue(invoice_file)
+
+    def _done(self, invoice_file: Path):
+        with self._lock:
+            self._queued.discard(invoice_file)
+
+    def _work(self):
+        while not self._stop.is_set():
             try:
-                print_to_usb_printer(base64_data)
-            except Exception as e_usb:
-                print(f"❌ USB printing failed: {e_usb}")
-                print("🔄 Falling back to IP printer...")
-                print_to_printer(base64_data)
+                invoice_file = self.jobs.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            future = None
+            try:
+                if invoice_file.exists():
+                    future = process_invoice_file(invoice_file, self.printer_manager, self.failures)
+                    self.processed += 1
+            finally:
+                if future is None:
+                    self._done(invoice_file)
+                else:
+                    # The file stays until it has printed; a rescan meanwhile must not queue it again
+                    future.add_done_callback(lambda _, invoice_file=invoice_file: self._done(invoice_file))
+                self.jobs.task_done()
+
+    def _poll(self, interval: float):
+        while not self._stop.wait(interval):
+            self.scan()
+
+    def start(self):
+        if not self.folder_path.exists():
+            raise FileNotFoundError(f"Print folder not found: {self.folder_path}")
+        self._stop.clear()
+        self.printer_manager.start()
+        # Files left from before the daemon started go first
+        self.scan()
+        self._threads = [threading.Thread(target=self._work, daemon=True)]
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(_FolderEvents(self), str(self.folder_path), recursive=False)
+            self._observer.start()
+            print(f"👀 Watching {self.folder_path} for invoice files")
+            if PRINT_RESCAN_INTERVAL > 0:
+                # enqueue skips files already queued, so the sweep never prints anything twice
+                self._threads.append(threading.Thread(target=self._poll, args=(PRINT_RESCAN_INTERVAL,), daemon=True))
         else:
-            print_to_printer(base64_data)
+            self._threads.append(threading.Thread(target=self._poll, args=(PRINT_POLL_INTERVAL,), daemon=True))
+            print(f"👀 Polling {self.folder_path} every {PRINT_POLL_INTERVAL}s (install watchdog for folder events)")
+        for t in self._threads:
+            t.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+        self._observer = None
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self.printer_manager.stop()
+
+    def run_forever(self):
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
 
-    except Exception as e:
-        print(f"❌ Error processing {latest_file.name}: {e}")
 
-    finally:
-        try:
-            latest_file.unlink()
-            print(f"🗑 Deleted {latest_file.name}")
-        except Exception as del_err:
-            print(f"⚠ Failed to delete file: {del_err}")
+class _FolderEvents(FileSystemEventHandler):
+    def __init__(self, daemon: PrintDaemon):
+        self.daemon = daemon
 
+    def on_created(self, event):
+        if not event.is_directory:
+            self.daemon.enqueue(Path(event.src_path))
 
-if __name__ == "__main__":
-    process_latest_invoice()
+    def on_moved(self, event):
+        # POS software may write to a temp name and rename into place
+        if not event.is_directory:
+            self.daemon.enqueue(Path(event.dest_path))
 
+
+if __name__ == "__main__":
+    if "--once" in sys.argv:
+        process_pending_invoices()
+    else:
+        PrintDaemon().run_forever()
@@ -0,0 +1,280 @@
+import os
+import time
+import queue
+import socket
+import threading
+from concurrent.futures import Future
+
+try:
+    import usb.core
+    import usb.util
+except ImportError:
+    usb = None
+
+PRINT_TIMEOUT = 10  # seconds
+INTERFACE = 0  # usually 0
+
+# Backoff before an unhealthy printer is tried again (seconds)
+RETRY_MIN = float(os.getenv("PRINTER_RETRY_MIN", "2"))
+RETRY_MAX = float(os.getenv("PRINTER_RETRY_MAX", "60"))
+
+
+class PrinterUnavailable(Exception):
+    pass
+
+
+class Printer:
+    """One physical printer with a long-lived connection and a health state."""
+
+    kind = "printer"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.healthy = True
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_error = None
+        self.jobs = queue.Queue()
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def available(self, now: float = None) -> bool:
+        """Healthy, or unhealthy but due for a probe."""
+        return self.healthy or (now or time.monotonic()) >= self.retry_at
+
+    def send(self, raw_bytes: bytes):
+        with self._lock:
+            # A kept-alive connection may have gone stale; reconnect once before giving up
+            for attempt in range(2):
+                try:
+                    if not self.connected():
+                        self.connect()
+                    self.write(raw_bytes)
+                    self._mark_ok()
+                    return
+                except Exception as e:
+                    self.disconnect()
+                    if attempt == 1:
+                        self._mark_failed(e)
+                        raise PrinterUnavailable(f"{self.name}: {e}") from e
+
+    def _mark_ok(self):
+        self.healthy = True
+        self.failures = 0
+        self.last_error = None
+        self.sent += 1
+
+    def _mark_failed(self, error: Exception):
+        self.healthy = False
+        self.failures += 1
+        self.last_error = str(error)
+        self.retry_at = time.monotonic() + min(RETRY_MAX, RETRY_MIN * (2 ** (self.failures - 1)))
+
+    def status(self) -> dict:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "healthy": self.healthy,
+            "failures": self.failures,
+            "queued": self.jobs.qsize(),
+            "sent": self.sent,
+            "last_error": self.last_error,
+        }
+
+    def connected(self) -> bool:
+        raise NotImplementedError
+
+    def connect(self):
+        raise NotImplementedError
+
+    def write(self, raw_bytes: bytes):
+        raise NotImplementedError
+
+    def disconnect(self):
+        raise NotImplementedError
+
+
+class NetworkPrinter(Printer):
+    """Raw TCP (port 9100) printer."""
+
+    kind = "ip"
+
+    def __init__(self, host: str, port: int = 9100, name: str = None):
+        super().__init__(name or f"ip:{host}:{port}")
+        self.host = host
+        self.port = port
+        self._sock = None
+
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    def connect(self):
+        s = socket.create_connection((self.host, self.port), timeout=PRINT_TIMEOUT)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._sock = s
+
+    def write(self, raw_bytes: bytes):
+        self._sock.sendall(raw_bytes)
+
+    def disconnect(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+
+class UsbPrinter(Printer):
+    """ESC/POS printer on USB; the device stays claimed between jobs."""
+
+    kind = "usb"
+
+    def __init__(self, vendor_id: int, product_id: int, name: str = None):
+        super().__init__(name or f"usb:{vendor_id:04x}:{product_id:04x}")
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self._dev = None
+        self._ep_out = None
+
+    def connected(self) -> bool:
+        return self._ep_out is not None
+
+    def connect(self):
+        if usb is None:
+            raise PrinterUnavailable("pyusb is not installed")
+        dev = usb.core.find(idVendor=self.vendor_id, idProduct=self.product_id)
+        if dev is None:
+            raise PrinterUnavailable(f"USB printer not found (VID={self.vendor_id}, PID={self.product_id}).")
+
+        # Detach kernel driver if possible, ignore on Windows if not implemented
+        try:
+            if dev.is_kernel_driver_active(INTERFACE):
+                dev.detach_kernel_driver(INTERFACE)
+        except NotImplementedError:
+            pass
+
+        usb.util.claim_interface(dev, INTERFACE)
+
+        cfg = dev.get_active_configuration()
+        intf = cfg[(0, 0)]
+        ep_out = usb.util.find_descriptor(
+            intf,
+            custom_match=lambda e: usb.util.endpoint_direction(e.bEndpointAddress) == usb.util.ENDPOINT_OUT
+        )
+        if ep_out is None:
+            usb.util.release_interface(dev, INTERFACE)
+            usb.util.dispose_resources(dev)
+            raise PrinterUnavailable("No OUT endpoint found on USB device.")
+        self._dev = dev
+        self._ep_out = ep_out
+
+    def write(self, raw_bytes: bytes):
+        self._ep_out.write(raw_bytes, timeout=PRINT_TIMEOUT * 1000)  # pyusb timeout in ms
+
+    def disconnect(self):
+        if self._dev is not None:
+            try:
+                usb.util.release_interface(self._dev, INTERFACE)
+                usb.util.dispose_resources(self._dev)
+            except Exception:
+                pass
+        self._dev = None
+        self._ep_out = None
+
+
+class PrinterManager:
+    """
+    Routes print jobs across printers. Each printer has its own queue and worker thread.
+    A job goes to the first available printer in configured order with the shortest queue.
+    If that printer fails, the job moves to another one. A failed printer is skipped until
+    its backoff expires; the next job routed to it then acts as the probe.
+    """
+
+    def __init__(self, printers):
+        self.printers = list(printers)
+        self._threads = []
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_env(cls):
+        """
+        PRINTERS="usb:0x0416:0x5011,ip:192.168.1.147:9100" lists printers in preference order.
+        Without it, the USB printer (if PRINTER_VENDOR_ID/PRINTER_PRODUCT_ID are set) comes
+        first and PRINTER_IP/PRINTER_PORT is the fallback, as before.
+        """
+        specs = [s.strip() for s in os.getenv("PRINTERS", "").split(",") if s.strip()]
+        if not specs:
+            vendor_id, product_id = os.getenv("PRINTER_VENDOR_ID"), os.getenv("PRINTER_PRODUCT_ID")
+            if vendor_id and product_id:
+                specs.append(f"usb:{vendor_id}:{product_id}")
+            specs.append(f"ip:{os.getenv('PRINTER_IP', '192.168.1.147')}:{os.getenv('PRINTER_PORT', '9100')}")
+        return cls(parse_printer(spec) for spec in specs)
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        for printer in self.printers:
+            t = threading.Thread(target=self._work, args=(printer,), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        for printer in self.printers:
+            printer.disconnect()
+
+    def submit(self, raw_bytes: bytes) -> Future:
+        """Queue raw ESC/POS bytes; the future resolves to the printer name that printed them."""
+        future = Future()
+        self._route(raw_bytes, future, tried=set())
+        return future
+
+    def status(self):
+        return [printer.status() for printer in self.printers]
+
+    def _route(self, raw_bytes: bytes, future: Future, tried: set):
+        now = time.monotonic()
+        candidates = [p for p in self.printers if p.name not in tried and p.available(now)]
+        if not candidates:
+            # Everything is backing off: probe whichever printer recovers first
+            candidates = sorted((p for p in self.printers if p.name not in tried), key=lambda p: p.retry_at)[:1]
+        if not candidates:
+            future.set_exception(PrinterUnavailable("No printer could take the job"))
+            return
+        printer = min(candidates, key=lambda p: p.jobs.qsize())
+        printer.jobs.put((raw_bytes, future, tried))
+
+    def _work(self, printer: Printer):
+        while not self._stop.is_set():
+            try:
+                raw_bytes, future, tried = printer.jobs.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                printer.send(raw_bytes)
+                future.set_result(printer.name)
+            except PrinterUnavailable as e:
+                print(f"❌ {e}; trying another printer")
+                tried.add(printer.name)
+                self._route(raw_bytes, future, tried)
+
+
+def parse_printer(spec: str) -> Printer:
+    kind, _, rest = spec.partition(":")
+    if kind == "usb":
+        vendor_id, _, product_id = rest.partition(":")
+        return UsbPrinter(_parse_id(vendor_id), _parse_id(product_id))
+    if kind == "ip":
+        host, _, port = rest.rpartition(":")
+        return NetworkPrinter(host, int(port)) if host else NetworkPrinter(rest)
+    raise ValueError(f"Unknown printer spec: {spec}")
+
+
+def _parse_id(value: str) -> int:
+    return int(value, 16) if value.startswith("0x") else int(value)